@@ -1,18 +1,26 @@
 from __future__ import print_function
 
+import argparse
+import array
+import collections
 import socket
 import fcntl, os
 import errno
+import random
+import select
+import threading
 
 import sys
 import time
-
-from sense_hat import SenseHat
-sh = SenseHat()
+import json
+import struct
 
 ADDR = ''          # Edit the gateway address here
 PORT = 10000
 
+# Largest datagram the gateway reads
+MAX_DATAGRAM = 2048
+
 # Create a UDP socket
 client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 server_address = (ADDR, PORT)
@@ -40,108 +48,601 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-# Input Parameters from command line
-device_id = sys.argv[1]
-num_messages = int(sys.argv[2])
-enable_accelerometer = sys.argv[3]
+# Set by main() from the command line
+device_id = None
+use_binary = False
+
+# Channel of the requests to the gateway, set by main()
+channel = None
 
-if not device_id:
-    sys.exit('The device id must be specified.')
 
-logger.info('Bringing up device {}'.format(device_id))
+# [START sensors]
+class SenseHatSensor(object):
+    """Accelerometer and LED matrix of the Sense HAT."""
+
+    def __init__(self):
+        from sense_hat import SenseHat
+        self.sh = SenseHat()
+
+    def read(self):
+        acceleration = self.sh.get_accelerometer_raw()
+        return acceleration['x'], acceleration['y'], acceleration['z']
+
+    def show_message(self, text):
+        self.sh.show_message(text) #text_colour=yellow, back_colour=blue, scroll_speed=0.05
+        self.sh.clear()
+
+
+class SyntheticSensor(object):
+    """Generated accelerometer readings, to run the device without a Sense HAT.
+
+    The device lies flat (z = 1g) with a little noise, and now and then gets
+    tilted (x = -1g) for a few hundred samples.
+    """
+
+    def __init__(self, tilt_probability=0.002, seed=None):
+        self.random = random.Random(seed)
+        self.tilt_probability = tilt_probability
+        self.tilted = 0
+
+    def read(self):
+        if not self.tilted and self.random.random() < self.tilt_probability:
+            self.tilted = self.random.randint(100, 1000)
+        noise = self.random.gauss
+        if self.tilted:
+            self.tilted -= 1
+            return -1.0 + noise(0, 0.02), noise(0, 0.02), noise(0, 0.02)
+        return noise(0, 0.02), noise(0, 0.02), 1.0 + noise(0, 0.02)
+
+    def show_message(self, text):
+        logger.info('Display: {}'.format(text))
+
+
+SENSORS = {
+    'sensehat': SenseHatSensor,
+    'synthetic': SyntheticSensor,
+}
+# [END sensors]
+
+
+# [START sample_ring]
+class SampleRing(object):
+    """Fixed-size ring of (timestamp, x, y, z) samples.
+
+    The storage is allocated once, in an array of doubles. When the ring is
+    full the oldest samples are overwritten, and counted in overwritten.
+    """
+
+    FIELDS = 4
+
+    def __init__(self, size):
+        self.size = size
+        self.data = array.array('d', [0.0]) * (size * self.FIELDS)
+        self.head = 0       # Number of samples ever written
+        self.tail = 0       # Number of samples ever taken, or overwritten
+        self.overwritten = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def put(self, timestamp, x, y, z):
+        i = (self.head % self.size) * self.FIELDS
+        data = self.data
+        data[i] = timestamp
+        data[i + 1] = x
+        data[i + 2] = y
+        data[i + 3] = z
+        self.head += 1
+        if self.head - self.tail > self.size:
+            self.tail += 1
+            self.overwritten += 1
+
+    def peek(self):
+        """Returns the oldest sample, without removing it."""
+        i = (self.tail % self.size) * self.FIELDS
+        return tuple(self.data[i:i + self.FIELDS])
+
+    def take(self, count):
+        """Removes and returns up to count of the oldest samples."""
+        count = min(count, len(self))
+        samples = []
+        for n in range(self.tail, self.tail + count):
+            i = (n % self.size) * self.FIELDS
+            samples.append(tuple(self.data[i:i + self.FIELDS]))
+        self.tail += count
+        return samples
+# [END sample_ring]
+
+
+# Binary frames, same layout as in gateway.py:
+#   header: magic, version, action code, length of the device id (!BBBB)
+#   device id, UTF-8
+#   version 2 only: sequence number of the request, or of the acked one (!I)
+#   event body: samples (timestamp, x, y, z) back to back (!dfff)
+#   ack body: acked action code, status code (!BB)
+FRAME_MAGIC = 0xB5
+FRAME_FORMATS = {'bin1': 1, 'bin2': 2}
+FRAME_HEADER = struct.Struct('!BBBB')
+FRAME_SEQ = struct.Struct('!I')
+FRAME_SAMPLE = struct.Struct('!dfff')
+FRAME_ACK = struct.Struct('!BB')
+FRAME_ACTIONS = {1: 'attach', 2: 'detach', 3: 'subscribe', 4: 'event', 5: 'ack'}
+FRAME_STATUSES = {0: 'ok', 1: 'busy', 2: 'error'}
+FRAME_EVENT = 4
+FRAME_ACK_CODE = 5
+
+
+def MakeEventFrame(device_id, samples, seq=None):
+    """Packs samples, a list of (timestamp, x, y, z), in one event frame.
+
+    The frame is of version 2 when it is numbered with seq."""
+    device = device_id.encode('utf8')
+    version = 1 if seq is None else 2
+    return b''.join(
+        [FRAME_HEADER.pack(FRAME_MAGIC, version, FRAME_EVENT, len(device)), device]
+        + ([] if seq is None else [FRAME_SEQ.pack(seq)])
+        + [FRAME_SAMPLE.pack(*sample) for sample in samples])
+
+
+def ParseReply(data):
+    """Returns the (seq, reply) of a reply of the gateway, or None for the
+    configs and commands it relays.
+
+    reply is the dict of a JSON reply, or the equivalent of a binary ack. seq
+    is None if the gateway did not number the reply.
+    """
+    if data[:1] == bytes((FRAME_MAGIC,)):
+        if len(data) < FRAME_HEADER.size:
+            return None
+        magic, version, code, id_length = FRAME_HEADER.unpack_from(data)
+        if code != FRAME_ACK_CODE:
+            return None
+        offset = FRAME_HEADER.size + id_length
+        seq = None
+        if version >= 2:
+            seq, = FRAME_SEQ.unpack_from(data, offset)
+            offset += FRAME_SEQ.size
+        action, status = FRAME_ACK.unpack_from(data, offset)
+        return seq, {'command': FRAME_ACTIONS.get(action),
+                     'status': FRAME_STATUSES.get(status)}
+    if not data.startswith(b'{ "device"'):
+        return None
+    try:
+        reply = json.loads(data.decode('utf8'))
+    except ValueError:
+        return None
+    if not isinstance(reply, dict) or 'command' not in reply or 'status' not in reply:
+        return None
+    return reply.get('seq'), reply
+
+
+# [START channel]
+# Bounds of the retransmission timeout, in seconds
+MIN_RTO = 0.2
+MAX_RTO = 5.0
+INITIAL_RTO = 1.0
+
+# Number of times a request is sent before giving up on it
+MAX_TRANSMISSIONS = 5
+
+# Sequence numbers are 32 bits, and wrap around
+SEQ_MODULO = 1 << 32
+
+
+class Request(object):
+    """A request sent to the gateway, and waiting for its reply."""
+
+    __slots__ = ('seq', 'datagram', 'sent_at', 'deadline', 'transmissions', 'reply')
+
+    def __init__(self, seq, datagram):
+        self.seq = seq
+        self.datagram = datagram
+        self.sent_at = None
+        self.deadline = None
+        self.transmissions = 0
+        self.reply = None
+
+
+class Channel(object):
+    """Numbered requests to the gateway, acknowledged within a sliding window.
+
+    Every request carries a sequence number, which the gateway echoes in its
+    reply. Up to `window` requests may wait for their replies. Those not
+    replied to within the retransmission timeout are sent again, with
+    exponential backoff, up to MAX_TRANSMISSIONS times; the gateway
+    acknowledges the duplicates without handling them twice. The timeout
+    follows the measured round trip times, as in TCP (RFC 6298).
+
+    The first sequence number is random, so that the gateway tells a new
+    session of the device from the retransmissions of the previous one.
+    Datagrams which are not replies, the configs and commands relayed by the
+    gateway, are handed to on_downlink.
+    """
+
+    def __init__(self, sock, address, window, on_downlink):
+        self.sock = sock
+        self.address = address
+        self.window = window
+        self.on_downlink = on_downlink
+        self.next_seq = random.getrandbits(32)
+        self.pending = collections.OrderedDict()    # seq: Request
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.stats = {'sent': 0, 'acked': 0, 'retransmitted': 0, 'busy': 0,
+                      'lost': 0, 'unexpected': 0}
+
+    def has_room(self):
+        return len(self.pending) < self.window
+
+    def send(self, make_datagram):
+        """Sends the datagram make_datagram(seq) without waiting for its reply.
+
+        Waits for room in the window first. Returns the Request."""
+        while not self.has_room():
+            self.poll(self.timeout())
+        seq = self.next_seq
+        self.next_seq = (seq + 1) % SEQ_MODULO
+        datagram = make_datagram(seq)
+        if not isinstance(datagram, bytes):
+            datagram = datagram.encode()
+        request = Request(seq, datagram)
+        self.pending[seq] = request
+        self.stats['sent'] += 1
+        self.transmit(request, time.time())
+        return request
+
+    def request(self, make_datagram):
+        """Sends the datagram make_datagram(seq) and waits for its reply.
+
+        Returns the reply, or None if the gateway did not reply."""
+        request = self.send(make_datagram)
+        while request.seq in self.pending:
+            self.poll(self.timeout())
+        return request.reply
+
+    def flush(self):
+        """Waits until every request got its reply, or was given up."""
+        while self.pending:
+            self.poll(self.timeout())
+
+    def timeout(self):
+        """Returns the time until the next retransmission, None if there is
+        no request waiting."""
+        if not self.pending:
+            return None
+        deadline = min(request.deadline for request in self.pending.values())
+        return max(deadline - time.time(), 0)
+
+    def transmit(self, request, now):
+        logger.debug('Sending #{} "{}"'.format(request.seq, request.datagram))
+        self.sock.sendto(request.datagram, self.address)
+        request.transmissions += 1
+        request.sent_at = now
+        request.deadline = now + min(
+            self.rto * 2 ** (request.transmissions - 1), MAX_RTO)
+
+    def poll(self, timeout):
+        """Waits up to timeout seconds for datagrams from the gateway, handles
+        them, then retransmits the requests whose reply is late."""
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        while readable:
+            try:
+                data = self.sock.recv(4096)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            self.receive(data)
+        self.retransmit()
+
+    def receive(self, data):
+        parsed = ParseReply(data)
+        if parsed is None:
+            self.on_downlink(data.decode('utf8'))
+            return
+        seq, reply = parsed
+        logger.debug('Received #{}: "{}"'.format(seq, reply))
+        if seq is None:
+            # Gateways which do not number their replies send them in order
+            if not self.pending:
+                self.stats['unexpected'] += 1
+                return
+            seq = next(iter(self.pending))
+        elif reply.get('status') == 'busy' and seq in self.pending:
+            # Rejected for now, sent again on its deadline
+            self.stats['busy'] += 1
+            return
+        request = self.pending.pop(seq, None)
+        if request is None:
+            # Reply to a retransmission of a request replied to already
+            self.stats['unexpected'] += 1
+            return
+        request.reply = reply
+        self.stats['acked'] += 1
+        if request.transmissions == 1:
+            # Karn's algorithm: the replies to retransmissions are ambiguous
+            self.measure(time.time() - request.sent_at)
+
+    def measure(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def retransmit(self):
+        now = time.time()
+        for request in list(self.pending.values()):
+            if request.deadline > now:
+                continue
+            if request.transmissions >= MAX_TRANSMISSIONS:
+                del self.pending[request.seq]
+                self.stats['lost'] += 1
+                logger.info('No reply to request #{}'.format(request.seq))
+                continue
+            self.stats['retransmitted'] += 1
+            self.transmit(request, now)
 
+    def stats_str(self):
+        return ('in flight {}/{}, rto {:.3f}s, sent {sent}, acked {acked}, '
+                'retransmitted {retransmitted}, busy {busy}, lost {lost}, '
+                'unexpected {unexpected}').format(
+                    len(self.pending), self.window, self.rto, **self.stats)
+# [END channel]
 
-def SendCommand(sock, message):
-    logger.debug('Sending "{}"'.format(message))
-    sock.sendto(message.encode(), server_address)
 
-    # Receive response
-    logger.debug('waiting for response')
-    while True:
-        try:
-            response = sock.recv(4096)
-        except socket.error as e:
-            err = e.args[0]
-            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                continue
-            else:
-                # a "real" error occurred
-                logger.info(e)
-                sys.exit(1)
-        else:
-            break
+def MakeMessage(device_id, action, data='', seq=None):
+    fields = '"device" : "{}", "action":"{}"'.format(device_id, action)
+    if seq is not None:
+        fields += ', "seq" : {}'.format(seq)
+    if data:
+        fields += ', "data" : {}'.format(data)
+    return '{{ {} }}'.format(fields)
 
-    logger.debug('Received: "{}"'.format(response))
 
+def MakeEvent(device_id, timestamp, x, y, z):
+    return '{{ "device_id": "{}", "event_time": "{}", "raw_accelerometer_data": "x={}, y={}, z={}" }}'.format(
+        device_id, time.asctime(time.gmtime(timestamp)), x, y, z)
+
+
+def RunAction(action, data='', wait=True):
+    """Sends an action to the gateway, returns its reply if wait is True."""
+    logger.info('Send data: {} '.format(MakeMessage(device_id, action, data)))
+    make_message = lambda seq: MakeMessage(device_id, action, data, seq)
+    if not wait:
+        channel.send(make_message)
+        return None
+    response = channel.request(make_message)
+    logger.debug('Response: {}'.format(response))
     return response
 
 
-def MakeMessage(device_id, action, data=''):
-    if data:
-        return '{{ "device" : "{}", "action":"{}", "data" : {} }}'.format(
-            device_id, action, data)
-    else:
-        return '{{ "device" : "{}", "action":"{}" }}'.format(
-            device_id, action)
-
-
-def RunAction(action, data=''):
-    global client_sock
-    message = MakeMessage(device_id, action, data)
-    if not message:
-        return
-    logger.info('Send data: {} '.format(message))
-    event_response = SendCommand(client_sock, message)
-    logger.debug('Response: {}'.format(event_response))
-
-
-try:
-    RunAction('attach')
-    
-    time.sleep(3)
-    RunAction('subscribe')
-
-    time.sleep(3)
-    for i in range(0, num_messages):
-        RunAction('event', '"Sending message #{}"'.format(i))
-        time.sleep(1)
-
-    response = None
+def Attach():
+    """Attaches the device, returns the binary frame format accepted, if any."""
+    if not use_binary:
+        RunAction('attach')
+        return None
+    formats = json.dumps(sorted(FRAME_FORMATS, reverse=True))
+    make_message = lambda seq: (
+        '{{ "device" : "{}", "action":"attach", "seq" : {}, "formats" : {} }}'.format(
+            device_id, seq, formats))
+    logger.info('Send data: {} '.format(make_message(channel.next_seq)))
+    response = channel.request(make_message)
+    if response is None:
+        sys.exit('The gateway did not reply.')
+    return response.get('format')
+
+
+def SendEventFrame(samples, frame_format):
+    make_frame = lambda seq: MakeEventFrame(
+        device_id, samples, seq if frame_format == 'bin2' else None)
+    logger.debug('Send frame of {} samples'.format(len(samples)))
+    channel.send(make_frame)
+
+
+def HandleDownlink(sensor, response):
+    """Handles a config or command relayed by the gateway."""
+    logger.info('Client received {{{}}}'.format(response))
+
+    # Display from command
+    if response.startswith("d_DISP"):
+        display_content = response[8:]
+        sensor.show_message(display_content)
+
+
+# [START sampling]
+class BatchSender(object):
+    """Sends the samples of the ring in batched event datagrams, as long as
+    the window of the channel has room."""
+
+    def __init__(self, channel, ring, frame_format):
+        self.channel = channel
+        self.ring = ring
+        self.frame_format = frame_format
+        if frame_format:
+            header = FRAME_HEADER.size + FRAME_SEQ.size + len(device_id.encode('utf8'))
+            self.max_samples = (MAX_DATAGRAM - header) // FRAME_SAMPLE.size
+        self.stats = {'datagrams': 0, 'samples': 0}
+
+    def make_datagram(self, samples, seq):
+        if self.frame_format:
+            return MakeEventFrame(
+                device_id, samples, seq if self.frame_format == 'bin2' else None)
+        events = ','.join(MakeEvent(device_id, *sample) for sample in samples)
+        return MakeMessage(device_id, 'event', '[{}]'.format(events), seq)
+
+    def take_samples(self):
+        """Takes from the ring the samples which fit in one datagram."""
+        if self.frame_format:
+            return self.ring.take(self.max_samples)
+        samples = []
+        # With the largest seq, for a retransmission to fit too
+        size = len(MakeMessage(device_id, 'event', '[]', SEQ_MODULO - 1).encode())
+        while len(self.ring):
+            # The event and its comma, one sample is sent whatever its size
+            event_size = len(MakeEvent(device_id, *self.ring.peek()).encode()) + 1
+            if samples and size + event_size > MAX_DATAGRAM:
+                break
+            samples.append(self.ring.take(1)[0])
+            size += event_size
+        return samples
+
+    def send(self):
+        while len(self.ring) and self.channel.has_room():
+            samples = self.take_samples()
+            self.channel.send(lambda seq: self.make_datagram(samples, seq))
+            self.stats['datagrams'] += 1
+            self.stats['samples'] += len(samples)
+
+
+def RunSampling(sensor, frame_format, sample_rate, batch_interval, ring_size):
+    """Samples the accelerometer at sample_rate Hz, and sends the samples every
+    batch_interval seconds."""
+    ring = SampleRing(ring_size)
+    sender = BatchSender(channel, ring, frame_format)
+    period = 1.0 / sample_rate
+    next_sample = time.time()
+    next_batch = next_sample + batch_interval
+    next_stats = next_sample + 10
+    skipped = 0
+
     while True:
-        try:
-            response = client_sock.recv(4096).decode('utf8')
-        except socket.error as e:
-            err = e.args[0]
-            if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
-                ### Non-blocking operations
-                if enable_accelerometer == "true":
-                    # accelerometer
-                    acceleration = sh.get_accelerometer_raw()
-                    x = acceleration['x']
-                    y = acceleration['y']
-                    z = acceleration['z']
-
-                    x=round(x, 0)
-                    y=round(y, 0)
-                    z=round(z, 0)
-
-                    logger.debug("x={0}, y={1}, z={2}".format(x, y, z))
-                    RunAction('event', '{{ "device_id": "{}", "event_time": "{}", "raw_accelerometer_data": "x={}, y={}, z={}" }}'.format(device_id, time.ctime(), x, y, z))
+        now = time.time()
+        if now >= next_sample:
+            x, y, z = sensor.read()
+            # Rounded like the readings of the non sampling mode
+            ring.put(now, round(x, 0), round(y, 0), round(z, 0))
+            next_sample += period
+            if now - next_sample > 10 * period:
+                # Too far behind, e.g. after a long display
+                skipped += int((now - next_sample) / period)
+                next_sample = now + period
+
+        if now >= next_batch:
+            sender.send()
+            next_batch += batch_interval
+
+        if now >= next_stats:
+            logger.info('Sampling: {} buffered, {} overwritten, {} skipped, {} datagrams, {} samples'.format(
+                len(ring), ring.overwritten, skipped,
+                sender.stats['datagrams'], sender.stats['samples']))
+            logger.info('Channel: {}'.format(channel.stats_str()))
+            next_stats += 10
+
+        # Sleep until the next sample, batch or retransmission, waking up for
+        # the gateway
+        timeout = min(next_sample, next_batch) - time.time()
+        retransmit_timeout = channel.timeout()
+        if retransmit_timeout is not None:
+            timeout = min(timeout, retransmit_timeout)
+        channel.poll(max(timeout, 0))
+# [END sampling]
+
+
+def parse_command_line_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description=(
+        'Raspberry Pi device sending events through the gateway.'))
+    parser.add_argument('device_id', help='Cloud IoT Core device id')
+    parser.add_argument('num_messages', type=int, help='Number of test messages to send')
+    parser.add_argument(
+        'enable_accelerometer', choices=('true', 'false'),
+        help='Send accelerometer readings')
+    parser.add_argument(
+        'use_binary', nargs='?', choices=('true', 'false'), default='false',
+        help='Send accelerometer readings as binary frames')
+    parser.add_argument(
+        '--sensor', choices=sorted(SENSORS), default='sensehat',
+        help='Where the accelerometer readings come from.')
+    parser.add_argument(
+        '--sample_rate_hz', type=float, default=0,
+        help=('Sample the accelerometer at this fixed rate and send the samples '
+              'in batches. 0 sends one reading at a time.'))
+    parser.add_argument(
+        '--batch_interval_ms', type=int, default=1000,
+        help='Interval, in milliseconds, between two batches of samples.')
+    parser.add_argument(
+        '--ring_size', type=int, default=4096,
+        help='Number of samples buffered on the device.')
+    parser.add_argument(
+        '--max_in_flight', type=int, default=8,
+        help='Maximum number of requests sent and not yet acknowledged.')
+    return parser.parse_args()
+
+
+def main():
+    global device_id
+    global use_binary
+    global channel
+
+    args = parse_command_line_args()
+
+    # Input Parameters from command line
+    device_id = args.device_id
+    num_messages = args.num_messages
+    enable_accelerometer = args.enable_accelerometer
+    use_binary = args.use_binary == "true"
+
+    if not device_id:
+        sys.exit('The device id must be specified.')
+
+    logger.info('Bringing up device {}'.format(device_id))
+
+    sensor = SENSORS[args.sensor]()
+
+    def on_downlink(response):
+        # Scrolling a message takes seconds, keep talking to the gateway
+        # meanwhile
+        threading.Thread(target=HandleDownlink, args=(sensor, response)).start()
+
+    channel = Channel(client_sock, server_address, args.max_in_flight, on_downlink)
+
+    try:
+        frame_format = Attach()
+        logger.info('Binary frames {}'.format(frame_format or 'disabled'))
+
+        time.sleep(3)
+        RunAction('subscribe')
+
+        time.sleep(3)
+        for i in range(0, num_messages):
+            RunAction('event', '"Sending message #{}"'.format(i))
+            time.sleep(1)
+
+        if enable_accelerometer == "true" and args.sample_rate_hz > 0:
+            RunSampling(sensor, frame_format, args.sample_rate_hz,
+                        args.batch_interval_ms / 1000.0, args.ring_size)
+
+        while True:
+            if enable_accelerometer == "true":
+                channel.poll(0)
+
+                # accelerometer
+                x, y, z = sensor.read()
+
+                x=round(x, 0)
+                y=round(y, 0)
+                z=round(z, 0)
+
+                logger.debug("x={0}, y={1}, z={2}".format(x, y, z))
+                if frame_format:
+                    SendEventFrame([(time.time(), x, y, z)], frame_format)
+                    continue
+                RunAction('event', MakeEvent(device_id, time.time(), x, y, z), wait=False)
             else:
-                # a "real" error occurred
-                logger.info(e)
-                sys.exit(1)
-        else:
-            logger.info('Client received {{{}}}'.format(response))
-            
-            # Display from command
-            if response.startswith("d_DISP"):
-                display_content = response[8:]
-                sh.show_message(display_content) #text_colour=yellow, back_colour=blue, scroll_speed=0.05
-                sh.clear()
-
-finally:
-    RunAction('detach')
-
-    logger.info('closing socket', file=sys.stderr)
-    client_sock.close()
+                # Sleep until a config or command comes, or a retransmission
+                channel.poll(channel.timeout())
+
+    finally:
+        channel.flush()
+        RunAction('detach')
+
+        logger.info('closing socket')
+        client_sock.close()
+
+
+if __name__ == '__main__':
+    main()
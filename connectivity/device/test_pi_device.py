@@ -0,0 +1,79 @@
+import json
+import unittest
+
+import pi_device
+
+
+class BatchSenderTest(unittest.TestCase):
+
+    def setUp(self):
+        pi_device.device_id = 'my-device'
+        self.ring = pi_device.SampleRing(4096)
+        self.sender = pi_device.BatchSender(None, self.ring, None)
+
+    def datagrams(self):
+        """Returns the datagrams of the samples of the ring, numbered with
+        the largest seq."""
+        datagrams = []
+        while len(self.ring):
+            samples = self.sender.take_samples()
+            datagrams.append((samples, self.sender.make_datagram(
+                samples, pi_device.SEQ_MODULO - 1).encode()))
+        return datagrams
+
+    def check(self, count):
+        datagrams = self.datagrams()
+        self.assertEqual(sum(len(samples) for samples, _ in datagrams), count)
+        for samples, datagram in datagrams:
+            self.assertLessEqual(len(datagram), pi_device.MAX_DATAGRAM)
+            self.assertEqual(len(json.loads(datagram.decode())['data']), len(samples))
+        return datagrams
+
+    def event_size(self, sample):
+        return len(pi_device.MakeEvent(pi_device.device_id, *sample).encode()) + 1
+
+    def test_longer_event_at_the_boundary(self):
+        # A padding event then short ones, leaving room for one more short
+        # event but not for the long event coming next, even without its comma
+        short = (0.0, 0.0, 0.0, 0.0)
+        long_sample = (1e9, -123456789.125, -123456789.125, -123456789.125)
+        header = len(pi_device.MakeMessage(
+            pi_device.device_id, 'event', '[]', pi_device.SEQ_MODULO - 1).encode())
+        room = pi_device.MAX_DATAGRAM - header
+        for x_digits in range(1, 16):
+            for y_digits in range(1, 16):
+                padding = (0.0, float('1' * x_digits), float('1' * y_digits), 0.0)
+                left = (room - self.event_size(padding)) % self.event_size(short)
+                if left + self.event_size(short) < self.event_size(long_sample) - 1:
+                    break
+            else:
+                continue
+            break
+        else:
+            self.fail('No padding reaches the boundary')
+        shorts = (room - self.event_size(padding)) // self.event_size(short) - 1
+        self.ring.put(*padding)
+        for _ in range(shorts):
+            self.ring.put(*short)
+        self.ring.put(*long_sample)
+        datagrams = self.check(1 + shorts + 1)
+        self.assertEqual([len(samples) for samples, _ in datagrams], [1 + shorts, 1])
+
+    def test_full_datagrams(self):
+        for n in range(1000):
+            self.ring.put(1.5e9 + n, float(n % 3 - 1), -float(n % 7), 10.0 ** (n % 9))
+        datagrams = self.check(1000)
+        # Every datagram but the last one has no room for its next event
+        for (samples, datagram), (next_samples, _) in zip(datagrams, datagrams[1:]):
+            event = pi_device.MakeEvent(pi_device.device_id, *next_samples[0]).encode()
+            self.assertGreater(len(datagram) + len(event) + 1, pi_device.MAX_DATAGRAM)
+
+    def test_event_larger_than_a_datagram(self):
+        pi_device.device_id = 'd' * pi_device.MAX_DATAGRAM
+        self.ring.put(0.0, 0.0, 0.0, 0.0)
+        self.ring.put(0.0, 0.0, 0.0, 0.0)
+        self.assertEqual([len(samples) for samples, _ in self.datagrams()], [1, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
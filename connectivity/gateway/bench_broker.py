@@ -0,0 +1,177 @@
+"""
+Local stand-in for the Google MQTT bridge, for the gateway benchmarks.
+
+Speaks just enough MQTT 3.1.1 for gateway.py: CONNECT, PUBLISH (acked when
+QoS 1), SUBSCRIBE, UNSUBSCRIBE, PINGREQ and DISCONNECT. Messages are counted,
+not routed. Every report interval, prints its counters as one JSON line on
+stdout. Run the gateway with --no_tls against it:
+
+    python bench_broker.py --port 1883
+    python gateway.py --no_tls --mqtt_bridge_hostname 127.0.0.1 \\
+        --mqtt_bridge_port 1883 ...
+"""
+
+import argparse
+import asyncio
+import json
+import signal
+import struct
+import time
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+CONNACK = b'\x20\x02\x00\x00'
+PINGRESP = b'\xd0\x00'
+
+
+class Counters(object):
+    connections = 0
+    connected = 0
+    publishes = 0
+    payload_bytes = 0
+    subscribes = 0
+
+    # Publishes per last level of the topic: events, attach, detach, state...
+    kinds = {}
+
+    @classmethod
+    def as_dict(cls):
+        return {
+            'time': time.time(),
+            'connections': cls.connections,
+            'connected': cls.connected,
+            'publishes': cls.publishes,
+            'payload_bytes': cls.payload_bytes,
+            'subscribes': cls.subscribes,
+            'kinds': dict(cls.kinds),
+        }
+
+
+def encode_length(length):
+    """Encodes the remaining length of a packet."""
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        out.append(byte)
+        if not length:
+            return bytes(out)
+
+
+async def read_packet(reader):
+    """Returns the (first byte, body) of the next packet."""
+    first = (await reader.readexactly(1))[0]
+    multiplier, length = 1, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 127) * multiplier
+        multiplier *= 128
+        if not byte & 128:
+            break
+    body = await reader.readexactly(length) if length else b''
+    return first, body
+
+
+def on_publish(writer, first, body, puback_delay):
+    qos = (first >> 1) & 3
+    topic_length, = struct.unpack_from('!H', body)
+    topic = body[2:2 + topic_length].decode('utf8')
+    offset = 2 + topic_length
+    if qos:
+        mid = body[offset:offset + 2]
+        offset += 2
+        puback = b'\x40\x02' + mid
+        if puback_delay:
+            asyncio.get_event_loop().call_later(puback_delay, writer.write, puback)
+        else:
+            writer.write(puback)
+    Counters.publishes += 1
+    Counters.payload_bytes += len(body) - offset
+    kind = topic.rsplit('/', 1)[-1]
+    Counters.kinds[kind] = Counters.kinds.get(kind, 0) + 1
+
+
+def on_subscribe(writer, body):
+    mid = body[:2]
+    offset = 2
+    granted = bytearray()
+    while offset < len(body):
+        topic_length, = struct.unpack_from('!H', body, offset)
+        offset += 2 + topic_length
+        granted.append(body[offset])
+        offset += 1
+    Counters.subscribes += len(granted)
+    writer.write(b'\x90' + encode_length(2 + len(granted)) + mid + bytes(granted))
+
+
+async def handle(reader, writer, puback_delay):
+    Counters.connections += 1
+    Counters.connected += 1
+    try:
+        while True:
+            first, body = await read_packet(reader)
+            packet_type = first >> 4
+            if packet_type == PUBLISH:
+                on_publish(writer, first, body, puback_delay)
+            elif packet_type == CONNECT:
+                writer.write(CONNACK)
+            elif packet_type == SUBSCRIBE:
+                on_subscribe(writer, body)
+            elif packet_type == UNSUBSCRIBE:
+                writer.write(b'\xb0\x02' + body[:2])
+            elif packet_type == PINGREQ:
+                writer.write(PINGRESP)
+            elif packet_type == DISCONNECT:
+                break
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        Counters.connected -= 1
+        writer.close()
+
+
+async def report(interval):
+    while True:
+        print(json.dumps(Counters.as_dict()), flush=True)
+        await asyncio.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', default=1883, type=int, help='Port to listen on.')
+    parser.add_argument(
+        '--puback_delay_ms', default=0, type=float,
+        help='Delay of the PUBACKs, to mimic the round trip to the bridge.')
+    parser.add_argument(
+        '--report_interval', default=1.0, type=float,
+        help='Interval, in seconds, between two reports of the counters.')
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(asyncio.start_server(
+        lambda reader, writer: handle(reader, writer, args.puback_delay_ms / 1000.0),
+        args.host, args.port))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    reporter = loop.create_task(report(args.report_interval))
+    try:
+        loop.run_forever()
+    finally:
+        # Last report, with everything received
+        print(json.dumps(Counters.as_dict()), flush=True)
+        reporter.cancel()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
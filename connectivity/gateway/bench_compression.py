@@ -0,0 +1,194 @@
+"""
+Compression of recorded event payloads, with dictionaries trained on them.
+
+Trains a dictionary on part of the samples, then reports for every codec the
+compression ratio of the other samples, and the CPU time to compress and
+decompress one payload. Samples are events, one JSON object per line, e.g.
+exported from BigQuery (see data-processing/README.md); they are published
+one per payload, or in arrays as the gateway batches them. Without
+--samples, events like those of pi_device are generated. Run it from this
+folder, and pass the dictionary written to the gateway with --compress:
+
+    python bench_compression.py --samples events.json --dictionary telemetry.dict
+    python gateway.py --compress zlib --compress_dictionary telemetry.dict ...
+"""
+
+import argparse
+import json
+import random
+import time
+import zlib
+
+from gateway import (COMPRESSED_HEADER, COMPRESSED_MAGIC, COMPRESSION_CODES,
+                     PayloadCompressor, dictionary_id, zstandard)
+
+# Samples a zlib dictionary is made of, spread over the training ones
+ZLIB_DICTIONARY_SAMPLES = 64
+
+
+def synthetic_events(count, devices, seed):
+    """Returns events as pi_device sends them, lying flat and tilted now and then."""
+    rng = random.Random(seed)
+    start = 1588085999
+    events = []
+    for n in range(count):
+        if rng.random() < 0.05:
+            x, y, z = -1.0, round(rng.gauss(0, 0.02), 0), round(rng.gauss(0, 0.02), 0)
+        else:
+            x, y, z = (round(rng.gauss(0, 0.02), 0), round(rng.gauss(0, 0.02), 0),
+                       round(1 + rng.gauss(0, 0.02), 0))
+        events.append(json.dumps({
+            'device_id': 'my-device-{}'.format(n % devices),
+            'event_time': time.ctime(start + n // devices),
+            'raw_accelerometer_data': 'x={}, y={}, z={}'.format(x, y, z)}))
+    return events
+
+
+def read_events(paths):
+    events = []
+    for path in paths:
+        with open(path) as f:
+            events.extend(json.dumps(json.loads(line)) for line in f if line.strip())
+    return events
+
+
+def make_payloads(events, batch_size):
+    """Returns the payloads the gateway publishes for events."""
+    if batch_size == 1:
+        return [event.encode() for event in events]
+    return ['[{}]'.format(','.join(events[i:i + batch_size])).encode()
+            for i in range(0, len(events), batch_size)]
+
+
+def train_zlib_dictionary(samples, size):
+    """Returns a zlib dictionary of samples spread over the training ones.
+
+    Events share most of their text with the other events of their kind:
+    deflate finds it in the samples the dictionary is made of, which are
+    spread out to cover the devices and kinds of events."""
+    step = max(len(samples) // ZLIB_DICTIONARY_SAMPLES, 1)
+    chosen = []
+    total = 0
+    for sample in samples[::step]:
+        if total + len(sample) > size:
+            break
+        chosen.append(sample)
+        total += len(sample)
+    return b''.join(chosen)
+
+
+def train_dictionary(encoding, samples, size):
+    if encoding == 'zstd':
+        return zstandard.train_dictionary(size, samples).as_bytes()
+    return train_zlib_dictionary(samples, size)
+
+
+class Decompressor(object):
+    """Decodes the payloads of PayloadCompressor, as the consumers do."""
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.dict_id = dictionary_id(dictionary)
+        self.zstd = None
+        if zstandard is not None:
+            self.zstd = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(dictionary))
+
+    def decompress(self, data):
+        if data[:1] != bytes((COMPRESSED_MAGIC,)):
+            return data
+        _, code, dict_id = COMPRESSED_HEADER.unpack_from(data)
+        if dict_id != self.dict_id:
+            raise ValueError('Unknown dictionary {:08x}'.format(dict_id))
+        body = data[COMPRESSED_HEADER.size:]
+        if code == COMPRESSION_CODES['zstd']:
+            return self.zstd.decompress(body)
+        decompressor = zlib.decompressobj(-15, self.dictionary)
+        return decompressor.decompress(body) + decompressor.flush()
+
+
+def measure(compress, decompress, payloads):
+    """Returns (compressed bytes, us per compression, us per decompression)."""
+    start = time.perf_counter()
+    compressed = [compress(payload) for payload in payloads]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decompressed = [decompress(data) for data in compressed]
+    decompress_time = time.perf_counter() - start
+    if decompressed != payloads:
+        raise RuntimeError('The payloads do not survive the round trip')
+    return (sum(len(data) for data in compressed),
+            compress_time / len(payloads) * 1e6, decompress_time / len(payloads) * 1e6)
+
+
+def codecs(train, dictionary_size, level):
+    """Yields the (name, compress, decompress) of the codecs to compare."""
+    yield 'none', lambda data: data, lambda data: data
+    encodings = ['zlib'] + (['zstd'] if zstandard is not None else [])
+    for encoding in encodings:
+        # Without a dictionary: the same format, with an empty one
+        for dictionary, name in ((b'\0', encoding),
+                                 (train_dictionary(encoding, train, dictionary_size),
+                                  '{}+dict'.format(encoding))):
+            compressor = PayloadCompressor(encoding, dictionary, level)
+            yield name, compressor.compress, Decompressor(dictionary).decompress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--samples', nargs='+', help='Files of recorded events, one JSON object per line.')
+    parser.add_argument(
+        '--synthetic', default=20000, type=int,
+        help='Number of events generated, without --samples.')
+    parser.add_argument(
+        '--devices', default=10, type=int, help='Devices of the generated events.')
+    parser.add_argument(
+        '--batch_sizes', nargs='+', default=[1, 10], type=int,
+        help='Events per payload, as the gateway batches them, one report each.')
+    parser.add_argument(
+        '--train_ratio', default=0.5, type=float,
+        help='Share of the samples the dictionaries are trained on.')
+    parser.add_argument(
+        '--dictionary_size', default=4096, type=int, help='Size of the dictionaries.')
+    parser.add_argument(
+        '--level', type=int, help='Compression level, as --compress_level of the gateway.')
+    parser.add_argument(
+        '--encoding', choices=('zlib', 'zstd'), default='zlib',
+        help='Encoding of the dictionary written with --dictionary.')
+    parser.add_argument(
+        '--dictionary', help='File to write the dictionary trained on all the samples to.')
+    parser.add_argument('--seed', default=1, type=int, help='Seed of the generated events.')
+    args = parser.parse_args()
+
+    if args.samples:
+        events = read_events(args.samples)
+    else:
+        events = synthetic_events(args.synthetic, args.devices, args.seed)
+    split = int(len(events) * args.train_ratio)
+    print('{} events, {} to train the dictionaries on, {} to measure'.format(
+        len(events), split, len(events) - split))
+
+    print('{:>6} {:<10} {:>12} {:>8} {:>14} {:>16}'.format(
+        'batch', 'codec', 'bytes/msg', 'ratio', 'compress us', 'decompress us'))
+    for batch_size in args.batch_sizes:
+        train = make_payloads(events[:split], batch_size)
+        payloads = make_payloads(events[split:], batch_size)
+        raw = sum(len(payload) for payload in payloads)
+        for name, compress, decompress in codecs(train, args.dictionary_size, args.level):
+            size, compress_us, decompress_us = measure(compress, decompress, payloads)
+            print('{:>6} {:<10} {:>12.1f} {:>8.2f} {:>14.2f} {:>16.2f}'.format(
+                batch_size, name, size / float(len(payloads)), raw / float(size),
+                compress_us, decompress_us))
+
+    if args.dictionary:
+        dictionary = train_dictionary(
+            args.encoding, make_payloads(events, 1), args.dictionary_size)
+        with open(args.dictionary, 'wb') as f:
+            f.write(dictionary)
+        print('{} dictionary {:08x} of {} bytes written to {}'.format(
+            args.encoding, dictionary_id(dictionary), len(dictionary), args.dictionary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+"""
+Fleet of virtual devices speaking the UDP protocol of the gateway.
+
+Every device attaches, subscribes, sends events and detaches, as pi_device
+does, with numbered requests. The events are sent on a fixed schedule at the
+rate asked, spread over the devices in a seeded order, so that two runs
+send the same datagrams in the same order. Prints the throughput and the ack
+latencies. Run it from this folder against a running gateway:
+
+    python bench_fleet.py --devices 1000 --rate 2000 --duration 30
+
+With --device_key_file the devices attach with JWTs signed by that key, and
+--reattach_rate mixes attaches with new JWTs into the measured events, as
+devices reconnecting en masse would: the event latencies show whether the
+verification of their tokens holds the events of the other devices back.
+
+bench_gateway.py runs it against a gateway and a local broker it starts.
+"""
+
+import argparse
+import array
+import collections
+import datetime
+import json
+import math
+import random
+import select
+import socket
+import time
+
+import jwt
+
+from gateway import (FRAME_ACTIONS, FRAME_ACTION_CODES, FRAME_HEADER,
+                     FRAME_MAGIC, FRAME_SAMPLE, FRAME_SEQ, FRAME_STATUS_CODES,
+                     decode_frame)
+
+# Sequence numbers are 32 bits, and wrap around
+SEQ_MODULO = 1 << 32
+
+FRAME_STATUSES = dict((code, status) for status, code in FRAME_STATUS_CODES.items())
+
+# Readings the events are made of
+SAMPLE_POOL_SIZE = 1024
+
+EVENT_FORMATS = ('json', 'bin2')
+
+
+def sign_tokens(devices, key_file, algorithm, audience, issued_at):
+    """Returns the JWT of every device, signed with the key in key_file."""
+    with open(key_file) as f:
+        key = f.read()
+    claims = {
+        'iat': issued_at,
+        'exp': issued_at + datetime.timedelta(minutes=60),
+        'aud': audience,
+    }
+    tokens = {}
+    for device_id in devices:
+        token = jwt.encode(claims, key, algorithm=algorithm)
+        tokens[device_id] = token.decode() if isinstance(token, bytes) else token
+    return tokens
+
+
+def percentile(ordered, fraction):
+    """Returns the nearest-rank percentile of a sorted sequence."""
+    if not ordered:
+        return None
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class Fleet(object):
+    """Virtual devices, multiplexed over a few UDP sockets.
+
+    Replies are matched to requests on the device ID and sequence number they
+    echo. The latency of a request is measured from the time it was due, not
+    from the time it was sent: when the generator falls behind because the
+    gateway stalls it, the delay still shows in the tail latencies.
+    """
+
+    def __init__(self, address, device_count, socket_count, event_format,
+                 samples_per_event, timeout, seed):
+        self.address = address
+        self.event_format = event_format
+        self.samples_per_event = samples_per_event
+        self.timeout = timeout
+        self.random = random.Random(seed)
+
+        self.devices = ['bench-{:05d}'.format(i) for i in range(device_count)]
+        self.seqs = dict((device_id, self.random.getrandbits(32))
+                         for device_id in self.devices)
+        self.socks = []
+        for _ in range(min(socket_count, device_count)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self.socks.append(sock)
+        self.device_socks = dict(
+            (device_id, self.socks[i % len(self.socks)])
+            for i, device_id in enumerate(self.devices))
+        self.sample_pool = [
+            (self.random.gauss(0, 0.02), self.random.gauss(0, 0.02),
+             1.0 + self.random.gauss(0, 0.02))
+            for _ in range(SAMPLE_POOL_SIZE)]
+        self.sample_index = 0
+
+        self.tokens = {}                        # device_id: JWT to attach with
+        self.pending = {}                       # (device_id, seq): (due, record)
+        self.expiry = collections.deque()       # (due, device_id, seq)
+        self.latencies = array.array('d')
+        self.attach_latencies = array.array('d')
+        self.max_lag = 0.0
+        self.stats = collections.Counter()
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+
+    # Requests
+    def next_samples(self, timestamp):
+        samples = []
+        for _ in range(self.samples_per_event):
+            x, y, z = self.sample_pool[self.sample_index]
+            self.sample_index = (self.sample_index + 1) % SAMPLE_POOL_SIZE
+            samples.append((timestamp, x, y, z))
+        return samples
+
+    def encode(self, device_id, action, seq, timestamp):
+        if action == 'attach':
+            token = self.tokens.get(device_id)
+            return ('{{ "device" : "{}", "action":"attach", "seq" : {}, '
+                    '"formats" : ["bin2"]{} }}').format(
+                        device_id, seq,
+                        ', "jwt" : "{}"'.format(token) if token else '').encode()
+        if action != 'event':
+            return '{{ "device" : "{}", "action":"{}", "seq" : {} }}'.format(
+                device_id, action, seq).encode()
+        samples = self.next_samples(timestamp)
+        if self.event_format == 'bin2':
+            device = device_id.encode('utf8')
+            return b''.join(
+                [FRAME_HEADER.pack(FRAME_MAGIC, 2, FRAME_ACTION_CODES['event'], len(device)),
+                 device, FRAME_SEQ.pack(seq)]
+                + [FRAME_SAMPLE.pack(*sample) for sample in samples])
+        # As MakeEvent in pi_device
+        events = [
+            '{{ "device_id": "{}", "event_time": "{}", "raw_accelerometer_data": '
+            '"x={}, y={}, z={}" }}'.format(device_id, time.ctime(t), x, y, z)
+            for t, x, y, z in samples]
+        data = events[0] if len(events) == 1 else '[{}]'.format(','.join(events))
+        return '{{ "device" : "{}", "action":"event", "seq" : {}, "data" : {} }}'.format(
+            device_id, seq, data).encode()
+
+    def send(self, device_id, action, due, record):
+        seq = self.seqs[device_id]
+        self.seqs[device_id] = (seq + 1) % SEQ_MODULO
+        datagram = self.encode(device_id, action, seq, time.time())
+        try:
+            self.device_socks[device_id].sendto(datagram, self.address)
+        except BlockingIOError:
+            self.stats['send_errors'] += 1
+            return
+        self.pending[(device_id, seq)] = (due, record)
+        self.expiry.append((due, device_id, seq))
+        self.stats['sent'] += 1
+
+    # Replies
+    def on_reply(self, data, now):
+        try:
+            if data[:1] == bytes((FRAME_MAGIC,)):
+                _, device_id, seq, body = decode_frame(data)
+                action_code, status_code = body[0], body[1]
+                action = FRAME_ACTIONS.get(action_code)
+                status = FRAME_STATUSES.get(status_code)
+            else:
+                reply = json.loads(data.decode('utf8'))
+                device_id, seq = reply['device'], reply.get('seq')
+                action, status = reply['command'], reply['status']
+        except (ValueError, KeyError, IndexError):
+            # Configs and commands relayed by the gateway
+            self.stats['downlinks'] += 1
+            return
+        entry = self.pending.pop((device_id, seq), None)
+        if entry is None:
+            self.stats['unexpected'] += 1
+            return
+        due, record = entry
+        self.stats[status] += 1
+        if record and action == 'event':
+            self.latencies.append(now - due)
+        elif record and action == 'attach':
+            self.attach_latencies.append(now - due)
+
+    def receive(self, timeout):
+        """Handles the replies coming within timeout seconds."""
+        readable, _, _ = select.select(self.socks, [], [], max(timeout, 0))
+        for sock in readable:
+            while True:
+                try:
+                    data = sock.recv(4096)
+                except BlockingIOError:
+                    break
+                self.on_reply(data, time.perf_counter())
+        self.expire(time.perf_counter())
+
+    def expire(self, now):
+        deadline = now - self.timeout
+        expiry = self.expiry
+        while expiry and expiry[0][0] < deadline:
+            _, device_id, seq = expiry.popleft()
+            if self.pending.pop((device_id, seq), None) is not None:
+                self.stats['timeouts'] += 1
+
+    # Phases
+    def run(self, schedule, rate, record=False):
+        """Sends the (device_id, action) of schedule at rate per second."""
+        start = time.perf_counter()
+        for n, (device_id, action) in enumerate(schedule):
+            due = start + n / rate
+            now = time.perf_counter()
+            if now >= due and n % 64 == 0:
+                # Behind schedule, still read the replies now and then
+                self.receive(0)
+            while now < due:
+                self.receive(due - now)
+                now = time.perf_counter()
+            if record:
+                self.max_lag = max(self.max_lag, time.perf_counter() - due)
+            self.send(device_id, action, due, record)
+
+    def drain(self):
+        """Waits for the replies of the requests sent, up to the timeout."""
+        deadline = time.perf_counter() + self.timeout
+        while self.pending and time.perf_counter() < deadline:
+            self.receive(min(0.1, deadline - time.perf_counter()))
+        self.expire(float('inf'))
+
+    def control_schedule(self, action):
+        return [(device_id, action) for device_id in self.devices]
+
+    def event_schedule(self, count, reattach_every=0):
+        """Yields count events, and an attach after every reattach_every of them."""
+        order = list(self.devices)
+        self.random.shuffle(order)
+        for n in range(count):
+            yield order[n % len(order)], 'event'
+            if reattach_every and n % reattach_every == reattach_every - 1:
+                yield order[(n // reattach_every) % len(order)], 'attach'
+
+    def results(self, elapsed):
+        ordered = sorted(self.latencies)
+        results = dict(self.stats)
+        attaches = sorted(self.attach_latencies)
+        results.update({
+            'events_acked': len(ordered),
+            'throughput': len(ordered) / elapsed if elapsed else 0.0,
+            'max_lag_ms': self.max_lag * 1000,
+            'attaches_acked': len(attaches),
+            'attach_latency_p99_ms': (
+                None if not attaches else percentile(attaches, 0.99) * 1000),
+        })
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                               ('p999', 0.999), ('max', 1.0)):
+            value = percentile(ordered, fraction)
+            results['latency_{}_ms'.format(name)] = (
+                None if value is None else value * 1000)
+        return results
+
+
+def run_fleet(fleet, args, on_phase=None):
+    """Runs the phases of a benchmark, returns the results of the measured one.
+
+    on_phase(name) is called when each phase starts, and with 'done' at the
+    end, e.g. to sample the gateway."""
+    def phase(name):
+        if on_phase is not None:
+            on_phase(name)
+
+    now = datetime.datetime.utcnow()
+    if args.device_key_file:
+        fleet.tokens = sign_tokens(
+            fleet.devices, args.device_key_file, args.device_algorithm,
+            args.audience, now - datetime.timedelta(minutes=1))
+    phase('attach')
+    fleet.run(fleet.control_schedule('attach'), args.control_rate)
+    fleet.drain()
+    phase('subscribe')
+    fleet.run(fleet.control_schedule('subscribe'), args.control_rate)
+    fleet.drain()
+    phase('warmup')
+    fleet.run(fleet.event_schedule(int(args.warmup * args.rate)), args.rate)
+    fleet.drain()
+
+    control = dict(fleet.stats)
+    fleet.stats.clear()
+    reattach_every = 0
+    if args.reattach_rate:
+        reattach_every = max(int(args.rate / args.reattach_rate), 1)
+        if args.device_key_file:
+            # New tokens, which the gateway has not verified yet
+            fleet.tokens = sign_tokens(
+                fleet.devices, args.device_key_file, args.device_algorithm,
+                args.audience, now)
+    phase('measure')
+    start = time.perf_counter()
+    fleet.run(fleet.event_schedule(int(args.duration * args.rate), reattach_every),
+              args.rate + (args.rate / reattach_every if reattach_every else 0),
+              record=True)
+    fleet.drain()
+    elapsed = time.perf_counter() - start
+    phase('detach')
+    results = fleet.results(elapsed)
+    results['elapsed'] = elapsed
+    results['setup'] = control
+
+    fleet.stats.clear()
+    fleet.run(fleet.control_schedule('detach'), args.control_rate)
+    fleet.drain()
+    phase('done')
+    return results
+
+
+def add_fleet_arguments(parser):
+    parser.add_argument(
+        '--devices', default=1000, type=int, help='Number of virtual devices.')
+    parser.add_argument(
+        '--sockets', default=64, type=int,
+        help='Number of UDP sockets the devices are spread over.')
+    parser.add_argument(
+        '--format', choices=EVENT_FORMATS, default='json',
+        help='Format of the events: JSON, or numbered binary frames.')
+    parser.add_argument(
+        '--samples', default=1, type=int,
+        help='Number of accelerometer samples per event.')
+    parser.add_argument(
+        '--rate', default=1000, type=float,
+        help='Events per second, over the whole fleet.')
+    parser.add_argument(
+        '--control_rate', default=500, type=float,
+        help='Attach, subscribe and detach requests per second.')
+    parser.add_argument(
+        '--warmup', default=5, type=float,
+        help='Seconds of events sent before measuring.')
+    parser.add_argument(
+        '--duration', default=30, type=float, help='Seconds of events measured.')
+    parser.add_argument(
+        '--timeout', default=5, type=float,
+        help='Seconds after which a request without reply counts as lost.')
+    parser.add_argument(
+        '--seed', default=1, type=int,
+        help='Seed of the device sequence numbers, event order and readings.')
+    parser.add_argument(
+        '--reattach_rate', default=0, type=float,
+        help='Attaches per second mixed into the measured events.')
+    parser.add_argument(
+        '--device_key_file',
+        help='Private key the devices sign the JWTs they attach with.')
+    parser.add_argument(
+        '--device_algorithm', choices=('RS256', 'ES256'), default='RS256',
+        help='Algorithm of --device_key_file.')
+    parser.add_argument(
+        '--audience', default='bench',
+        help='Audience of the JWTs of the devices: the project ID of the gateway.')
+
+
+def print_results(results):
+    print('events acked {events_acked} in {elapsed:.1f}s: {throughput:.0f}/s'.format(
+        **results))
+    print('ack latency ms: p50 {} p90 {} p99 {} p999 {} max {}'.format(*[
+        'n/a' if results[key] is None else '{:.2f}'.format(results[key])
+        for key in ('latency_p50_ms', 'latency_p90_ms', 'latency_p99_ms',
+                    'latency_p999_ms', 'latency_max_ms')]))
+    print('sent {} busy {} error {} timeouts {} unexpected {}, max lag {:.1f} ms'.format(
+        results.get('sent', 0), results.get('busy', 0), results.get('error', 0),
+        results.get('timeouts', 0), results.get('unexpected', 0),
+        results['max_lag_ms']))
+    if results['attaches_acked']:
+        print('attaches acked {} while measuring, latency ms: p99 {:.2f}'.format(
+            results['attaches_acked'], results['attach_latency_p99_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--gateway_host', default='127.0.0.1', help='Gateway address.')
+    parser.add_argument('--gateway_port', default=10000, type=int, help='Gateway port.')
+    parser.add_argument('--output', help='File to write the results to, as JSON.')
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+
+    fleet = Fleet((args.gateway_host, args.gateway_port), args.devices,
+                  args.sockets, args.format, args.samples, args.timeout, args.seed)
+    try:
+        results = run_fleet(fleet, args)
+    finally:
+        fleet.close()
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,373 @@
+"""
+End-to-end benchmark of the gateway, against a fleet of virtual devices.
+
+Starts bench_broker.py as a local stand-in of the MQTT bridge, then
+gateway.py connected to it without TLS, then runs bench_fleet.py against the
+gateway. Reports the throughput, the ack latencies seen by the devices, the
+CPU time of the gateway per event, and its memory over time, sampled from
+/proc (Linux). Run it from this folder:
+
+    python bench_gateway.py --devices 2000 --rate 3000 --output run.json
+
+Runs are seeded, and --repeat reports the median of several runs. Compare
+with an earlier run to track regressions of the gateway hot path:
+
+    python bench_gateway.py --baseline run.json
+
+--device_auth makes the gateway verify the JWTs the devices attach with, e.g.
+during a storm of re-attaches:
+
+    python bench_gateway.py --device_auth --reattach_rate 500
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+import bench_fleet
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# How long the gateway gets to connect to the broker, in seconds
+STARTUP_TIMEOUT = 15
+
+# Metrics compared with the baseline, and whether higher is better
+COMPARED_METRICS = (
+    ('throughput', True),
+    ('latency_p50_ms', False),
+    ('latency_p99_ms', False),
+    ('latency_p999_ms', False),
+    ('cpu_us_per_event', False),
+    ('max_rss_kb', False),
+)
+
+
+def free_port(kind):
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_private_key(path, algorithm='RS256', public_path=None):
+    """Writes an RSA or EC key to sign JWTs with, and its public key."""
+    if algorithm == 'ES256':
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    else:
+        key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+    with open(path, 'wb') as f:
+        f.write(key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()))
+    if public_path:
+        with open(public_path, 'wb') as f:
+            f.write(key.public_key().public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo))
+
+
+# [START process_monitor]
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def process_tree(pid):
+    """Returns pid and the pids of its descendants, e.g. the gateway workers."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open('/proc/{0}/task/{0}/children'.format(parent)) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except (IOError, OSError):
+            pass
+    return pids
+
+
+def process_usage(pid):
+    """Returns the (cpu seconds, rss kB) of pid and its descendants."""
+    cpu = 0.0
+    rss = 0
+    for member in process_tree(pid):
+        try:
+            with open('/proc/{}/stat'.format(member)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/{}/status'.format(member)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+                        break
+        except (IOError, OSError):
+            continue
+        # utime and stime, the 14th and 15th fields of stat
+        cpu += (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    return cpu, rss
+
+
+class ProcessMonitor(object):
+    """Samples the CPU time and memory of a process tree, in a thread."""
+
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []   # (time, phase, cpu seconds, rss kB)
+        self.phase = 'startup'
+        self.marks = {}     # phase: cpu seconds when it started
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def sample(self):
+        cpu, rss = process_usage(self.pid)
+        self.samples.append((time.time(), self.phase, cpu, rss))
+        return cpu
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def mark(self, phase):
+        self.phase = phase
+        self.marks[phase] = self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+# [END process_monitor]
+
+
+class Broker(object):
+    """bench_broker.py in a subprocess, and its latest counters."""
+
+    def __init__(self, port, puback_delay_ms):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'bench_broker.py'),
+             '--port', str(port), '--puback_delay_ms', str(puback_delay_ms),
+             '--report_interval', '0.2'],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.counters = {}
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.counters = json.loads(line)
+
+    def stop(self):
+        """Stops the broker, returns its final counters."""
+        self.process.terminate()
+        self.process.wait()
+        self.thread.join()
+        return self.counters
+
+
+def start_gateway(args, workdir, broker_port, gateway_port, metrics_port):
+    key_file = os.path.join(workdir, 'rsa_private.pem')
+    if not os.path.exists(key_file):
+        write_private_key(key_file)
+    command = [
+        sys.executable, os.path.join(HERE, 'gateway.py'),
+        '--project_id', 'bench', '--registry_id', 'bench', '--gateway_id', 'bench',
+        '--private_key_file', key_file, '--algorithm', 'RS256',
+        '--no_tls', '--mqtt_bridge_hostname', '127.0.0.1',
+        '--mqtt_bridge_port', str(broker_port),
+        '--host', '127.0.0.1', '--port', str(gateway_port),
+        '--workers', str(args.workers), '--metrics_port', str(metrics_port),
+    ]
+    if args.device_auth:
+        # One key pair for the whole fleet
+        public_file = os.path.join(workdir, 'device_public.pem')
+        args.device_key_file = os.path.join(workdir, 'device_private.pem')
+        write_private_key(args.device_key_file, args.device_algorithm, public_file)
+        command += ['--device_public_keys', public_file]
+    command += shlex.split(args.gateway_args)
+    log = open(os.path.join(workdir, 'gateway.log'), 'w')
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def save_metrics(port, workers, workdir):
+    """Saves the metrics of every gateway worker in the workdir."""
+    for worker in range(workers):
+        url = 'http://127.0.0.1:{}/metrics'.format(port + worker)
+        try:
+            text = urllib.request.urlopen(url, timeout=5).read()
+        except (IOError, OSError) as e:
+            print('Could not read the metrics at {}: {}'.format(url, e))
+            continue
+        with open(os.path.join(workdir, 'metrics-{}.txt'.format(worker)), 'wb') as f:
+            f.write(text)
+
+
+def wait_connected(broker, gateway, workers):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if gateway.poll() is not None:
+            raise RuntimeError('The gateway exited with status {}'.format(gateway.returncode))
+        # Every worker subscribes to its config and commands topics
+        if (broker.counters.get('connected', 0) >= workers
+                and broker.counters.get('subscribes', 0) >= 2 * workers):
+            return
+        time.sleep(0.1)
+    raise RuntimeError('The gateway did not connect to the broker')
+
+
+def run_once(args, workdir):
+    """Runs the benchmark once, returns its results."""
+    broker_port = free_port(socket.SOCK_STREAM)
+    gateway_port = free_port(socket.SOCK_DGRAM)
+    metrics_port = free_port(socket.SOCK_STREAM)
+    broker = Broker(broker_port, args.puback_delay_ms)
+    gateway = None
+    monitor = None
+    try:
+        gateway = start_gateway(args, workdir, broker_port, gateway_port, metrics_port)
+        wait_connected(broker, gateway, args.workers)
+        monitor = ProcessMonitor(gateway.pid, args.sample_interval)
+        monitor.start()
+
+        fleet = bench_fleet.Fleet(
+            ('127.0.0.1', gateway_port), args.devices, args.sockets,
+            args.format, args.samples, args.timeout, args.seed)
+        try:
+            results = bench_fleet.run_fleet(fleet, args, monitor.mark)
+        finally:
+            fleet.close()
+        monitor.stop()
+        save_metrics(metrics_port, args.workers, workdir)
+    finally:
+        if gateway is not None:
+            gateway.terminate()
+            gateway.wait()
+        counters = broker.stop()
+
+    cpu = monitor.marks['detach'] - monitor.marks['measure']
+    results['gateway_cpu_s'] = cpu
+    results['cpu_us_per_event'] = (
+        cpu / results['events_acked'] * 1e6 if results['events_acked'] else None)
+    results['max_rss_kb'] = max(rss for _, _, _, rss in monitor.samples)
+    # Warmup included, several events per publish when the gateway batches
+    results['events_sent'] = int(args.warmup * args.rate) + int(args.duration * args.rate)
+    results['event_publishes'] = counters.get('kinds', {}).get('events', 0)
+    results['broker'] = counters
+    results['timeline'] = [
+        {'time': t, 'phase': phase, 'cpu_s': cpu, 'rss_kb': rss}
+        for t, phase, cpu, rss in monitor.samples]
+    return results
+
+
+def median_results(runs):
+    """Returns the median of the compared metrics over runs."""
+    median = {}
+    for metric, _ in COMPARED_METRICS:
+        values = [run[metric] for run in runs if run.get(metric) is not None]
+        median[metric] = statistics.median(values) if values else None
+    return median
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE, stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'revision': revision,
+    }
+
+
+def compare(baseline, current, tolerance):
+    """Prints the change of every metric, returns False on a regression."""
+    ok = True
+    print('{:<18} {:>12} {:>12} {:>9}'.format('metric', 'baseline', 'current', 'change'))
+    for metric, higher_is_better in COMPARED_METRICS:
+        before, after = baseline.get(metric), current.get(metric)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        ok = ok and not regressed
+        print('{:<18} {:>12.2f} {:>12.2f} {:>+8.1%}{}'.format(
+            metric, before, after, change, '  REGRESSION' if regressed else ''))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    bench_fleet.add_fleet_arguments(parser)
+    parser.add_argument(
+        '--workers', default=1, type=int, help='Number of gateway workers.')
+    parser.add_argument(
+        '--gateway_args', default='',
+        help='More arguments for gateway.py, e.g. "--batch_max_events 20".')
+    parser.add_argument(
+        '--device_auth', action='store_true',
+        help='Make the gateway verify the JWTs of the devices, signed with a new key.')
+    parser.add_argument(
+        '--puback_delay_ms', default=0, type=float,
+        help='Delay of the PUBACKs of the broker.')
+    parser.add_argument(
+        '--sample_interval', default=0.5, type=float,
+        help='Interval, in seconds, between two samples of the gateway CPU and memory.')
+    parser.add_argument(
+        '--repeat', default=1, type=int,
+        help='Number of runs, the medians of which are reported.')
+    parser.add_argument('--output', help='File to write the results to, as JSON.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with.')
+    parser.add_argument(
+        '--tolerance', default=0.1, type=float,
+        help='Relative change of a metric counted as a regression.')
+    parser.add_argument(
+        '--workdir', help='Folder for the gateway key and log. Default: a temporary one.')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_gateway.')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    runs = []
+    for run in range(args.repeat):
+        results = run_once(args, workdir)
+        runs.append(results)
+        print('Run {}/{}:'.format(run + 1, args.repeat))
+        bench_fleet.print_results(results)
+        print('gateway cpu {:.1f} us/event, max rss {} kB, {} publishes for {} events'.format(
+            results['cpu_us_per_event'] or 0, results['max_rss_kb'],
+            results['event_publishes'], results['events_sent']))
+    summary = median_results(runs)
+    print('Gateway log and metrics in {}'.format(workdir))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'environment': environment(),
+                       'summary': summary, 'runs': runs}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['summary']
+        if not compare(baseline, summary, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
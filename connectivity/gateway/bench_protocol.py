@@ -0,0 +1,99 @@
+"""
+Compares the cost per message of the JSON and binary device protocols.
+
+For each format, measures the time to encode an accelerometer event the way
+pi_device does, the time for the gateway to decode it into the payload it
+publishes, and the size of the datagram. Run it from this folder:
+
+    python bench_protocol.py --samples 1 --samples 10
+"""
+
+import argparse
+import json
+import time
+import timeit
+
+from gateway import (FRAME_HEADER, FRAME_MAGIC, FRAME_SAMPLE, FRAME_SEQ,
+                     FRAME_VERSION, FRAME_ACTION_CODES, decode_frame, decode_samples,
+                     samples_to_json)
+
+
+DEVICE_ID = 'my-device'
+
+
+def make_samples(count):
+    now = time.time()
+    return [(now + i * 0.01, -1.0, 0.0, 1.0) for i in range(count)]
+
+
+# Encoders, as in pi_device.py
+def encode_json(samples):
+    events = ['{{ "device_id": "{}", "event_time": "{}", "raw_accelerometer_data": '
+              '"x={}, y={}, z={}" }}'.format(DEVICE_ID, time.ctime(t), x, y, z)
+              for t, x, y, z in samples]
+    data = events[0] if len(events) == 1 else '[{}]'.format(','.join(events))
+    return '{{ "device" : "{}", "action":"{}", "data" : {} }}'.format(
+        DEVICE_ID, 'event', data).encode()
+
+
+def encode_binary(samples):
+    device = DEVICE_ID.encode('utf8')
+    return b''.join(
+        [FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, FRAME_ACTION_CODES['event'], len(device)),
+         device, FRAME_SEQ.pack(0)] + [FRAME_SAMPLE.pack(*sample) for sample in samples])
+
+
+# Decoders, as in gateway.py
+def decode_json(data):
+    command = json.loads(data.decode('utf-8'))
+    return "{}".format(json.dumps(command["data"]))
+
+
+def decode_binary_forward(data):
+    action, device_id, seq, body = decode_frame(data)
+    decode_samples(body)
+    return data
+
+
+def decode_binary_json(data):
+    action, device_id, seq, body = decode_frame(data)
+    return samples_to_json(device_id, decode_samples(body))
+
+
+def measure(fn, arg, number):
+    """Returns the best time per call, in microseconds."""
+    timer = timeit.Timer(lambda: fn(arg))
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--samples', action='append', type=int,
+        help='Number of samples per message, may be repeated. Default: 1 and 10.')
+    parser.add_argument(
+        '--number', default=20000, type=int,
+        help='Number of calls per measure.')
+    args = parser.parse_args()
+
+    print('{:>8} {:<16} {:>8} {:>12} {:>12} {:>12}'.format(
+        'samples', 'format', 'bytes', 'encode us', 'decode us', 'us/sample'))
+    for count in args.samples or [1, 10]:
+        samples = make_samples(count)
+        json_data = encode_json(samples)
+        binary_data = encode_binary(samples)
+        rows = [
+            ('json', encode_json, decode_json, json_data),
+            ('binary/forward', encode_binary, decode_binary_forward, binary_data),
+            ('binary/json', encode_binary, decode_binary_json, binary_data),
+        ]
+        for name, encode, decode, data in rows:
+            encode_us = measure(encode, samples, args.number)
+            decode_us = measure(decode, data, args.number)
+            print('{:>8} {:<16} {:>8} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                count, name, len(data), encode_us, decode_us,
+                (encode_us + decode_us) / count))
+
+
+if __name__ == '__main__':
+    main()
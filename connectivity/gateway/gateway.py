@@ -1,15 +1,36 @@
 # [START my_gateway]
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import fnmatch
+import heapq
+import itertools
 import logging
+import mmap
 import os
+import random
+import selectors
+import signal
 import ssl
+import struct
 import sys
+import threading
 import time
 import json
+import zlib
 
 import jwt
 import paho.mqtt.client as mqtt
+try:
+    import zstandard
+except ImportError:  # Only needed by --compress zstd
+    zstandard = None
+from cryptography.hazmat.backends import default_backend
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
 
 # create logger
 logger = logging.getLogger(__name__)
@@ -32,9 +53,9 @@ logger.addHandler(ch)
 
 
 # The initial backoff time after a disconnection occurs, in seconds.
-minimum_backoff_time = 1
+MINIMUM_BACKOFF_TIME = 1
 
-# The maximum backoff time before giving up, in seconds.
+# The maximum backoff time between two reconnection attempts, in seconds.
 MAXIMUM_BACKOFF_TIME = 32
 
 
@@ -43,11 +64,131 @@ import socket
 HOST = ''
 PORT = 10000
 BUFSIZE = 2048
-ADDR = (HOST, PORT)
 
-udpSerSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udpSerSock.setblocking(False)
-udpSerSock.bind(ADDR)
+# Kernel receive buffer of the UDP socket, room for bursts between wakeups.
+UDP_RCVBUF = 4 * 1024 * 1024
+
+# The UDP socket facing the devices, bound by main()
+udpSerSock = None
+
+
+def create_udp_socket(addr, reuse_port=False):
+    """Create the non-blocking UDP socket the devices talk to.
+
+    With reuse_port, several gateway workers bind the same address and the
+    kernel spreads the datagrams among them."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.setblocking(False)
+    sock.bind(addr)
+    return sock
+
+
+# [START topic_index]
+class TopicIndex(object):
+    """Maps MQTT topic filters to the address of the device subscribed to them.
+
+    Filters are stored in a trie over their topic levels, so routing a topic
+    walks one node per level (plus the '+' and '#' wildcard branches) whatever
+    the number of attached devices. Each filter counts the messages it
+    matched.
+    """
+
+    class Node(object):
+        __slots__ = ('children', 'topic_filter', 'value', 'hits')
+
+        def __init__(self):
+            self.children = {}
+            self.topic_filter = None
+            self.value = None
+            self.hits = 0
+
+    def __init__(self):
+        self.root = self.Node()
+        self.count = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self.count
+
+    def __setitem__(self, topic_filter, value):
+        node = self.root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = self.Node()
+            node = child
+        if node.topic_filter is None:
+            self.count += 1
+        node.topic_filter = topic_filter
+        node.value = value
+
+    def __delitem__(self, topic_filter):
+        path = [self.root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                raise KeyError(topic_filter)
+            path.append(node)
+        if path[-1].topic_filter is None:
+            raise KeyError(topic_filter)
+        path[-1].topic_filter = None
+        path[-1].value = None
+        self.count -= 1
+        # Prune the branches left empty
+        for level, parent, node in reversed(list(zip(levels, path, path[1:]))):
+            if node.children or node.topic_filter is not None:
+                break
+            del parent.children[level]
+
+    def match(self, topic):
+        """Returns the values of the filters matching topic, counting hits."""
+        nodes = []
+        levels = topic.split('/')
+        # Wildcards do not match topics starting with '$' (MQTT-4.7.2-1)
+        self.collect(self.root, levels, 0, not topic.startswith('$'), nodes)
+        if not nodes:
+            self.misses += 1
+        for node in nodes:
+            node.hits += 1
+        return [node.value for node in nodes]
+
+    def collect(self, node, levels, depth, wildcards, nodes):
+        if wildcards:
+            # 'a/#' matches 'a' as well as everything below it
+            multi = node.children.get('#')
+            if multi is not None and multi.topic_filter is not None:
+                nodes.append(multi)
+        if depth == len(levels):
+            if node.topic_filter is not None:
+                nodes.append(node)
+            return
+        child = node.children.get(levels[depth])
+        if child is not None:
+            self.collect(child, levels, depth + 1, True, nodes)
+        if wildcards:
+            single = node.children.get('+')
+            if single is not None:
+                self.collect(single, levels, depth + 1, True, nodes)
+
+    def items(self):
+        """Yields the (topic_filter, value, hits) of every filter."""
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.topic_filter is not None:
+                yield node.topic_filter, node.value, node.hits
+            stack.extend(node.children.values())
+
+    def stats_str(self, top=5):
+        busiest = sorted(self.items(), key=lambda item: -item[2])[:top]
+        return 'filters {}, unmatched messages {}, busiest {}'.format(
+            self.count, self.misses,
+            ', '.join('{}: {}'.format(f, hits) for f, _, hits in busiest))
+# [END topic_index]
 
 
 class GatewayState:
@@ -61,15 +202,379 @@ class GatewayState:
     # SUBSCRIBE messages waiting for SUBACK. The key is 'mid' from Paho.
     pending_subscribes = {}
 
-    # for all SUBSCRIPTIONS. The key is subscription topic.
-    subscriptions = {}
+    # for all SUBSCRIPTIONS. The key is the subscription topic filter, the
+    # value the address of the subscribed device.
+    subscriptions = TopicIndex()
+
+    # Topics the gateway subscribed to, to subscribe again on a new
+    # connection. The key is the topic, the value its QoS.
+    subscribed_topics = {}
 
     # Indicates if MQTT client is connected or not
     connected = False
 
+    # OutboundQueue of the device events waiting to be published
+    outbound = None
+
+    # Optional Spool storing device events while they cannot be published
+    spool = None
+
+    # WorkerRouter of this worker, when several gateway workers run
+    worker = None
+
+    # What to publish for binary events: 'json' or the 'forward'ed frame
+    binary_events = 'json'
+
+    # ReconnectScheduler bringing the MQTT client back after a disconnect
+    reconnector = None
+
+    # TokenManager minting the JWTs of the gateway
+    token_manager = None
+
+    # ClientHandover moving the gateway to a connection with a fresh JWT
+    handover = None
+
+    # Device commands (fn, args) received while disconnected, they are run as
+    # fn(client, *args) once connected.
+    pending_control = collections.deque()
+
+    # The MQTT client currently used to talk to the bridge
+    client = None
+
+    # The EventLoop driving the UDP and MQTT sockets
+    event_loop = None
+
+    # Optional EventBatcher aggregating device events before publishing
+    batcher = None
+
+    # DuplicateFilter of the numbered requests of the devices
+    duplicates = None
+
+    # Optional DeviceAuthenticator verifying the JWTs devices attach with
+    authenticator = None
+
+    # DownlinkRelay caching the configs of the devices, and pacing the
+    # datagrams relayed to them
+    downlinks = None
+
+    # Optional PayloadCompressor of the events published
+    compressor = None
+
+    # Optional EdgeAggregator publishing statistics of the readings instead
+    # of the readings
+    aggregator = None
+
 gateway_state = GatewayState()
 
 
+# [START metrics]
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    """Counter in the Prometheus text format, with optional labels.
+
+    Either incremented with inc(), or read at scrape time from collect(),
+    which returns (label values, value) pairs, e.g. from the stats dict of
+    a component.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        values = self.collect() if self.collect is not None else self.values.items()
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    """Gauge in the Prometheus text format, set() or read from collect()."""
+
+    kind = 'gauge'
+
+    def set(self, value, label_values=()):
+        self.values[label_values] = value
+
+
+class Histogram(object):
+    """Histogram in the Prometheus text format, with optional labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}    # label values: [count per bucket..., sum]
+
+    def observe(self, value, label_values=()):
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * len(self.buckets) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield (self.name + '_bucket',
+                       format_labels(self.labels + ('le',),
+                                     label_values + (format_value(bound),)),
+                       total)
+            labels = format_labels(self.labels, label_values)
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+class GatewayMetrics(object):
+    """Metrics of the gateway, served by MetricsServer.
+
+    The hot path only increments dict entries. Queue depths and the counters
+    the components keep anyway are read when the metrics are scraped.
+    """
+
+    # Bounds, in seconds, of the buckets of the publish latency histogram
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.metrics = []
+        self.datagrams_received = self.add(Counter(
+            'gateway_udp_datagrams_received_total',
+            'Datagrams received from the devices.', ('format',)))
+        self.bytes_received = self.add(Counter(
+            'gateway_udp_received_bytes_total',
+            'Bytes received from the devices.'))
+        self.datagrams_sent = self.add(Counter(
+            'gateway_udp_datagrams_sent_total',
+            'Datagrams sent to the devices, replies or relayed messages.', ('kind',)))
+        self.invalid_datagrams = self.add(Counter(
+            'gateway_udp_invalid_datagrams_total',
+            'Datagrams which are neither valid JSON commands nor valid frames.'))
+        self.requests = self.add(Counter(
+            'gateway_device_requests_total',
+            'Device requests, by action and status of the reply.',
+            ('action', 'status')))
+        self.device_events = self.add(Counter(
+            'gateway_device_events_total',
+            'Events received, per device.', ('device',)))
+        self.publish_latency = self.add(Histogram(
+            'gateway_mqtt_publish_latency_seconds',
+            'Time from the publish of an event to its PUBACK, or to the '
+            'socket write with QoS 0.', self.LATENCY_BUCKETS, ('qos',)))
+        # Devices beyond this number are counted together as 'other'
+        self.max_devices = 1000
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def count_event(self, device_id):
+        device_events = self.device_events
+        key = (device_id,)
+        if key not in device_events.values and len(device_events.values) >= self.max_devices:
+            key = ('other',)
+        device_events.inc(key)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = GatewayMetrics()
+
+
+def add_component_metrics():
+    """Adds the metrics read from the components of the gateway."""
+    state = gateway_state
+
+    def stats(component, *keys):
+        if component is None:
+            return []
+        return [((key,), component.stats[key]) for key in keys]
+
+    def queue_depths():
+        depths = [(('pending_control',), len(state.pending_control))]
+        if state.outbound is not None:
+            depths.append((('outbound',), len(state.outbound.queue)))
+            depths.append((('inflight',), len(state.outbound.inflight)))
+        if state.spool is not None:
+            depths.append((('spool',), state.spool.backlog))
+        if state.batcher is not None:
+            depths.append((('batch',), sum(
+                len(buf.events) for buf in state.batcher.buffers.values())))
+        if state.downlinks is not None:
+            depths.append((('downlink',), len(state.downlinks.queue)))
+        if state.authenticator is not None:
+            depths.append((('device_auth',), len(state.authenticator.pending)))
+        return depths
+
+    metrics.add(Gauge(
+        'gateway_mqtt_connected', 'Whether the MQTT client is connected.',
+        collect=lambda: [((), int(state.connected))]))
+    metrics.add(Gauge(
+        'gateway_queue_depth', 'Events waiting, by queue.', ('queue',),
+        collect=queue_depths))
+    metrics.add(Counter(
+        'gateway_outbound_events_total',
+        'Events of the outbound queue, by outcome.', ('outcome',),
+        collect=lambda: stats(state.outbound, 'published', 'completed',
+                              'dropped_oldest', 'dropped_newest', 'nacked')))
+    metrics.add(Counter(
+        'gateway_mqtt_reconnects_total', 'Reconnection attempts, and failures.',
+        ('result',),
+        collect=lambda: [] if state.reconnector is None else [
+            (('attempt',), state.reconnector.attempts),
+            (('failure',), state.reconnector.failures)]))
+    metrics.add(Counter(
+        'gateway_jwt_refreshes_total', 'JWTs minted for a connection.',
+        collect=lambda: [] if state.token_manager is None else [
+            ((), state.token_manager.refreshes)]))
+    metrics.add(Counter(
+        'gateway_handovers_total', 'Connection handovers, by result.', ('result',),
+        collect=lambda: [] if state.handover is None else [
+            (('complete',), state.handover.handovers),
+            (('failure',), state.handover.failures)]))
+    metrics.add(Counter(
+        'gateway_worker_datagrams_total',
+        'Datagrams forwarded between the gateway workers.', ('direction',),
+        collect=lambda: stats(state.worker, 'forwarded', 'received', 'dropped')))
+    metrics.add(Counter(
+        'gateway_downlinks_total',
+        'Configs and commands for the devices, by outcome.', ('outcome',),
+        collect=lambda: stats(state.downlinks, 'configs', 'unchanged', 'superseded',
+                              'served', 'commands', 'sent', 'dropped')))
+    metrics.add(Counter(
+        'gateway_compression_bytes_total',
+        'Bytes of the event payloads, before and after compression.', ('stage',),
+        collect=lambda: [] if state.compressor is None else [
+            (('in',), state.compressor.stats['bytes_in']),
+            (('out',), state.compressor.stats['bytes_out'])]))
+    metrics.add(Counter(
+        'gateway_aggregation_total',
+        'Readings aggregated, and events published by the edge aggregation.',
+        ('kind',),
+        collect=lambda: stats(state.aggregator, 'readings', 'published',
+                              'incidents', 'summaries')))
+    metrics.add(Counter(
+        'gateway_device_auth_total',
+        'Device JWTs checked on attach, by outcome.', ('outcome',),
+        collect=lambda: stats(state.authenticator, 'hits', 'misses', 'coalesced',
+                              'verified', 'rejected', 'busy', 'evicted')))
+
+
+class MetricsServer(object):
+    """Serves the metrics over HTTP, in the Prometheus text format.
+
+    Scrapes are rare and small: they are answered on the event loop, with
+    blocking reads and writes bounded by SCRAPE_TIMEOUT.
+    """
+
+    SCRAPE_TIMEOUT = 1.0
+
+    def __init__(self, event_loop, address):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        event_loop.add_reader(self.sock, self.on_accept)
+        logger.info('Serving metrics on http://{}:{}/metrics'.format(*address))
+
+    def on_accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        try:
+            conn.settimeout(self.SCRAPE_TIMEOUT)
+            request = b''
+            while b'\r\n\r\n' not in request and len(request) < 8192:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                request += data
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] in (b'/', b'/metrics'):
+                status, body = '200 OK', metrics.render().encode('utf8')
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            conn.sendall(
+                'HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: {}\r\n\r\n'.format(status, len(body)).encode('utf8')
+                + body)
+        except socket.error as e:
+            logger.debug('Metrics scrape failed: {}'.format(e))
+        finally:
+            conn.close()
+
+
+class SampledLogger(object):
+    """Per-message logs of the hot path, at most one every `interval` seconds.
+
+    The message is only formatted when it is logged, and tells how many were
+    skipped since the previous one. An interval of 0 logs every message.
+    """
+
+    interval = 1.0
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.last = None
+        self.skipped = 0
+
+    def info(self, message, *args):
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            self.skipped += 1
+            return
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        message = message.format(*args)
+        if self.skipped:
+            message += ' ({} similar messages skipped)'.format(self.skipped)
+        self.logger.info(message)
+        self.last = now
+        self.skipped = 0
+
+
+datagram_log = SampledLogger(logger)
+publish_log = SampledLogger(logger)
+auth_log = SampledLogger(logger)
+downlink_log = SampledLogger(logger)
+# [END metrics]
+
+
 # [START iot_mqtt_jwt]
 def create_jwt(project_id, private_key_file, algorithm, jwt_expires_minutes):
     """Creates a JWT (https://jwt.io) to establish an MQTT connection.
@@ -106,6 +611,217 @@ def create_jwt(project_id, private_key_file, algorithm, jwt_expires_minutes):
     return jwt.encode(token, private_key, algorithm=algorithm)
 # [END iot_mqtt_jwt]
 
+# [START token_manager]
+class TokenManager(object):
+    """Mints the JWTs of the gateway from a private key parsed only once.
+
+    prepare() mints the next token ahead of time, so that a connection
+    handover does not wait on reading the key file and signing.
+    """
+
+    def __init__(self, project_id, private_key_file, algorithm, jwt_expires_minutes):
+        self.project_id = project_id
+        self.algorithm = algorithm
+        self.lifetime = datetime.timedelta(minutes=jwt_expires_minutes)
+
+        # Read and parse the private key file.
+        with open(private_key_file, 'rb') as f:
+            self.private_key = serialization.load_pem_private_key(
+                f.read(), password=None, backend=default_backend())
+        logger.info('Creating JWTs using {} from private key file {}'.format(
+                algorithm, private_key_file))
+
+        self.next_token = None
+        self.refreshes = 0
+
+    def mint(self):
+        now = datetime.datetime.utcnow()
+        token = {
+                'iat': now,
+                'exp': now + self.lifetime,
+                'aud': self.project_id
+        }
+        return jwt.encode(token, self.private_key, algorithm=self.algorithm)
+
+    def prepare(self):
+        """Mints the token returned by the next call to take()."""
+        self.next_token = self.mint()
+
+    def take(self):
+        """Returns a fresh token, the prepared one if any."""
+        token = self.next_token or self.mint()
+        self.next_token = None
+        self.refreshes += 1
+        return token
+# [END token_manager]
+
+# [START device_auth]
+# Clock skew tolerated between the devices and the gateway, in seconds
+DEVICE_JWT_LEEWAY = 60
+
+
+def load_public_key(data):
+    """Returns the public key of a PEM public key or X.509 certificate."""
+    if b'-----BEGIN CERTIFICATE-----' in data:
+        return x509.load_pem_x509_certificate(data, default_backend()).public_key()
+    return serialization.load_pem_public_key(data, backend=default_backend())
+
+
+class DeviceAuthenticator(object):
+    """Verifies the JWTs devices attach with, against their public keys.
+
+    Public keys are parsed once per version of their file. Verified tokens are
+    kept until they expire, up to cache_size of them in LRU order, so that a
+    device attaching again with the same token is accepted at once. Tokens not
+    seen yet are verified on a pool of threads, and their result is handed back
+    to the event loop through a socket pair: a re-attach storm does not stall
+    the events of the other devices. The same token sent again while it is
+    verified waits for that verification, and attaches beyond max_pending
+    verifications are answered 'busy' so that devices retry later.
+    """
+
+    def __init__(self, event_loop, key_path, audience, algorithms, cache_size,
+                 workers, max_pending):
+        self.key_path = key_path        # Path of the key of a {device_id}
+        self.audience = audience
+        self.algorithms = algorithms
+        self.cache_size = cache_size
+        self.max_pending = max_pending
+
+        # The key is the device ID, the value (file mtime, public key)
+        self.keys = {}
+        self.keys_lock = threading.Lock()
+
+        # The key is (device ID, token), the value the expiry of the token
+        self.tokens = collections.OrderedDict()
+
+        # Callbacks of the verifications running, by (device ID, token)
+        self.pending = {}
+        # (device ID, token, future) of the verifications done, filled by the
+        # worker threads
+        self.done = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='device-auth')
+
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        event_loop.add_reader(self.wakeup_receiver, self.on_wakeup)
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'verified': 0,
+            'rejected': 0,
+            'busy': 0,
+            'evicted': 0,
+        }
+
+    def verify(self, device_id, token, callback):
+        """Calls callback(status) once the token of device_id is checked.
+
+        status is 'ok', 'error' for an invalid token, or 'busy'. The callback
+        is called right away for a cached token, else from the event loop."""
+        entry = (device_id, token)
+        expiry = self.tokens.get(entry)
+        if expiry is not None:
+            if expiry > time.time():
+                self.tokens.move_to_end(entry)
+                self.stats['hits'] += 1
+                callback('ok')
+                return
+            del self.tokens[entry]
+
+        if not token:
+            self.stats['rejected'] += 1
+            auth_log.info('Device {} attached without a JWT', device_id)
+            callback('error')
+            return
+        waiting = self.pending.get(entry)
+        if waiting is not None:
+            self.stats['coalesced'] += 1
+            waiting.append(callback)
+            return
+        if len(self.pending) >= self.max_pending:
+            self.stats['busy'] += 1
+            callback('busy')
+            return
+
+        self.stats['misses'] += 1
+        self.pending[entry] = [callback]
+        future = self.executor.submit(self.check, device_id, token)
+        future.add_done_callback(lambda future: self.on_done(entry, future))
+
+    def public_key(self, device_id):
+        """Returns the public key of device_id, parsed again if its file changed."""
+        path = self.key_path.format(device_id=device_id)
+        mtime = os.stat(path).st_mtime
+        with self.keys_lock:
+            cached = self.keys.get(device_id)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            key = load_public_key(f.read())
+        with self.keys_lock:
+            self.keys[device_id] = (mtime, key)
+        return key
+
+    def check(self, device_id, token):
+        """Returns the expiry of a valid token. Runs on the worker threads."""
+        claims = jwt.decode(
+            token, self.public_key(device_id), algorithms=self.algorithms,
+            audience=self.audience, leeway=DEVICE_JWT_LEEWAY)
+        if 'exp' not in claims:
+            raise jwt.InvalidTokenError('The token does not expire')
+        return claims['exp']
+
+    def on_done(self, entry, future):
+        """Runs on the worker threads."""
+        self.done.append((entry, future))
+        try:
+            self.wakeup_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The event loop has wakeups to read already
+            pass
+
+    def on_wakeup(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.done:
+            entry, future = self.done.popleft()
+            try:
+                expiry = future.result()
+            except Exception as e:  # jwt.InvalidTokenError, OSError, ValueError
+                self.stats['rejected'] += 1
+                auth_log.info('Device {} rejected: {}', entry[0], e)
+                status = 'error'
+            else:
+                self.stats['verified'] += 1
+                self.remember(entry, expiry)
+                status = 'ok'
+            for callback in self.pending.pop(entry):
+                callback(status)
+
+    def remember(self, entry, expiry):
+        self.tokens[entry] = expiry
+        self.tokens.move_to_end(entry)
+        if len(self.tokens) > self.cache_size:
+            self.tokens.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def stats_str(self):
+        return ('{} tokens, {} keys cached, {} verifying, '.format(
+            len(self.tokens), len(self.keys), len(self.pending))
+            + ', '.join('{} {}'.format(key, value) for key, value in self.stats.items()))
+# [END device_auth]
+
 
 # [START iot_mqtt_config]
 def error_str(rc):
@@ -113,75 +829,115 @@ def error_str(rc):
     return '{}: {}'.format(rc, mqtt.error_string(rc))
 
 
-def on_connect(unused_client, unused_userdata, unused_flags, rc):
+def on_connect(client, userdata, unused_flags, rc):
     """Callback for when a device connects."""
     logger.info('on_connect {}'.format(mqtt.connack_string(rc)))
+    if rc != 0:
+        # Paho closes the connection and calls on_disconnect
+        return
+
+    handover = gateway_state.handover
+    if handover is not None and client is handover.client:
+        handover.complete()
+    elif client is not gateway_state.client:
+        return
 
     # After a successful connect, reset backoff time and stop backing off.
-    global minimum_backoff_time
-    minimum_backoff_time = 1
+    if gateway_state.reconnector is not None:
+        gateway_state.reconnector.reset()
 
-    gateway_state.connected = True
+    # A new session starts without the subscriptions of the previous one
+    if userdata['resubscribe']:
+        subscribe_all(client)
+    userdata['resubscribe'] = True
 
-def on_disconnect(unused_client, unused_userdata, rc):
-    """Paho callback for when a device disconnects."""
-    logger.info('on_disconnect {}'.format(error_str(rc)))
+    gateway_state.connected = True
+    if gateway_state.event_loop is not None:
+        gateway_state.event_loop.resume_udp('disconnected')
 
-    gateway_state.connected = False
+    # Run the device commands received while disconnected
+    while gateway_state.pending_control:
+        fn, args = gateway_state.pending_control.popleft()
+        fn(client, *args)
 
-    # Since a disconnect occurred, the next loop iteration will wait with
-    # exponential backoff.
-    global minimum_backoff_time
-    while True:
-        # If backoff time is too large, give up.
-        if minimum_backoff_time > MAXIMUM_BACKOFF_TIME:
-            logger.info('Exceeded maximum backoff time. Giving up.')
-            break
+    if gateway_state.outbound is not None:
+        gateway_state.outbound.pump()
 
-        delay = minimum_backoff_time + random.randint(0, 1000) / 1000.0
-        time.sleep(delay)
-        minimum_backoff_time *= 2
-        client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
+def on_disconnect(client, unused_userdata, rc):
+    """Paho callback for when a device disconnects."""
+    logger.info('on_disconnect {}'.format(error_str(rc)))
 
+    handover = gateway_state.handover
+    if handover is not None and client is handover.client:
+        handover.abort('disconnected')
+        return
+    if client is not gateway_state.client:
+        # A client retired by a handover
+        return
 
-def on_publish(unused_client, unused_userdata, unused_mid):
+    gateway_state.connected = False
+    # Without a spool, device events wait in the kernel buffer until the
+    # gateway is connected again.
+    if gateway_state.event_loop is not None and gateway_state.spool is None:
+        gateway_state.event_loop.pause_udp('disconnected')
+    if gateway_state.outbound is not None:
+        gateway_state.outbound.on_disconnect()
+
+    # rc is 0 when the gateway itself called disconnect(). During a handover,
+    # the bridge drops the old connection once the new one is made.
+    if handover is not None and handover.client is not None:
+        return
+    if rc != 0 and gateway_state.reconnector is not None:
+        gateway_state.reconnector.schedule(client)
+
+
+def on_publish(client, unused_userdata, mid):
     """Paho callback when a message is sent to the broker."""
-    logger.debug('on_publish \'{}\''.format(unused_mid))
+    logger.debug('on_publish %s', mid)
+    # The mids of a retired client are not the ones of the current client
+    if gateway_state.outbound is not None and client is gateway_state.client:
+        gateway_state.outbound.on_publish(mid)
 
 
 def on_message(unused_client, unused_userdata, message):
     """Callback when the device receives a message on a subscription."""
     payload = str(message.payload.decode('utf-8'))
-    logger.info('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-        payload, message.topic, str(message.qos)))
+    downlink_log.info('Received message \'{}\' on topic \'{}\' with Qos {}',
+                      payload, message.topic, message.qos)
 
-    
-    try:
-        # Relaying to the device
-        client_addr = gateway_state.subscriptions[message.topic]
-
-        if client_addr != gateway_state.gateway_id:
-            # Having fun with 'DISP: <Text>' command
-            if payload.startswith('DISP'):
-                payload = "d_{}".format(payload)
-            
-            logger.info('Relaying config[{}] to {}'.format(payload, client_addr))
-            udpSerSock.sendto(payload.encode('utf8'), client_addr)
-        
-
-    except KeyError:
+
+    client_addrs = gateway_state.subscriptions.match(message.topic)
+    if not client_addrs:
         logger.info('Nobody subscribes to topic {}'.format(message.topic))
+        return
+
+    # The gateway subscribes to its own config too, which is not relayed
+    client_addrs = [addr for addr in client_addrs if addr != gateway_state.gateway_id]
+    if not client_addrs:
+        return
+
+    # Having fun with 'DISP: <Text>' command
+    if payload.startswith('DISP'):
+        payload = "d_{}".format(payload)
+
+    # Relaying to the device: /devices/<device_id>/config or commands
+    levels = message.topic.split('/')
+    device_id, kind = levels[2], levels[3]
+    if kind == 'config':
+        gateway_state.downlinks.config(device_id, payload, client_addrs)
+    else:
+        gateway_state.downlinks.command(device_id, payload, client_addrs)
+
 
 def on_subscribe(unused_client, unused_userdata, mid, granted_qos):
     logger.debug('on_subscribe success: mid {}, qos {}'.format(mid, granted_qos))
 
 # This client is the gateway
-def get_client(
-        project_id, cloud_region, registry_id, device_id, private_key_file,
-        algorithm, ca_certs, mqtt_bridge_hostname, mqtt_bridge_port, 
-        jwt_expires_minutes):
-    """Create our MQTT client. The client_id is a unique string that identifies
-    this device. For Google Cloud IoT Core, it must be in the format below."""
+def create_client(
+        project_id, cloud_region, registry_id, device_id, password, ca_certs):
+    """Create our MQTT client, not yet connected. The client_id is a unique
+    string that identifies this device. For Google Cloud IoT Core, it must be
+    in the format below."""
     client_id=('projects/{}/locations/{}/registries/{}/devices/{}'.format(
             project_id,
             cloud_region,
@@ -192,13 +948,12 @@ def get_client(
 
     # With Google Cloud IoT Core, the username field is ignored, and the
     # password field is used to transmit a JWT to authorize the device.
-    client.username_pw_set(
-            username='unused',
-            password=create_jwt(
-                    project_id, private_key_file, algorithm, jwt_expires_minutes))
+    client.username_pw_set(username='unused', password=password)
 
-    # Enable SSL/TLS support.
-    client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+    # Enable SSL/TLS support, unless there are no CA certs: to connect to a
+    # local broker, as in the benchmarks.
+    if ca_certs is not None:
+        client.tls_set(ca_certs=ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
 
     # Register message callbacks. https://eclipse.org/paho/clients/python/docs/
     # describes additional callbacks that Paho supports. In this example, the
@@ -209,6 +964,30 @@ def get_client(
     client.on_message = on_message
     client.on_subscribe = on_subscribe
 
+    # 'resubscribe' tells on_connect to subscribe again to every topic
+    client.user_data_set({'resubscribe': True})
+
+    # The OutboundQueue bounds the events in flight, Paho must not hold
+    # them back in its own queue.
+    client.max_inflight_messages_set(0)
+
+    return client
+
+
+def get_client(
+        project_id, cloud_region, registry_id, device_id, private_key_file,
+        algorithm, ca_certs, mqtt_bridge_hostname, mqtt_bridge_port,
+        jwt_expires_minutes, password=None):
+    """Create our MQTT client, connect it and subscribe to the gateway topics."""
+    if password is None:
+        password = create_jwt(
+                project_id, private_key_file, algorithm, jwt_expires_minutes)
+    client = create_client(
+            project_id, cloud_region, registry_id, device_id, password, ca_certs)
+
+    # The topics are subscribed below
+    client.user_data_set({'resubscribe': False})
+
     # Connect to the Google MQTT bridge.
     client.connect(mqtt_bridge_hostname, mqtt_bridge_port)
 
@@ -218,6 +997,7 @@ def get_client(
     try:
         result, mid = client.subscribe(mqtt_config_topic, qos=1)
         gateway_state.subscriptions[mqtt_config_topic] = device_id
+        gateway_state.subscribed_topics[mqtt_config_topic] = 1
         logger.info('[Subscription] Subscribing to {} - qos {}, with mid {}'.format(mqtt_config_topic, 1, mid))
     except:   #ValueError
         logger.info("Error with Subscription mid {}".format(mid))
@@ -227,7 +1007,8 @@ def get_client(
     mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)    
     try:
         result, mid = client.subscribe(mqtt_command_topic, qos=0)
-        gateway_state.subscriptions[mqtt_config_topic[:-2]] = device_id
+        gateway_state.subscriptions[mqtt_command_topic] = device_id
+        gateway_state.subscribed_topics[mqtt_command_topic] = 0
         logger.info('[Subscription] Subscribing to {} - qos {}, with mid {}'.format(mqtt_command_topic, 0, mid))
     except:   #ValueError
         logger.info("Error with Subscription mid {}".format(mid))
@@ -243,7 +1024,8 @@ def attach_device(client, device_id, auth):
     attach_payload = '{{"authorization" : "{}"}}'.format(auth)
     try:
         result, mid = client.publish(attach_topic, attach_payload, qos=1)
-        logger.info('[Attachment] Publishing to {} - payload {} - qos {}, with mid {}'.format(attach_topic, attach_payload, 1, mid))
+        # The payload holds the credentials of the device, and is not logged
+        logger.info('[Attachment] Publishing to {} - qos {}, with mid {}'.format(attach_topic, 1, mid))
     except:   #ValueError
         logger.info("Error with Attachment - mid {}".format(mid))
 # [END iot_attach_device]
@@ -264,9 +1046,17 @@ def subscribe_device(client, device_id, client_addr):
     # Subscribe to the config topic.
     # This is the topic that the device will receive configuration updates on.
     mqtt_config_topic = '/devices/{}/config'.format(device_id)
+    mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)
+    if (mqtt_config_topic in gateway_state.subscribed_topics
+            and mqtt_command_topic in gateway_state.subscribed_topics):
+        # Subscribed already, the DownlinkRelay serves the latest config
+        gateway_state.subscriptions[mqtt_config_topic] = client_addr
+        gateway_state.subscriptions[mqtt_command_topic] = client_addr
+        return
     try:
         result, mid = client.subscribe(mqtt_config_topic, qos=1)
         gateway_state.subscriptions[mqtt_config_topic] = client_addr        # Remember the corresponding device
+        gateway_state.subscribed_topics[mqtt_config_topic] = 1
         logger.info('[Subscription] Subscribing to {} - qos {}, with mid {}'.format(mqtt_config_topic, 1, mid))
     except:   #ValueError
         logger.info("Error with Subscription mid {}".format(mid))
@@ -274,30 +1064,1523 @@ def subscribe_device(client, device_id, client_addr):
 
     # Subscribe to the commands topic
     # The topic that the device will receive commands on.
-    mqtt_command_topic = '/devices/{}/commands/#'.format(device_id)    
     try:
         result, mid = client.subscribe(mqtt_command_topic, qos=0)
-        gateway_state.subscriptions[mqtt_command_topic[:-2]] = client_addr        # Remember the corresponding device
+        gateway_state.subscriptions[mqtt_command_topic] = client_addr        # Remember the corresponding device
+        gateway_state.subscribed_topics[mqtt_command_topic] = 0
         logger.info('[Subscription] Subscribing to {} - qos {}, with mid {}'.format(mqtt_command_topic, 0, mid))
     except:   #ValueError
         logger.info("Error with Subscription mid {}".format(mid))
 # [END subscribe_device]
 
+# [START subscribe_all]
+# Maximum number of topics in one SUBSCRIBE packet
+SUBSCRIBE_BATCH = 100
+
+
+def subscribe_all(client):
+    """Subscribe again to every topic, in a few SUBSCRIBE packets."""
+    topics = list(gateway_state.subscribed_topics.items())
+    for i in range(0, len(topics), SUBSCRIBE_BATCH):
+        batch = topics[i:i + SUBSCRIBE_BATCH]
+        result, mid = client.subscribe(batch)
+        logger.info('[Subscription] Subscribing again to {} topics, with mid {}'.format(
+            len(batch), mid))
+# [END subscribe_all]
+
+# [START downlink_relay]
+class DownlinkRelay(object):
+    """Relays the configs and commands of the devices, at a paced rate.
+
+    The latest config of every device is kept with a version counted by the
+    gateway, and served again when the device subscribes, without a round
+    trip to the bridge. A config the bridge sends again unchanged is not
+    relayed, and a config still waiting to be sent is replaced by a newer one
+    rather than queued after it. Datagrams go out at up to rate per second,
+    in bursts of up to burst, so that a burst of updates for many devices
+    does not flood the network of the devices. Configs take one place in the
+    queue per device, commands beyond max_queued are dropped.
+    """
+
+    def __init__(self, event_loop, send, rate, burst, max_queued):
+        self.event_loop = event_loop
+        self.send = send                # send(payload, client_addr)
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+
+        # The key is the device ID, the value (version, payload) of its config
+        self.configs = {}
+        # Configs waiting to be sent: device ID: client addresses
+        self.pending_configs = {}
+        # ('config', device ID, None, None) or ('command', device ID, payload,
+        # client addresses)
+        self.queue = collections.deque()
+        self.queued_commands = 0
+
+        self.credit = burst
+        self.last = time.monotonic()
+        self.timer = None
+
+        self.stats = {
+            'configs': 0,
+            'unchanged': 0,
+            'superseded': 0,
+            'served': 0,
+            'commands': 0,
+            'sent': 0,
+            'dropped': 0,
+        }
+
+    def config(self, device_id, payload, client_addrs):
+        """Takes the config the bridge sent for device_id."""
+        self.stats['configs'] += 1
+        cached = self.configs.get(device_id)
+        if cached is not None and cached[1] == payload:
+            # e.g. sent again by the bridge on a new subscription
+            self.stats['unchanged'] += 1
+            return
+        version = cached[0] + 1 if cached is not None else 1
+        self.configs[device_id] = (version, payload)
+        logger.debug('Config version %s of %s', version, device_id)
+        self.enqueue_config(device_id, client_addrs)
+
+    def serve(self, device_id, client_addr):
+        """Sends the latest config of device_id again, to a new subscription."""
+        if device_id not in self.configs:
+            return
+        self.stats['served'] += 1
+        self.enqueue_config(device_id, [client_addr])
+
+    def enqueue_config(self, device_id, client_addrs):
+        if device_id in self.pending_configs:
+            # Not sent yet, it goes out with the latest version
+            self.stats['superseded'] += 1
+        else:
+            self.queue.append(('config', device_id, None, None))
+        self.pending_configs[device_id] = client_addrs
+        self.schedule()
+
+    def command(self, device_id, payload, client_addrs):
+        self.stats['commands'] += 1
+        if self.queued_commands >= self.max_queued:
+            self.stats['dropped'] += 1
+            return
+        self.queue.append(('command', device_id, payload, client_addrs))
+        self.queued_commands += 1
+        self.schedule()
+
+    def schedule(self):
+        # Sent from the event loop, after the reply of the request at hand
+        if self.timer is None:
+            self.timer = self.event_loop.call_later(0, self.pump)
+
+    def pump(self):
+        self.timer = None
+        now = time.monotonic()
+        self.credit = min(self.credit + (now - self.last) * self.rate, self.burst)
+        self.last = now
+        while self.queue and self.credit >= 1:
+            kind, device_id, payload, client_addrs = self.queue.popleft()
+            if kind == 'config':
+                client_addrs = self.pending_configs.pop(device_id)
+                payload = self.configs[device_id][1]
+            else:
+                self.queued_commands -= 1
+            for client_addr in client_addrs:
+                downlink_log.info('Relaying {}[{}] to {}', kind, payload, client_addr)
+                self.send(payload, client_addr)
+                self.stats['sent'] += 1
+                self.credit -= 1
+        if self.queue:
+            self.timer = self.event_loop.call_later(
+                (1 - self.credit) / self.rate, self.pump)
+
+    def stats_str(self):
+        return '{} configs cached, {} queued, '.format(
+            len(self.configs), len(self.queue)) + ', '.join(
+                '{} {}'.format(key, value) for key, value in self.stats.items())
+# [END downlink_relay]
+
 # [START sendevent_device]
-def sendevent_device(client, device_id, payload):
+def sendevent_device(client, device_id, payload, qos=0):
     # This is the topic that the device will send events to
     mqtt_topic = '/devices/{}/events'.format(device_id)
     mid = -1
     try:
-        result, mid = client.publish(mqtt_topic, payload, qos=0)
-        logger.info('[Publishing Event] Publishing to {} - payload {} - qos {}, with mid {}'.format(mqtt_topic, payload, 0, mid))
+        result, mid = client.publish(mqtt_topic, payload, qos=qos)
+        publish_log.info('[Publishing Event] Publishing to {} - payload {} - qos {}, with mid {}',
+                         mqtt_topic, payload, qos, mid)
     except:   #ValueError
         logger.info("Error with Publishing Event to {} - mid {}".format(mqtt_topic, mid))
+    return mid
 # [END sendevent_device]
 
+# [START event_batcher]
+class EventBatcher(object):
+    """Aggregates device events into one MQTT publish per device.
+
+    Events are buffered per device and published as a single JSON array to
+    '/devices/{id}/events' when the buffer holds max_events events, when adding
+    an event would go over max_bytes of payload, or when the oldest buffered
+    event has waited max_linger seconds.
+    """
+
+    def __init__(self, event_loop, publish, max_events, max_bytes, max_linger):
+        self.event_loop = event_loop
+        self.publish = publish      # publish(device_id, payload)
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_linger = max_linger
+
+        # The key is device_id, the value is a DeviceBuffer
+        self.buffers = {}
+
+        self.stats = {
+            'events': 0,
+            'batches': 0,
+            'flush_size': 0,
+            'flush_bytes': 0,
+            'flush_linger': 0,
+            'flush_detach': 0,
+            'flush_shutdown': 0,
+        }
+
+    class DeviceBuffer(object):
+        def __init__(self, timer):
+            self.events = []
+            self.size = 2           # the enclosing '[]'
+            self.timer = timer
+
+    def add(self, device_id, payload):
+        """Buffer the JSON payload of one event of device_id."""
+        self.stats['events'] += 1
+        event_size = len(payload) + 1
+
+        buf = self.buffers.get(device_id)
+        if buf is not None and buf.size + event_size > self.max_bytes:
+            self.flush(device_id, 'bytes')
+            buf = None
+        if buf is None:
+            timer = self.event_loop.call_later(
+                self.max_linger, self.flush, device_id, 'linger')
+            buf = self.buffers[device_id] = self.DeviceBuffer(timer)
+
+        buf.events.append(payload)
+        buf.size += event_size
+        if len(buf.events) >= self.max_events:
+            self.flush(device_id, 'size')
+
+    def flush(self, device_id, reason):
+        """Publish the buffered events of device_id, if any."""
+        buf = self.buffers.pop(device_id, None)
+        if buf is None:
+            return
+        buf.timer.cancel()
+        self.stats['batches'] += 1
+        self.stats['flush_' + reason] += 1
+        self.publish(device_id, '[{}]'.format(','.join(buf.events)))
+
+    def flush_all(self, reason):
+        for device_id in list(self.buffers):
+            self.flush(device_id, reason)
+
+    def stats_str(self):
+        batches = self.stats['batches']
+        return ('events {events}, batches {batches} ({per_batch:.1f} events/batch), '
+                'flushed by size {flush_size}, bytes {flush_bytes}, '
+                'linger {flush_linger}, detach {flush_detach}, '
+                'shutdown {flush_shutdown}, buffered devices {buffered}').format(
+                    per_batch=self.stats['events'] / batches if batches else 0,
+                    buffered=len(self.buffers), **self.stats)
+# [END event_batcher]
+
+# [START edge_aggregation]
+AXES = ('x', 'y', 'z')
+
+
+class AlertRule(object):
+    """A threshold on one axis of the readings of the devices matching device,
+    as the alert rules of the Beam pipeline (alert_rules.json).
+
+    An incident of the rule starts when the value goes below (or above) the
+    threshold, and ends when it crosses back the clear threshold. Its
+    duration and message are only used by the pipeline.
+    """
+
+    def __init__(self, name, metric, below=None, above=None, clear=None,
+                 duration_s=0, device='*', message=None):
+        if metric not in AXES:
+            raise ValueError('Rule {}: unknown metric {}.'.format(name, metric))
+        if (below is None) == (above is None):
+            raise ValueError('Rule {}: give either below or above.'.format(name))
+        self.name = name
+        self.axis = AXES.index(metric)
+        self.below = below is not None
+        self.threshold = float(below if self.below else above)
+        self.clear = self.threshold if clear is None else float(clear)
+        self.device = device
+
+    def applies_to(self, device_id):
+        return fnmatch.fnmatchcase(device_id, self.device)
+
+    def triggered(self, value):
+        return value <= self.threshold if self.below else value >= self.threshold
+
+    def cleared(self, value):
+        return value > self.clear if self.below else value < self.clear
+
+
+def load_alert_rules(path):
+    """Returns the rules of a file in the format of alert_rules.json."""
+    with open(path) as f:
+        return [AlertRule(**rule) for rule in json.load(f)['rules']]
+
+
+def parse_axes(raw_accelerometer_data):
+    """Returns the (x, y, z) of 'x=<x>, y=<y>, z=<z>'."""
+    axes = {}
+    for part in raw_accelerometer_data.split(','):
+        name, _, value = part.partition('=')
+        axes[name.strip()] = float(value)
+    return axes['x'], axes['y'], axes['z']
+
+
+class EdgeAggregator(object):
+    """Publishes statistics of the readings of the devices instead of the
+    readings, except around anomalies.
+
+    The readings of a device are folded into the statistics of the current
+    period of interval seconds, kept with those of the previous periods of
+    the window in an array of fixed size. At the end of every period, the
+    statistics of each device over the window are published as one summary.
+
+    A reading triggering one of the rules starts an incident, which lasts
+    until the readings clear all the rules of the device, as in the Beam
+    pipeline. The readings of an incident are published as they are, with
+    up to context readings before and after it: the pipeline receives every
+    reading its alerts depend on, and raises the same alerts.
+    """
+
+    # Fields of the statistics of a period: count, then the sum, sum of
+    # squares, minimum and maximum of x, y and z
+    FIELDS = 13
+    EMPTY = array.array('d', [0.0] + [0.0, 0.0, float('inf'), float('-inf')] * 3)
+
+    def __init__(self, event_loop, publish_reading, publish_summary, rules,
+                 interval, window, context):
+        self.event_loop = event_loop
+        self.publish_reading = publish_reading      # publish_reading(device_id, event)
+        self.publish_summary = publish_summary      # publish_summary(device_id, payload)
+        self.rules = rules
+        self.interval = interval
+        self.slots = window // interval             # Periods of a window
+        self.context = context
+        self.period = int(time.time() // interval)  # Number of the current period
+
+        # The key is device_id, the value is a DeviceWindow
+        self.devices = {}
+
+        self.stats = {
+            'readings': 0,
+            'published': 0,
+            'incidents': 0,
+            'summaries': 0,
+        }
+        self.schedule()
+
+    class DeviceWindow(object):
+        def __init__(self, slots, rules, context):
+            self.data = EdgeAggregator.EMPTY * slots
+            self.periods = [None] * slots   # The period of each slot
+            self.rules = rules
+            self.incidents = set()          # Rules in an incident
+            self.before = collections.deque(maxlen=context)
+            self.after = 0                  # Readings to publish after an incident
+
+    def add(self, device_id, readings):
+        """Takes in readings of device_id, a list of (x, y, z, event), where
+        event is what publish_reading publishes."""
+        device = self.devices.get(device_id)
+        if device is None:
+            rules = [rule for rule in self.rules if rule.applies_to(device_id)]
+            device = self.devices[device_id] = self.DeviceWindow(
+                self.slots, rules, self.context)
+        slot = self.period % self.slots
+        i = slot * self.FIELDS
+        data = device.data
+        if device.periods[slot] != self.period:
+            device.periods[slot] = self.period
+            data[i:i + self.FIELDS] = self.EMPTY
+
+        self.stats['readings'] += len(readings)
+        for reading in readings:
+            data[i] += 1
+            for j, value in zip((i + 1, i + 5, i + 9), reading):
+                data[j] += value
+                data[j + 1] += value * value
+                if value < data[j + 2]:
+                    data[j + 2] = value
+                if value > data[j + 3]:
+                    data[j + 3] = value
+
+            incidents = device.incidents
+            in_incident = bool(incidents)
+            for rule in device.rules:
+                if rule in incidents:
+                    if rule.cleared(reading[rule.axis]):
+                        incidents.discard(rule)
+                elif rule.triggered(reading[rule.axis]):
+                    incidents.add(rule)
+            if incidents and not in_incident:
+                self.stats['incidents'] += 1
+                while device.before:
+                    self.publish(device_id, device.before.popleft())
+            if incidents or in_incident:
+                # Up to the reading clearing the incident
+                self.publish(device_id, reading[3])
+                device.after = self.context
+            elif device.after:
+                device.after -= 1
+                self.publish(device_id, reading[3])
+            else:
+                device.before.append(reading[3])
+
+    def publish(self, device_id, event):
+        self.stats['published'] += 1
+        self.publish_reading(device_id, event)
+
+    def schedule(self):
+        delay = (self.period + 1) * self.interval - time.time()
+        self.event_loop.call_later(max(delay, 0), self.end_period)
+
+    def end_period(self):
+        self.flush((self.period + 1) * self.interval)
+        self.period = max(self.period + 1, int(time.time() // self.interval))
+        self.schedule()
+
+    def flush(self, end):
+        """Publishes the summaries of the window ending with the current
+        period, at end. Devices without readings in it are forgotten, unless
+        in an incident."""
+        start = time.asctime(time.gmtime((self.period - self.slots + 1) * self.interval))
+        end = time.asctime(time.gmtime(end))
+        for device_id, device in list(self.devices.items()):
+            summary = self.summarize(device)
+            if summary is None:
+                if not device.incidents:
+                    del self.devices[device_id]
+                continue
+            self.stats['summaries'] += 1
+            self.publish_summary(device_id, json.dumps(collections.OrderedDict(
+                [('device_id', device_id), ('window_start', start),
+                 ('window_end', end)] + summary)))
+
+    def summarize(self, device):
+        """Returns the items of the summary of the readings of device over the
+        window, or None if it has none."""
+        data = device.data
+        oldest = self.period - self.slots
+        starts = [slot * self.FIELDS for slot, period in enumerate(device.periods)
+                  if period is not None and period > oldest]
+        count = sum(data[i] for i in starts)
+        if not count:
+            return None
+        summary = [('count', int(count))]
+        for axis, name in enumerate(AXES):
+            j = 1 + 4 * axis
+            mean = sum(data[i + j] for i in starts) / count
+            variance = max(sum(data[i + j + 1] for i in starts) / count - mean * mean, 0.0)
+            summary.append((name, collections.OrderedDict(
+                (key, float('%.6g' % value)) for key, value in (
+                    ('mean', mean),
+                    ('min', min(data[i + j + 2] for i in starts)),
+                    ('max', max(data[i + j + 3] for i in starts)),
+                    ('variance', variance)))))
+        return summary
+
+    def stats_str(self):
+        readings = self.stats['readings']
+        return ('readings {readings}, published {published} ({share:.1%}), '
+                'incidents {incidents}, summaries {summaries}, devices {devices}, '
+                'in incident {in_incident}').format(
+                    share=self.stats['published'] / float(readings) if readings else 0,
+                    devices=len(self.devices),
+                    in_incident=sum(1 for device in self.devices.values() if device.incidents),
+                    **self.stats)
+# [END edge_aggregation]
+
+# [START outbound_queue]
+QUEUE_FULL_POLICIES = ('drop_oldest', 'drop_newest', 'block', 'nack')
+
+
+class OutboundQueue(object):
+    """Bounded queue of device events waiting to be published.
+
+    At most max_inflight events are handed to Paho at any time. They are kept
+    in gateway_state.pending_responses, keyed by mid, until on_publish()
+    reports the PUBACK (or the socket write for QoS 0). The other events wait
+    in a queue of at most max_queued events. When the queue is full, policy
+    decides what happens:
+        drop_oldest: the oldest queued event is dropped.
+        drop_newest: the new event is dropped.
+        block: reading from the UDP socket is paused until the queue drains
+               below half of its size, devices are pushed back by the kernel.
+        nack: the device gets a 'busy' reply instead of 'ok'.
+    """
+
+    def __init__(self, event_loop, publish, qos, max_inflight, max_queued, policy,
+                 on_complete=None):
+        self.event_loop = event_loop
+        self.publish = publish      # publish(device_id, payload, qos), returns mid
+        self.qos = qos
+        # on_complete(position) is called when an event offered with a
+        # position is published or dropped, e.g. to checkpoint the Spool.
+        self.on_complete = on_complete
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.policy = policy
+
+        self.queue = collections.deque()
+        self.inflight = gateway_state.pending_responses
+        # Publish time of the events in flight, keyed by mid
+        self.publish_times = {}
+        # Mids completed by on_publish() before publish() returned them: Paho
+        # writes QoS 0 messages right away when no loop thread runs.
+        self.publishing = False
+        self.completed_early = set()
+        self.qos_label = (str(qos),)
+
+        self.stats = {
+            'published': 0,
+            'completed': 0,
+            'dropped_oldest': 0,
+            'dropped_newest': 0,
+            'nacked': 0,
+            'blocked': 0,
+        }
+
+    def is_full(self):
+        return len(self.queue) >= self.max_queued
+
+    def room(self):
+        return max(self.max_queued - len(self.queue), 0)
+
+    def offer(self, device_id, payload, position=None):
+        """Queue an event, returns False if it was dropped."""
+        # With the block and nack policies, events are held back before they
+        # are read or acknowledged, the queue only goes over by what a batch
+        # or a single wakeup brings in.
+        if self.is_full():
+            if self.policy == 'drop_oldest':
+                self.complete(self.queue.popleft())
+                self.stats['dropped_oldest'] += 1
+            elif self.policy == 'drop_newest':
+                self.complete((device_id, payload, position))
+                self.stats['dropped_newest'] += 1
+                return False
+        self.queue.append((device_id, payload, position))
+        if self.policy == 'block' and self.is_full():
+            self.stats['blocked'] += 1
+            self.event_loop.pause_udp('outbound_full')
+        self.pump()
+        return True
+
+    def pump(self):
+        """Hand queued events to Paho while the in-flight window has room."""
+        while (self.queue and gateway_state.connected
+               and len(self.inflight) < self.max_inflight):
+            event = self.queue.popleft()
+            self.publishing = True
+            try:
+                mid = self.publish(event[0], event[1], self.qos)
+            finally:
+                self.publishing = False
+            if mid < 0:
+                self.queue.appendleft(event)
+                break
+            self.stats['published'] += 1
+            if mid in self.completed_early:
+                self.completed_early.discard(mid)
+                metrics.publish_latency.observe(0.0, self.qos_label)
+                self.stats['completed'] += 1
+                self.complete(event)
+                continue
+            self.inflight[mid] = event
+            self.publish_times[mid] = time.monotonic()
+
+        if self.policy == 'block' and len(self.queue) < self.max_queued // 2:
+            self.event_loop.resume_udp('outbound_full')
+
+    def complete(self, event):
+        if self.on_complete is not None and event[2] is not None:
+            self.on_complete(event[2])
+
+    def on_publish(self, mid):
+        event = self.inflight.pop(mid, None)
+        if event is None and self.publishing:
+            # Completed within publish(), pump() completes it
+            self.completed_early.add(mid)
+        elif event is not None:
+            metrics.publish_latency.observe(
+                time.monotonic() - self.publish_times.pop(mid), self.qos_label)
+            self.stats['completed'] += 1
+            self.complete(event)
+            self.pump()
+
+    def on_disconnect(self):
+        # Paho keeps QoS 1 messages and sends them again after reconnecting,
+        # the QoS 0 messages not yet written are lost, and so are their mids.
+        if self.qos == 0:
+            self.requeue_inflight()
+
+    def requeue_inflight(self):
+        """Queue the in-flight events again, to publish them on a new client."""
+        self.queue.extendleft(reversed(list(self.inflight.values())))
+        self.inflight.clear()
+        self.publish_times.clear()
+
+    def stats_str(self):
+        return ('queued {queued}/{max_queued}, in flight {inflight}/{max_inflight}, '
+                'published {published}, completed {completed}, '
+                'dropped oldest {dropped_oldest}, dropped newest {dropped_newest}, '
+                'nacked {nacked}, blocked {blocked}').format(
+                    queued=len(self.queue), max_queued=self.max_queued,
+                    inflight=len(self.inflight), max_inflight=self.max_inflight,
+                    **self.stats)
+# [END outbound_queue]
+
+# [START spool]
+# Each record of the spool is prefixed by its length and its CRC32.
+SPOOL_RECORD_HEADER = struct.Struct('!II')
+
+# How often, in seconds, the spool is replayed into the outbound queue.
+SPOOL_REPLAY_TICK = 0.1
+
+
+class SpoolSegment(object):
+    """A preallocated, memory-mapped file holding spool records back to back.
+
+    A zero length header marks the end of the records written so far."""
+
+    def __init__(self, path, seq, size=None):
+        self.path = path
+        self.seq = seq
+        if size is not None:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+        else:
+            self.file = open(path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        self.size = len(self.mm)
+        self.write_pos = self.scan(0)[0]
+        self.sealed = False
+
+    def read(self, pos):
+        """Returns (record, next_pos), record is None past the last record."""
+        end = pos + SPOOL_RECORD_HEADER.size
+        if end > self.size:
+            return None, pos
+        length, crc = SPOOL_RECORD_HEADER.unpack_from(self.mm, pos)
+        if length == 0 or end + length > self.size:
+            return None, pos
+        record = self.mm[end:end + length]
+        if zlib.crc32(record) != crc:
+            # Torn write, the gateway stopped while appending this record.
+            return None, pos
+        return record, end + length
+
+    def scan(self, pos):
+        """Returns the end of the records from pos on, and their number."""
+        count = 0
+        while True:
+            record, next_pos = self.read(pos)
+            if record is None:
+                return pos, count
+            pos = next_pos
+            count += 1
+
+    def append(self, record):
+        """Appends a record, returns False if the segment has no room left."""
+        end = self.write_pos + SPOOL_RECORD_HEADER.size + len(record)
+        # Keep room for the zero header marking the end of the records.
+        if end + SPOOL_RECORD_HEADER.size > self.size:
+            return False
+        self.mm[self.write_pos + SPOOL_RECORD_HEADER.size:end] = record
+        SPOOL_RECORD_HEADER.pack_into(
+            self.mm, self.write_pos, len(record), zlib.crc32(record))
+        self.write_pos = end
+        return True
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class Spool(object):
+    """Append-only, segment based store of device events.
+
+    Events are appended to memory-mapped segment files of segment_bytes in
+    directory. They are read back in order for replay, and the read offset is
+    checkpointed to disk on sync() once the events are acknowledged by the
+    bridge, so a restarted gateway replays every event not yet acknowledged. Segments
+    entirely acknowledged are deleted. When the segments take more than
+    max_bytes, the oldest one is dropped to keep the disk usage bounded.
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(max_bytes // segment_bytes, 2)
+        self.checkpoint_path = os.path.join(directory, 'checkpoint')
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The key is the sequence number of the segment
+        self.segments = collections.OrderedDict()
+
+        # Records read for replay and waiting to be acknowledged. The key is
+        # the position (seq, offset) following the record, the value tells if
+        # it was acknowledged.
+        self.unacked = collections.OrderedDict()
+
+        # Number of records appended and not yet read
+        self.backlog = 0
+
+        self.stats = {
+            'appended': 0,
+            'replayed': 0,
+            'acked': 0,
+            'dropped_segments': 0,
+            'dropped_records': 0,
+        }
+
+        self.checkpoint = self.load_checkpoint()
+        self.checkpoint_dirty = False
+        self.open_segments()
+        self.read_seq, self.read_pos = self.checkpoint
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, 'spool-{:010d}.log'.format(seq))
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            return checkpoint['segment'], checkpoint['offset']
+        except (IOError, ValueError, KeyError):
+            return 0, 0
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'segment': self.checkpoint[0],
+                       'offset': self.checkpoint[1]}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def open_segments(self):
+        seqs = sorted(
+            int(name[6:-4]) for name in os.listdir(self.directory)
+            if name.startswith('spool-') and name.endswith('.log'))
+        checkpoint_seq, checkpoint_pos = self.checkpoint
+        for seq in seqs:
+            if seq < checkpoint_seq:
+                os.remove(self.segment_path(seq))
+                continue
+            segment = SpoolSegment(self.segment_path(seq), seq)
+            segment.sealed = True
+            self.segments[seq] = segment
+            start = checkpoint_pos if seq == checkpoint_seq else 0
+            self.backlog += segment.scan(start)[1]
+
+        if self.segments:
+            # Keep appending to the last segment
+            next(reversed(self.segments.values())).sealed = False
+        else:
+            self.add_segment(checkpoint_seq)
+        if self.backlog:
+            logger.info('[Spool] {} events to replay from {}'.format(
+                self.backlog, self.directory))
+
+    def add_segment(self, seq):
+        segment = SpoolSegment(self.segment_path(seq), seq, self.segment_bytes)
+        self.segments[seq] = segment
+        while len(self.segments) > self.max_segments:
+            self.drop_oldest_segment()
+        return segment
+
+    def drop_oldest_segment(self):
+        seq, segment = self.segments.popitem(last=False)
+        if seq == self.read_seq:
+            dropped = segment.scan(self.read_pos)[1]
+        elif seq > self.read_seq:
+            dropped = segment.scan(0)[1]
+        else:
+            dropped = 0
+        for position in [p for p in self.unacked if p[0] == seq]:
+            del self.unacked[position]
+        segment.remove()
+
+        self.backlog -= dropped
+        self.stats['dropped_segments'] += 1
+        self.stats['dropped_records'] += dropped
+        logger.info('[Spool] Full, dropped segment {} with {} events'.format(
+            seq, dropped))
+
+        first_seq = next(iter(self.segments))
+        if self.read_seq < first_seq:
+            self.read_seq, self.read_pos = first_seq, 0
+        if self.checkpoint[0] < first_seq:
+            self.checkpoint = (first_seq, 0)
+            self.save_checkpoint()
+
+    def append(self, device_id, payload):
+        """Stores one event, returns False if it does not fit in a segment."""
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf8')
+        record = device_id.encode('utf8') + b'\n' + payload
+        segment = next(reversed(self.segments.values()))
+        if not segment.append(record):
+            segment.sealed = True
+            segment.flush()
+            segment = self.add_segment(segment.seq + 1)
+            if not segment.append(record):
+                logger.info('[Spool] Event of {} too large to be spooled'.format(device_id))
+                return False
+        self.backlog += 1
+        self.stats['appended'] += 1
+        return True
+
+    def read(self, count):
+        """Returns up to count events (device_id, payload, position) to replay."""
+        events = []
+        while len(events) < count and self.read_seq in self.segments:
+            segment = self.segments[self.read_seq]
+            record, next_pos = segment.read(self.read_pos)
+            if record is None:
+                if not segment.sealed:
+                    break
+                self.read_seq, self.read_pos = self.read_seq + 1, 0
+                continue
+            self.read_pos = next_pos
+            position = (self.read_seq, next_pos)
+            self.unacked[position] = False
+            device_id, payload = record.split(b'\n', 1)
+            events.append((device_id.decode('utf8'), payload, position))
+        self.backlog -= len(events)
+        self.stats['replayed'] += len(events)
+        return events
+
+    def ack(self, position):
+        """Marks a replayed event as acknowledged and moves the checkpoint."""
+        if position not in self.unacked:
+            return
+        self.unacked[position] = True
+        self.stats['acked'] += 1
+
+        checkpoint = None
+        while self.unacked and next(iter(self.unacked.values())):
+            checkpoint, _ = self.unacked.popitem(last=False)
+        if checkpoint is not None:
+            # Saved by the next sync()
+            self.checkpoint = checkpoint
+            self.checkpoint_dirty = True
+
+    def sync(self):
+        """Flushes the appended records and the checkpoint to disk."""
+        for segment in self.segments.values():
+            if not segment.sealed:
+                segment.flush()
+        if self.checkpoint_dirty:
+            self.checkpoint_dirty = False
+            self.save_checkpoint()
+            while next(iter(self.segments)) < self.checkpoint[0]:
+                self.segments.popitem(last=False)[1].remove()
+
+    def close(self):
+        self.sync()
+        for segment in self.segments.values():
+            segment.flush()
+            segment.close()
+
+    def stats_str(self):
+        return ('backlog {backlog}, segments {segments}, appended {appended}, '
+                'replayed {replayed}, acked {acked}, dropped segments '
+                '{dropped_segments} ({dropped_records} events)').format(
+                    backlog=self.backlog, segments=len(self.segments),
+                    **self.stats)
+# [END spool]
+
+# [START reconnect_scheduler]
+# How often, in seconds, the event loop checks on a reconnection in progress.
+RECONNECT_POLL_INTERVAL = 0.05
+
+
+class ReconnectScheduler(object):
+    """Reconnects the MQTT client with exponential backoff and jitter.
+
+    Attempts are scheduled on the event loop, and the blocking part of a
+    reconnection (TCP connect and TLS handshake) runs on a worker thread.
+    The event loop leaves the client alone meanwhile, and keeps receiving,
+    spooling and acknowledging device datagrams.
+    """
+
+    def __init__(self, event_loop, min_backoff, max_backoff):
+        self.event_loop = event_loop
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.timer = None
+        self.thread = None
+        self.error = None
+        self.attempts = 0
+        self.failures = 0
+
+    def reset(self):
+        self.backoff = self.min_backoff
+
+    def schedule(self, client):
+        """Plan the next reconnection attempt of client."""
+        if self.timer is not None or self.thread is not None:
+            return
+        delay = self.backoff + random.randint(0, 1000) / 1000.0
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+        logger.info('Reconnecting in {:.1f}s'.format(delay))
+        self.timer = self.event_loop.call_later(delay, self.start, client)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def start(self, client):
+        self.timer = None
+        self.attempts += 1
+        self.event_loop.remove_client(client)
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.reconnect, args=(client,), name='mqtt-reconnect')
+        self.thread.daemon = True
+        self.thread.start()
+        self.event_loop.call_later(RECONNECT_POLL_INTERVAL, self.check, client)
+
+    def reconnect(self, client):
+        try:
+            if gateway_state.token_manager is not None:
+                # The token of the lost connection may have expired
+                client.username_pw_set(
+                    username='unused', password=gateway_state.token_manager.take())
+            client.reconnect()
+        except Exception as e:
+            self.error = e
+
+    def check(self, client):
+        if self.thread.is_alive():
+            self.event_loop.call_later(RECONNECT_POLL_INTERVAL, self.check, client)
+            return
+        self.thread = None
+        if client is not gateway_state.client:
+            # The client was replaced in the meantime
+            if self.error is None:
+                client.disconnect()
+            return
+        if self.error is not None:
+            logger.info('Reconnection failed: {}'.format(self.error))
+            self.failures += 1
+            self.schedule(client)
+            return
+        # The CONNACK is read by the event loop, on_connect follows
+        self.event_loop.add_client(client)
+# [END reconnect_scheduler]
+
+# [START client_handover]
+# Fraction of the JWT lifetime after which the gateway moves to a new token
+JWT_REFRESH_RATIO = 0.9
+
+# How long before a handover the next JWT is minted, in seconds
+JWT_PREMINT_LEAD = 30
+
+# How long a handover waits for the new connection, in seconds
+HANDOVER_TIMEOUT = 30
+
+
+class ClientHandover(object):
+    """Moves the gateway to a new MQTT connection, made with a fresh JWT.
+
+    The new client connects on a worker thread while the current client keeps
+    publishing. Once the new client is connected it subscribes to every topic
+    in bulk, becomes gateway_state.client, and the events the old client had
+    in flight are published again on it. The bridge accepts one connection per
+    gateway, so the old connection is dropped by the bridge or by complete().
+    """
+
+    def __init__(self, event_loop, create, connect, token_manager):
+        self.event_loop = event_loop
+        self.create = create        # create(password), returns a new client
+        self.connect = connect      # connect(client), blocking
+        self.token_manager = token_manager
+        self.client = None
+        self.thread = None
+        self.error = None
+        self.timer = None
+        self.handovers = 0
+        self.failures = 0
+
+    def start(self):
+        if self.client is not None:
+            return
+        logger.info('Handing over to a connection with a fresh JWT')
+        self.client = self.create(self.token_manager.take())
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run_connect, args=(self.client,), name='mqtt-handover')
+        self.thread.daemon = True
+        self.thread.start()
+        self.event_loop.call_later(RECONNECT_POLL_INTERVAL, self.check, self.client)
+
+    def run_connect(self, client):
+        try:
+            self.connect(client)
+        except Exception as e:
+            self.error = e
+
+    def check(self, client):
+        if self.thread.is_alive():
+            self.event_loop.call_later(RECONNECT_POLL_INTERVAL, self.check, client)
+            return
+        self.thread = None
+        if client is not self.client:
+            # Aborted while connecting
+            if self.error is None:
+                client.disconnect()
+            return
+        if self.error is not None:
+            self.abort(self.error)
+            return
+        # The CONNACK is read by the event loop, on_connect calls complete()
+        self.event_loop.add_client(self.client)
+        self.timer = self.event_loop.call_later(
+            HANDOVER_TIMEOUT, self.abort, 'timeout')
+
+    def complete(self):
+        old = gateway_state.client
+        gateway_state.client = self.client
+        self.client = None
+        self.timer.cancel()
+        self.handovers += 1
+
+        gateway_state.reconnector.cancel()
+        if gateway_state.outbound is not None:
+            gateway_state.outbound.requeue_inflight()
+
+        old.disconnect()
+        self.event_loop.remove_client(old)
+        logger.info('Handover complete')
+
+    def abort(self, reason):
+        if self.client is None:
+            return
+        logger.info('Handover failed: {}'.format(reason))
+        self.failures += 1
+        client = self.client
+        self.client = None
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.thread is None:
+            self.event_loop.remove_client(client)
+            client.disconnect()
+        # else the thread is still connecting, check() finds client is None
+
+        if not gateway_state.connected:
+            # The bridge dropped the old connection already
+            gateway_state.reconnector.schedule(gateway_state.client)
+        else:
+            self.event_loop.call_later(HANDOVER_TIMEOUT, self.start)
+# [END client_handover]
+
+# [START worker_router]
+class WorkerRouter(object):
+    """Pins devices to gateway workers by device ID.
+
+    Every worker receives datagrams on its own SO_REUSEPORT socket, and the
+    kernel picks the worker from the device address. A worker receiving a
+    datagram of a device owned by another worker forwards it, along with the
+    device address, to the inbox of that worker: a Unix datagram socket.
+    """
+
+    def __init__(self, index, count, inboxes, outboxes):
+        self.index = index
+        self.count = count
+        self.inbox = inboxes[index]
+        self.outboxes = outboxes
+        self.inbox.setblocking(False)
+        for outbox in outboxes:
+            outbox.setblocking(False)
+        self.stats = {'forwarded': 0, 'received': 0, 'dropped': 0}
+
+    def owner(self, device_id):
+        return zlib.crc32(device_id.encode('utf8')) % self.count
+
+    def owns(self, device_id):
+        return self.owner(device_id) == self.index
+
+    def forward(self, device_id, data, client_addr):
+        header = '{}\n{}\n'.format(client_addr[0], client_addr[1]).encode('utf8')
+        try:
+            self.outboxes[self.owner(device_id)].send(header + data)
+            self.stats['forwarded'] += 1
+        except socket.error as e:
+            # The inbox of the owner is full, or the owner is restarting
+            self.stats['dropped'] += 1
+            logger.debug('Dropped datagram of {}: {}'.format(device_id, e))
+
+    def receive(self, on_datagram):
+        """Hands the datagrams forwarded by other workers to on_datagram."""
+        for _ in range(MAX_DATAGRAMS_PER_WAKEUP):
+            try:
+                message = self.inbox.recv(BUFSIZE + 64)
+            except (BlockingIOError, InterruptedError):
+                return
+            host, port, data = message.split(b'\n', 2)
+            self.stats['received'] += 1
+            on_datagram(data, (host.decode('utf8'), int(port)))
+
+    def stats_str(self):
+        return 'worker {}/{}, forwarded {forwarded}, received {received}, dropped {dropped}'.format(
+            self.index, self.count, **self.stats)
+
+
+# How long the supervisor waits before restarting a worker, in seconds
+WORKER_RESTART_DELAY = 1
+
+
+def supervise(args):
+    """Runs args.workers gateway workers, and restarts the ones which exit."""
+    # Inbox of each worker, and the socket the other workers send to it with
+    pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+             for _ in range(args.workers)]
+    inboxes = [inbox for inbox, _ in pairs]
+    outboxes = [outbox for _, outbox in pairs]
+
+    children = {}
+    stopping = []
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_gateway(args, WorkerRouter(index, args.workers, inboxes, outboxes))
+            except Exception:
+                logger.exception('Worker {} failed'.format(index))
+                code = 1
+            os._exit(code)
+        children[pid] = index
+        logger.info('Started worker {} with pid {}'.format(index, pid))
+
+    def stop(signum, unused_frame):
+        stopping.append(signum)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(args.workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            # The workers got the SIGINT too
+            stopping.append(signal.SIGINT)
+            continue
+        index = children.pop(pid)
+        if stopping:
+            continue
+        logger.info('Worker {} exited with status {}, restarting it'.format(index, status))
+        time.sleep(WORKER_RESTART_DELAY)
+        spawn(index)
+# [END worker_router]
+
+# [START duplicate_filter]
+# Sequence numbers are 32 bits, and wrap around
+SEQ_MODULO = 1 << 32
+
+
+class DuplicateFilter(object):
+    """Remembers the requests of each device which were already handled.
+
+    Devices number their requests, and retransmit the ones not acked in time.
+    Per device, the filter keeps the highest sequence number handled and a
+    bitmask of the `window` numbers below it, like an anti-replay window. A
+    device starts a session with an attach request, whose number it picks at
+    random: any other attach number starts a new session.
+    """
+
+    def __init__(self, window=64):
+        self.window = window
+        self.devices = {}   # device_id: [session seq, highest seq, bitmask]
+        self.stats = {'duplicates': 0, 'sessions': 0}
+
+    def seen(self, device_id, seq, action):
+        """Tells if the request seq of device_id was handled already."""
+        state = self.devices.get(device_id)
+        if state is None:
+            return False
+        if action == 'attach':
+            seen = seq == state[0]
+        else:
+            behind = (state[1] - seq) % SEQ_MODULO
+            if behind >= SEQ_MODULO // 2:
+                # Ahead of the highest seq
+                seen = False
+            else:
+                # Requests older than the window are taken as duplicates
+                seen = behind >= self.window or bool(state[2] >> behind & 1)
+        if seen:
+            self.stats['duplicates'] += 1
+        return seen
+
+    def handled(self, device_id, seq, action):
+        """Records that the request seq of device_id was handled."""
+        state = self.devices.get(device_id)
+        if action == 'attach' or state is None:
+            self.devices[device_id] = [seq, seq, 1]
+            self.stats['sessions'] += 1
+            return
+        ahead = (seq - state[1]) % SEQ_MODULO
+        if ahead < SEQ_MODULO // 2:
+            state[1] = seq
+            state[2] = (state[2] << ahead | 1) & ((1 << self.window) - 1)
+        elif SEQ_MODULO - ahead < self.window:
+            state[2] |= 1 << (SEQ_MODULO - ahead)
+
+    def stats_str(self):
+        return 'devices {}, sessions {sessions}, duplicates {duplicates}'.format(
+            len(self.devices), **self.stats)
+# [END duplicate_filter]
+
+
+# [START payload_compression]
+# Compressed event payloads:
+#   header: magic, encoding code, ID of the dictionary (!BBI)
+#   body: the payload (JSON or binary frame) compressed with the dictionary
+# The magic byte starts neither JSON nor binary frames (FRAME_MAGIC).
+COMPRESSED_MAGIC = 0xB6
+COMPRESSED_HEADER = struct.Struct('!BBI')
+COMPRESSION_CODES = {'zlib': 1, 'zstd': 2}
+
+# Room for the payload in the zlib window, after the dictionary, in bytes
+ZLIB_WINDOW_MARGIN = 2048
+ZLIB_MEM_LEVEL = 4
+
+
+def dictionary_id(dictionary):
+    """Returns the ID of a dictionary, as decoders look it up."""
+    return zlib.crc32(dictionary) & 0xffffffff
+
+
+class PayloadCompressor(object):
+    """Compresses event payloads with a dictionary trained on telemetry.
+
+    Events are small and alike, so compressed on their own they barely shrink:
+    the dictionary (see bench_compression.py) holds the strings they share.
+    The zlib compressor is primed with the dictionary once and copied for
+    every payload, decoders inflate it with a window of 15 bits. A payload
+    the compression does not make smaller is published as is, decoders take
+    both.
+    """
+
+    def __init__(self, encoding, dictionary, level=None):
+        self.encoding = encoding
+        self.header = COMPRESSED_HEADER.pack(
+            COMPRESSED_MAGIC, COMPRESSION_CODES[encoding], dictionary_id(dictionary))
+        if encoding == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression needs the zstandard package')
+            self.zstd = zstandard.ZstdCompressor(
+                level=3 if level is None else level,
+                dict_data=zstandard.ZstdCompressionDict(dictionary),
+                write_checksum=False, write_dict_id=False)
+        else:
+            # Raw deflate, the header carries what the zlib wrapper would. The
+            # window holds the dictionary and a batch of events: smaller than
+            # the default, with less memory, it is much cheaper to copy.
+            window_bits = min(max((len(dictionary) + ZLIB_WINDOW_MARGIN).bit_length(), 9), 15)
+            self.primed = zlib.compressobj(
+                6 if level is None else level, zlib.DEFLATED, -window_bits,
+                ZLIB_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+        self.stats = {
+            'compressed': 0,
+            'uncompressed': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    def compress_body(self, data):
+        if self.encoding == 'zstd':
+            return self.zstd.compress(data)
+        compressor = self.primed.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def compress(self, payload):
+        """Returns the payload to publish, bytes."""
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf8')
+        compressed = self.header + self.compress_body(payload)
+        self.stats['bytes_in'] += len(payload)
+        if len(compressed) >= len(payload):
+            self.stats['uncompressed'] += 1
+            self.stats['bytes_out'] += len(payload)
+            return payload
+        self.stats['compressed'] += 1
+        self.stats['bytes_out'] += len(compressed)
+        return compressed
+
+    def stats_str(self):
+        ratio = (self.stats['bytes_in'] / float(self.stats['bytes_out'])
+                 if self.stats['bytes_out'] else 0)
+        return '{} ratio {:.2f}, '.format(self.encoding, ratio) + ', '.join(
+            '{} {}'.format(key, value) for key, value in self.stats.items())
+# [END payload_compression]
+
+
+def forward_event(device_id, payload):
+    """Hands a device event, or a batch of events, over for publishing.
+
+    Events go to the spool while the gateway is disconnected, while older
+    events are still to be replayed, or when the outbound queue is full.
+    Returns False if the event was dropped.
+    """
+    if gateway_state.compressor is not None:
+        payload = gateway_state.compressor.compress(payload)
+    spool = gateway_state.spool
+    outbound = gateway_state.outbound
+    if spool is not None and (not gateway_state.connected or spool.backlog
+                              or outbound.is_full()):
+        return spool.append(device_id, payload)
+    return outbound.offer(device_id, payload)
+
+
+
+# [START event_loop]
+# Upper bound of datagrams handled per wakeup, so a flood of device traffic
+# cannot starve the MQTT socket and the timers.
+MAX_DATAGRAMS_PER_WAKEUP = 1024
+
+# Paho needs loop_misc() about once a second for keepalive and retries.
+MISC_INTERVAL = 1.0
+
+
+class Timer(object):
+    """Handle returned by EventLoop.call_later()."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """Single threaded I/O loop for the gateway.
+
+    The UDP socket facing the devices and the sockets of the Paho MQTT clients
+    are multiplexed with selectors, so the gateway only wakes up when one of
+    them is ready or a timer is due. Every wakeup drains all the datagrams
+    pending on the UDP socket.
+    """
+
+    def __init__(self, udp_sock, on_datagram):
+        self.selector = selectors.DefaultSelector()
+        self.udp_sock = udp_sock
+        self.on_datagram = on_datagram
+        self.udp_paused = False
+        self.udp_pause_reasons = set()
+        self.selector.register(udp_sock, selectors.EVENT_READ, None)
+
+        # The key is the Paho client, the value is the socket registered for it
+        self.clients = {}
+
+        # Other sockets to watch, the value is called when they are readable
+        self.readers = {}
+
+        self.timers = []
+        self.timer_seq = itertools.count()
+        self.last_misc = 0
+        self.running = False
+
+    # UDP socket
+    def pause_udp(self, reason):
+        """Stop reading datagrams, they are kept in the kernel buffer.
+
+        Reading stays paused until every reason given here is resumed."""
+        self.udp_pause_reasons.add(reason)
+        if not self.udp_paused:
+            self.udp_paused = True
+            self.selector.unregister(self.udp_sock)
+
+    def resume_udp(self, reason):
+        self.udp_pause_reasons.discard(reason)
+        if self.udp_paused and not self.udp_pause_reasons:
+            self.udp_paused = False
+            self.selector.register(self.udp_sock, selectors.EVENT_READ, None)
+
+    def drain_udp(self):
+        """Handle all datagrams pending on the UDP socket."""
+        count = 0
+        while count < MAX_DATAGRAMS_PER_WAKEUP and not self.udp_paused:
+            try:
+                data, client_addr = self.udp_sock.recvfrom(BUFSIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except socket.error as e:
+                # e.g. ICMP port unreachable from a device which went away
+                logger.debug('UDP receive error {}'.format(e))
+                continue
+            count += 1
+            try:
+                self.on_datagram(data, client_addr)
+            except Exception:
+                logger.exception('Error handling datagram from {}'.format(client_addr))
+        return count
+
+    def add_reader(self, sock, callback):
+        self.readers[sock] = callback
+        self.selector.register(sock, selectors.EVENT_READ, None)
+
+    # MQTT clients
+    def add_client(self, client):
+        self.clients[client] = None
+        self.sync_client(client)
+
+    def remove_client(self, client):
+        sock = self.clients.pop(client, None)
+        if sock is not None:
+            self.unregister_socket(sock)
+
+    def unregister_socket(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def sync_client(self, client):
+        """Keep the selector in line with the socket Paho currently uses."""
+        registered = self.clients[client]
+        sock = client.socket()
+        if sock is not registered:
+            if registered is not None:
+                self.unregister_socket(registered)
+            self.clients[client] = sock
+            if sock is None:
+                return
+            self.selector.register(sock, selectors.EVENT_READ, client)
+        elif sock is None:
+            return
+
+        events = selectors.EVENT_READ
+        if client.want_write():
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(sock).events != events:
+            self.selector.modify(sock, events, client)
+
+    # Timers
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds, returns a Timer."""
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.deadline, next(self.timer_seq), timer))
+        return timer
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception('Error in timer {}'.format(timer.callback))
+
+    def next_timeout(self):
+        now = time.time()
+        timeout = self.last_misc + MISC_INTERVAL - now
+        if self.timers:
+            timeout = min(timeout, self.timers[0][0] - now)
+        return max(timeout, 0)
+
+    # Main loop
+    def run_once(self):
+        for client in list(self.clients):
+            self.sync_client(client)
+
+        timeout = self.next_timeout()
+
+        # TLS may hold already decrypted bytes which select() cannot see.
+        pending = [c for c, sock in self.clients.items()
+                   if sock is not None and hasattr(sock, 'pending') and sock.pending()]
+        if pending:
+            timeout = 0
+
+        for key, mask in self.selector.select(timeout):
+            client = key.data
+            if client is None:
+                if key.fileobj is self.udp_sock:
+                    self.drain_udp()
+                else:
+                    self.readers[key.fileobj]()
+                continue
+            if client not in self.clients:
+                continue
+            if mask & selectors.EVENT_READ:
+                client.loop_read()
+            if mask & selectors.EVENT_WRITE and client in self.clients:
+                client.loop_write()
+
+        for client in pending:
+            if client in self.clients:
+                client.loop_read()
+
+        self.run_timers()
+
+        now = time.time()
+        if now - self.last_misc >= MISC_INTERVAL:
+            self.last_misc = now
+            for client in list(self.clients):
+                client.loop_misc()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+# [END event_loop]
 
 
 # [START parse_command_line_args]
+def positive_float(value):
+    """argparse type of the arguments which must be above 0."""
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError('{} is not above 0'.format(value))
+    return number
+
+
 def parse_command_line_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description=(
@@ -332,118 +2615,765 @@ def parse_command_line_args():
         help='MQTT bridge hostname.')
     parser.add_argument(
         '--mqtt_bridge_port',
-        choices=(8883, 443),
         default=8883,
         type=int,
-        help='MQTT bridge port.')
+        help='MQTT bridge port: 8883 or 443 for the Google MQTT bridge.')
+    parser.add_argument(
+        '--no_tls',
+        action='store_true',
+        help=('Connect to the MQTT bridge without TLS. Only for a local broker, '
+              'e.g. bench_broker.py.'))
     parser.add_argument(
         '--jwt_expires_minutes',
         default=1200,
         type=int,
         help=('Expiration time, in minutes, for JWT tokens.'))
-
-    return parser.parse_args()
+    parser.add_argument(
+        '--host',
+        default=HOST,
+        help='Address the UDP socket facing the devices is bound to.')
+    parser.add_argument(
+        '--port',
+        default=PORT,
+        type=int,
+        help='Port of the UDP socket facing the devices.')
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help=('Number of gateway processes sharing the UDP port, each with its '
+              'own MQTT connection. Devices are pinned to a worker by device ID.'))
+    parser.add_argument(
+        '--worker_gateway_id',
+        default='{gateway_id}-{worker}',
+        help=('Gateway ID of each worker, formatted with gateway_id and worker '
+              '(its index). Devices must be bound to every worker gateway.'))
+    parser.add_argument(
+        '--binary_events',
+        choices=('json', 'forward'),
+        default='json',
+        help=('Publish the events received as binary frames converted to the '
+              'JSON of pi_device, or forward the frames unchanged.'))
+    parser.add_argument(
+        '--event_qos',
+        choices=(0, 1),
+        default=0,
+        type=int,
+        help=('QoS used to publish device events. With 1, an event stays in '
+              'flight, and in the spool, until the bridge acknowledges it.'))
+    parser.add_argument(
+        '--max_inflight',
+        default=20,
+        type=int,
+        help='Maximum number of device events published and not yet acknowledged.')
+    parser.add_argument(
+        '--max_queued',
+        default=10000,
+        type=int,
+        help='Maximum number of device events waiting to be published.')
+    parser.add_argument(
+        '--queue_full_policy',
+        choices=QUEUE_FULL_POLICIES,
+        default='drop_oldest',
+        help='What to do with device events when the outbound queue is full.')
+    parser.add_argument(
+        '--spool_dir',
+        help=('Directory where device events are stored while the gateway '
+              'cannot publish them. Without it, they are not read from the '
+              'devices while disconnected.'))
+    parser.add_argument(
+        '--spool_segment_bytes',
+        default=4 * 1024 * 1024,
+        type=int,
+        help='Size, in bytes, of each spool file.')
+    parser.add_argument(
+        '--spool_max_bytes',
+        default=256 * 1024 * 1024,
+        type=int,
+        help='Maximum disk space, in bytes, used by the spool.')
+    parser.add_argument(
+        '--spool_replay_rate',
+        default=500,
+        type=int,
+        help='Maximum number of spooled events replayed per second.')
+    parser.add_argument(
+        '--spool_sync_ms',
+        default=1000,
+        type=int,
+        help='Interval, in milliseconds, between two syncs of the spool to disk.')
+    parser.add_argument(
+        '--batch_max_events',
+        default=1,
+        type=int,
+        help=('Publish device events in batches of up to this many events. '
+              '1 publishes every event on its own.'))
+    parser.add_argument(
+        '--batch_max_bytes',
+        default=16384,
+        type=int,
+        help='Maximum payload size, in bytes, of a batch of events.')
+    parser.add_argument(
+        '--batch_max_linger_ms',
+        default=1000,
+        type=int,
+        help='Maximum time, in milliseconds, an event waits in a batch.')
+    parser.add_argument(
+        '--aggregate_interval',
+        default=0,
+        type=int,
+        help=('Interval, in seconds, between two summaries of the readings of '
+              'each device, published instead of the readings. 0 publishes '
+              'all the readings. Readings are published as JSON events.'))
+    parser.add_argument(
+        '--aggregate_window',
+        type=int,
+        help=('Seconds of readings a summary covers, a multiple of '
+              '--aggregate_interval, by default the interval.'))
+    parser.add_argument(
+        '--aggregate_rules',
+        help=('Alert rules of the Beam pipeline, e.g. '
+              'data-processing/beam/alert_rules.json: the readings of an '
+              'incident, from the one triggering a rule to the one clearing '
+              'it, are published too.'))
+    parser.add_argument(
+        '--aggregate_context',
+        default=10,
+        type=int,
+        help='Readings published before and after those of an incident.')
+    parser.add_argument(
+        '--duplicate_window',
+        default=64,
+        type=int,
+        help=('Number of recent request numbers remembered per device, to '
+              'acknowledge retransmitted requests without handling them again.'))
+    parser.add_argument(
+        '--stats_interval',
+        default=60,
+        type=int,
+        help='Interval, in seconds, between two logs of the gateway stats.')
+    parser.add_argument(
+        '--metrics_host',
+        default='127.0.0.1',
+        help='Address the HTTP endpoint of the metrics is bound to.')
+    parser.add_argument(
+        '--metrics_port',
+        default=9300,
+        type=int,
+        help=('Port of the HTTP endpoint serving the metrics at /metrics, in '
+              'the Prometheus text format. Worker N listens on this port + N. '
+              '0 disables the endpoint.'))
+    parser.add_argument(
+        '--metrics_max_devices',
+        default=1000,
+        type=int,
+        help=('Number of devices with their own event counter, the other '
+              'devices are counted together.'))
+    parser.add_argument(
+        '--compress',
+        choices=('none', 'zlib', 'zstd'),
+        default='none',
+        help=('Compression of the event payloads, with --compress_dictionary. '
+              'zstd needs the zstandard package. The decoders, Dataflow and '
+              'the Cloud Function, need the dictionary too.'))
+    parser.add_argument(
+        '--compress_dictionary',
+        help='Dictionary trained on recorded events, by bench_compression.py.')
+    parser.add_argument(
+        '--compress_level',
+        type=int,
+        help='Compression level, by default 6 for zlib and 3 for zstd.')
+    parser.add_argument(
+        '--downlink_rate',
+        default=1000,
+        type=positive_float,
+        help='Configs and commands relayed to the devices per second, at most.')
+    parser.add_argument(
+        '--downlink_burst',
+        default=100,
+        type=int,
+        help='Configs and commands relayed to the devices at once, at most.')
+    parser.add_argument(
+        '--downlink_max_queued',
+        default=10000,
+        type=int,
+        help='Commands waiting to be relayed, beyond which they are dropped.')
+    parser.add_argument(
+        '--device_public_keys',
+        help=('Path of the public key, or X.509 certificate, of each device '
+              'in PEM, with {device_id} in place of the device ID, e.g. '
+              '"keys/{device_id}.pem". When set, devices must attach with a '
+              'JWT signed by their key.'))
+    parser.add_argument(
+        '--device_algorithms',
+        nargs='+',
+        choices=('RS256', 'ES256'),
+        default=['RS256', 'ES256'],
+        help='Algorithms accepted for the JWTs of the devices.')
+    parser.add_argument(
+        '--device_auth_cache_size',
+        default=100000,
+        type=int,
+        help='Number of verified device JWTs kept until they expire.')
+    parser.add_argument(
+        '--device_auth_workers',
+        default=4,
+        type=int,
+        help='Number of threads verifying the signatures of device JWTs.')
+    parser.add_argument(
+        '--device_auth_max_pending',
+        default=10000,
+        type=int,
+        help=('Number of device JWTs waiting to be verified, beyond which '
+              'attaches are answered busy.'))
+    parser.add_argument(
+        '--log_sample_interval',
+        default=1.0,
+        type=float,
+        help=('Interval, in seconds, between two logs of each per-message log '
+              'line, e.g. the events received and published. 0 logs them all.'))
+
+    args = parser.parse_args()
+    if args.compress != 'none' and not args.compress_dictionary:
+        parser.error('--compress needs a --compress_dictionary')
+    if args.aggregate_window and (not args.aggregate_interval
+                                  or args.aggregate_window % args.aggregate_interval):
+        parser.error('--aggregate_window must be a multiple of --aggregate_interval')
+    if args.downlink_burst < 1:
+        parser.error('--downlink_burst must be at least 1')
+    return args
 # [END parse_command_line_args]
 
-# [START iot_mqtt_run]
-def main():
-    global gateway_state
+# [START binary_protocol]
+# Binary frames exchanged with the devices, next to the JSON messages:
+#   header: magic, version, action code, length of the device id (!BBBB)
+#   device id, UTF-8
+#   version 2 only: sequence number of the request, or of the acked one (!I)
+#   event body: samples (timestamp, x, y, z) back to back (!dfff)
+#   ack body: acked action code, status code (!BB)
+# The versions of the format are negotiated on attach as 'bin1' and 'bin2'.
+FRAME_MAGIC = 0xB5
+FRAME_VERSION = 2
+FRAME_FORMAT = 'bin2'
+FRAME_FORMATS = {'bin1': 1, 'bin2': 2}
+FRAME_HEADER = struct.Struct('!BBBB')
+FRAME_SEQ = struct.Struct('!I')
+FRAME_SAMPLE = struct.Struct('!dfff')
+FRAME_ACK = struct.Struct('!BB')
 
-    args = parse_command_line_args()
+FRAME_ACTIONS = {1: 'attach', 2: 'detach', 3: 'subscribe', 4: 'event', 5: 'ack'}
+FRAME_ACTION_CODES = dict((action, code) for code, action in FRAME_ACTIONS.items())
+FRAME_STATUS_CODES = {'ok': 0, 'busy': 1, 'error': 2}
 
-    client = get_client(
-        args.project_id, args.cloud_region, args.registry_id, args.gateway_id,
-        args.private_key_file, args.algorithm, args.ca_certs,
-        args.mqtt_bridge_hostname, args.mqtt_bridge_port,
-        args.jwt_expires_minutes)
 
-    gateway_state.gateway_id = args.gateway_id
+def is_frame(data):
+    return data[:1] == bytes((FRAME_MAGIC,))
 
-    jwt_iat = datetime.datetime.utcnow()
-    jwt_exp_mins = args.jwt_expires_minutes
 
-    while True:
-        client.loop()        
+def negotiate_format(formats):
+    """Returns the most recent frame format offered by a device, or None."""
+    offered = [f for f in formats if f in FRAME_FORMATS]
+    if not offered:
+        return None
+    return max(offered, key=FRAME_FORMATS.get)
+
+
+def decode_frame(data):
+    """Returns the (action, device_id, seq, body) of a binary frame.
+
+    seq is None for the frames of version 1.
+
+    Raises:
+        ValueError: If data is not a valid frame.
+    """
+    if len(data) < FRAME_HEADER.size:
+        raise ValueError('truncated frame')
+    magic, version, code, id_length = FRAME_HEADER.unpack_from(data)
+    if (magic != FRAME_MAGIC or version not in FRAME_FORMATS.values()
+            or code not in FRAME_ACTIONS):
+        raise ValueError('unknown frame')
+    body_start = FRAME_HEADER.size + id_length
+    seq = None
+    if version >= 2:
+        body_start += FRAME_SEQ.size
+    if len(data) < body_start:
+        raise ValueError('truncated frame')
+    device_id = data[FRAME_HEADER.size:FRAME_HEADER.size + id_length].decode('utf8')
+    if version >= 2:
+        seq, = FRAME_SEQ.unpack_from(data, body_start - FRAME_SEQ.size)
+    return FRAME_ACTIONS[code], device_id, seq, data[body_start:]
+
+
+def decode_samples(body):
+    """Returns the list of (timestamp, x, y, z) of an event body."""
+    if len(body) % FRAME_SAMPLE.size:
+        raise ValueError('truncated sample')
+    return list(FRAME_SAMPLE.iter_unpack(body))
+
+
+def samples_to_json(device_id, samples):
+    """Renders samples like the JSON events of pi_device, an array if several."""
+    events = [
+        '{{"device_id": "{}", "event_time": "{}", "raw_accelerometer_data": '
+        '"x={}, y={}, z={}"}}'.format(
+            device_id, time.asctime(time.gmtime(timestamp)),
+            float('%.6g' % x), float('%.6g' % y), float('%.6g' % z))
+        for timestamp, x, y, z in samples]
+    if len(events) == 1:
+        return events[0]
+    return '[{}]'.format(','.join(events))
+
+
+def encode_ack(device_id, action, status, seq=None):
+    """Encodes an ack, of version 2 when it acks the request seq."""
+    device = device_id.encode('utf8')
+    version = 1 if seq is None else 2
+    return (FRAME_HEADER.pack(FRAME_MAGIC, version, FRAME_ACTION_CODES['ack'], len(device))
+            + device
+            + (b'' if seq is None else FRAME_SEQ.pack(seq))
+            + FRAME_ACK.pack(FRAME_ACTION_CODES[action], FRAME_STATUS_CODES[status]))
+# [END binary_protocol]
 
-        # Loop until gateway is connected
-        if gateway_state.connected is False:
-            logger.info('connect status {}'.format(gateway_state.connected))
-            time.sleep(1)
-            continue
 
-        # Gateway connected!
-        # Any data receiving from the device?
+# [START iot_mqtt_run]
+def run_control(fn, *args):
+    """Runs fn(client, *args) now, or once the gateway is connected again.
+
+    Paho must not be used while the ReconnectScheduler reconnects it."""
+    if gateway_state.connected:
+        fn(gateway_state.client, *args)
+    else:
+        gateway_state.pending_control.append((fn, args))
+
+
+def refuse_event():
+    """Returns True if device events must be refused, with the nack policy."""
+    outbound = gateway_state.outbound
+    if (outbound.policy == 'nack' and outbound.is_full()
+            and gateway_state.spool is None):
+        outbound.stats['nacked'] += 1
+        return True
+    return False
+
+
+def accept_event(device_id, payload, batch=True):
+    """Takes a device event in, returns the status to reply to the device."""
+    metrics.count_event(device_id)
+    if refuse_event():
+        return 'busy'
+    if batch and gateway_state.batcher is not None:
+        gateway_state.batcher.add(device_id, payload)
+        return 'ok'
+    if not forward_event(device_id, payload):
+        return 'busy'
+    return 'ok'
+
+
+def accept_readings(device_id, readings):
+    """Takes the readings of a device event in, (x, y, z, event) tuples, for
+    the EdgeAggregator. Returns the status to reply to the device."""
+    metrics.count_event(device_id)
+    if refuse_event():
+        return 'busy'
+    if readings:
+        gateway_state.aggregator.add(device_id, readings)
+    return 'ok'
+
+
+def event_readings(device_id, data):
+    """Returns the (x, y, z, event) of the JSON events of data, an event or
+    an array of them. The events without readings are published as is."""
+    readings = []
+    for event in data if isinstance(data, list) else [data]:
         try:
-            data, client_addr = udpSerSock.recvfrom(BUFSIZE)
-        except socket.error:
+            x, y, z = parse_axes(event["raw_accelerometer_data"])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            publish_reading(device_id, event)
             continue
-        logger.info('From Address {}:{} receive data: {}'.format(
-                client_addr[0], client_addr[1], data.decode("utf-8")))
+        readings.append((x, y, z, event))
+    return readings
 
-        # Yes, receive something from device
-        command = json.loads(data.decode('utf-8'))
-        if not command:
-            logger.info('invalid json command {}'.format(data))
-            continue
 
-        action = command["action"]
-        device_id = command["device"]
-        template = '{{ "device": "{}", "command": "{}", "status" : "ok" }}'
+def publish_reading(device_id, event):
+    """Publishes an event let through by the EdgeAggregator, a JSON event or
+    a sample of a binary frame."""
+    if isinstance(event, tuple):
+        payload = samples_to_json(device_id, [event])
+    else:
+        payload = json.dumps(event)
+    if gateway_state.batcher is not None:
+        gateway_state.batcher.add(device_id, payload)
+    else:
+        forward_event(device_id, payload)
 
-        if action == 'attach':
-            auth = ''  # TODO:    auth = command["jwt"]
-            attach_device(client, device_id, auth)
-
-            # Reply to the device
-            message = template.format(device_id, action)
-            logger.debug('Sending data over UDP {} {}'.format(client_addr, message))
-            udpSerSock.sendto(message.encode('utf8'), client_addr)
-        elif action == 'detach':
-            detach_device(client, device_id)
-
-            # Reply to the device
-            message = template.format(device_id, action)
-            logger.debug('Sending data over UDP {} {}'.format(client_addr, message))
-            udpSerSock.sendto(message.encode('utf8'), client_addr)
-        elif action == 'subscribe':
-            subscribe_device(client, device_id, client_addr)
-
-            # Reply to the device
-            message = template.format(device_id, action)
-            logger.debug('Sending data over UDP {} {}'.format(client_addr, message))
-            udpSerSock.sendto(message.encode('utf8'), client_addr)
-        elif action == 'event':
-            payload = "{}".format(json.dumps(command["data"]))      # To get double_quote in json output
-            sendevent_device(client, device_id, payload)
 
-            # Reply to the device
-            message = template.format(device_id, action)
-            logger.debug('Sending data over UDP {} {}'.format(client_addr, message))
-            udpSerSock.sendto(message.encode('utf8'), client_addr)
+def handle_frame(client, data, client_addr, forwarded=False):
+    """Process one binary frame received from a device over UDP."""
+    try:
+        action, device_id, seq, body = decode_frame(data)
+        samples = decode_samples(body) if action == 'event' else None
+    except ValueError as e:
+        metrics.invalid_datagrams.inc()
+        logger.info('invalid frame from {}: {}'.format(client_addr, e))
+        return
+
+    worker = gateway_state.worker
+    if worker is not None and not forwarded and not worker.owns(device_id):
+        worker.forward(device_id, data, client_addr)
+        return
+
+    if action != 'event':
+        metrics.invalid_datagrams.inc()
+        logger.info('undefined binary action: {}'.format(action))
+        return
+
+    duplicates = gateway_state.duplicates
+    if seq is not None and duplicates.seen(device_id, seq, action):
+        # Handled already, the device lost the ack
+        status = 'ok'
+        metrics.requests.inc((action, 'duplicate'))
+    else:
+        if gateway_state.aggregator is not None:
+            status = accept_readings(
+                device_id, [(x, y, z, (t, x, y, z)) for t, x, y, z in samples])
+        elif gateway_state.binary_events == 'forward':
+            # Published unchanged, the frame may hold several samples already
+            status = accept_event(device_id, data, batch=False)
         else:
-            logger.info('undefined action: {}'.format(action))
+            status = accept_event(device_id, samples_to_json(device_id, samples))
+        if seq is not None and status == 'ok':
+            duplicates.handled(device_id, seq, action)
+        metrics.requests.inc((action, status))
 
+    udpSerSock.sendto(encode_ack(device_id, action, status, seq), client_addr)
+    metrics.datagrams_sent.inc(('reply',))
 
-        # Refresh token if needed
-        seconds_since_issue = (datetime.datetime.utcnow() - jwt_iat).seconds
-        if seconds_since_issue > 60 * jwt_exp_mins:
-            logger.info('Refreshing token after {}s'.format(seconds_since_issue))
-            jwt_iat = datetime.datetime.utcnow()
-            client.loop()
-            client.disconnect()
-            client = get_client(
-                    args.project_id, args.cloud_region, args.registry_id, args.gateway_id,
-                    args.private_key_file, args.algorithm, args.ca_certs,
-                    args.mqtt_bridge_hostname, args.mqtt_bridge_port,
-                    args.jwt_expires_minutes)
 
-        time.sleep(1)
+def handle_datagram(client, data, client_addr, forwarded=False):
+    """Process one datagram received from a device over UDP.
+
+    forwarded tells the datagram comes from another worker."""
+    frame = is_frame(data)
+    if not forwarded:
+        # Counted once, by the worker receiving it from the device
+        metrics.datagrams_received.inc(('frame' if frame else 'json',))
+        metrics.bytes_received.inc(amount=len(data))
+    if frame:
+        handle_frame(client, data, client_addr, forwarded)
+        return
+
+    # Yes, receive something from device
+    try:
+        text = data.decode('utf-8')
+        datagram_log.info('From Address {}:{} receive data: {}',
+                          client_addr[0], client_addr[1], text)
+        command = json.loads(text)
+    except ValueError:
+        command = None
+    if not command:
+        metrics.invalid_datagrams.inc()
+        logger.info('invalid json command {}'.format(data))
+        return
+
+    if (not isinstance(command, dict) or not isinstance(command.get("action"), str)
+            or not isinstance(command.get("device"), str)
+            or command["action"] == 'event' and "data" not in command):
+        metrics.invalid_datagrams.inc()
+        logger.info('incomplete command {}'.format(data))
+        return
+
+    action = command["action"]
+    device_id = command["device"]
+    seq = command.get("seq")
+
+    worker = gateway_state.worker
+    if worker is not None and not forwarded and not worker.owns(device_id):
+        worker.forward(device_id, data, client_addr)
+        return
+
+    status = 'ok'
+    extra = ''
+
+    if action == 'attach':
+        # Tell the device which binary frames it may send
+        frame_format = negotiate_format(command.get("formats", ()))
+        if frame_format:
+            extra = ', "format": "{}"'.format(frame_format)
+    if seq is not None:
+        extra += ', "seq": {}'.format(seq)
+
+    duplicates = gateway_state.duplicates
+    duplicate = seq is not None and duplicates.seen(device_id, seq, action)
+    if duplicate:
+        # Handled already, the device lost the reply
+        logger.debug('Duplicate %s #%s of %s', action, seq, device_id)
+    elif action == 'attach':
+        auth = command.get("jwt", '')
+        authenticator = gateway_state.authenticator
+        if authenticator is not None:
+            def on_verified(status):
+                if status == 'ok':
+                    run_control(attach_device, device_id, auth)
+                reply_request(device_id, action, seq, status, extra, client_addr)
+
+            authenticator.verify(device_id, auth, on_verified)
+            return
+        run_control(attach_device, device_id, auth)
+    elif action == 'detach':
+        if gateway_state.batcher is not None:
+            gateway_state.batcher.flush(device_id, 'detach')
+        run_control(detach_device, device_id)
+    elif action == 'subscribe':
+        run_control(subscribe_device, device_id, client_addr)
+        gateway_state.downlinks.serve(device_id, client_addr)
+    elif action == 'event':
+        if gateway_state.aggregator is not None:
+            status = accept_readings(device_id, event_readings(device_id, command["data"]))
+        else:
+            payload = "{}".format(json.dumps(command["data"]))      # To get double_quote in json output
+            status = accept_event(device_id, payload)
+    else:
+        metrics.invalid_datagrams.inc()
+        logger.info('undefined action: {}'.format(action))
+        return
+
+    reply_request(device_id, action, seq, status, extra, client_addr, duplicate)
+
+
+def reply_request(device_id, action, seq, status, extra, client_addr, duplicate=False):
+    """Records the outcome of a JSON request, and replies to the device."""
+    if seq is not None and not duplicate and status == 'ok':
+        gateway_state.duplicates.handled(device_id, seq, action)
+    metrics.requests.inc((action, 'duplicate' if duplicate else status))
+
+    # Reply to the device
+    template = '{{ "device": "{}", "command": "{}", "status" : "{}"{} }}'
+    message = template.format(device_id, action, status, extra)
+    logger.debug('Sending data over UDP %s %s', client_addr, message)
+    udpSerSock.sendto(message.encode('utf8'), client_addr)
+    metrics.datagrams_sent.inc(('reply',))
+
 
+def run_gateway(args, worker=None):
+    """Runs one gateway, or one of the workers when worker is given."""
+    global gateway_state
+    global udpSerSock
+
+    gateway_id = args.gateway_id
+    spool_dir = args.spool_dir
+    if worker is not None:
+        # Each worker is a gateway of its own, devices are bound to all of them
+        gateway_id = args.worker_gateway_id.format(
+            gateway_id=args.gateway_id, worker=worker.index)
+        if spool_dir:
+            spool_dir = os.path.join(spool_dir, 'worker-{}'.format(worker.index))
+        formatter = logging.Formatter(
+            '%(asctime)s - %(levelname)s - [worker {}] %(message)s'.format(worker.index))
+        ch.setFormatter(formatter)
+
+    gateway_state.gateway_id = gateway_id
+    gateway_state.worker = worker
+    gateway_state.binary_events = args.binary_events
+
+    udpSerSock = create_udp_socket((args.host, args.port), reuse_port=worker is not None)
+
+    def on_datagram(data, client_addr):
+        handle_datagram(gateway_state.client, data, client_addr)
+
+    event_loop = EventLoop(udpSerSock, on_datagram)
+    gateway_state.event_loop = event_loop
+
+    if worker is not None:
+        def on_forwarded(data, client_addr):
+            handle_datagram(gateway_state.client, data, client_addr, forwarded=True)
+
+        event_loop.add_reader(worker.inbox, lambda: worker.receive(on_forwarded))
+
+    # Stop cleanly, flushing batches and the spool
+    signal.signal(signal.SIGTERM, lambda signum, frame: event_loop.stop())
+    gateway_state.reconnector = ReconnectScheduler(
+        event_loop, MINIMUM_BACKOFF_TIME, MAXIMUM_BACKOFF_TIME)
+
+    def publish_event(device_id, payload, qos):
+        return sendevent_device(gateway_state.client, device_id, payload, qos)
+
+    if spool_dir:
+        gateway_state.spool = Spool(
+            spool_dir, args.spool_segment_bytes, args.spool_max_bytes)
+
+    gateway_state.outbound = OutboundQueue(
+        event_loop, publish_event, args.event_qos, args.max_inflight,
+        args.max_queued, args.queue_full_policy,
+        on_complete=gateway_state.spool.ack if gateway_state.spool else None)
+
+    if args.batch_max_events > 1:
+        gateway_state.batcher = EventBatcher(
+            event_loop, forward_event, args.batch_max_events,
+            args.batch_max_bytes, args.batch_max_linger_ms / 1000.0)
+
+    gateway_state.duplicates = DuplicateFilter(args.duplicate_window)
+
+    if args.aggregate_interval:
+        rules = load_alert_rules(args.aggregate_rules) if args.aggregate_rules else []
+        gateway_state.aggregator = EdgeAggregator(
+            event_loop, publish_reading, forward_event, rules,
+            args.aggregate_interval, args.aggregate_window or args.aggregate_interval,
+            args.aggregate_context)
+
+    if args.compress != 'none':
+        with open(args.compress_dictionary, 'rb') as f:
+            gateway_state.compressor = PayloadCompressor(
+                args.compress, f.read(), args.compress_level)
+
+    def send_downlink(payload, client_addr):
+        udpSerSock.sendto(payload.encode('utf8'), client_addr)
+        metrics.datagrams_sent.inc(('relay',))
+
+    gateway_state.downlinks = DownlinkRelay(
+        event_loop, send_downlink, args.downlink_rate, args.downlink_burst,
+        args.downlink_max_queued)
+
+    if args.device_public_keys:
+        gateway_state.authenticator = DeviceAuthenticator(
+            event_loop, args.device_public_keys, args.project_id,
+            args.device_algorithms, args.device_auth_cache_size,
+            args.device_auth_workers, args.device_auth_max_pending)
+
+    SampledLogger.interval = args.log_sample_interval
+    metrics.max_devices = args.metrics_max_devices
+    add_component_metrics()
+    if args.metrics_port:
+        metrics_port = args.metrics_port + (worker.index if worker is not None else 0)
+        MetricsServer(event_loop, (args.metrics_host, metrics_port))
+
+    def log_stats():
+        logger.info('[Stats] Outbound: {}'.format(
+            gateway_state.outbound.stats_str()))
+        logger.info('[Stats] Topics: {}'.format(
+            gateway_state.subscriptions.stats_str()))
+        logger.info('[Stats] Duplicates: {}'.format(
+            gateway_state.duplicates.stats_str()))
+        logger.info('[Stats] Downlinks: {}'.format(
+            gateway_state.downlinks.stats_str()))
+        if gateway_state.compressor is not None:
+            logger.info('[Stats] Compression: {}'.format(
+                gateway_state.compressor.stats_str()))
+        if gateway_state.batcher is not None:
+            logger.info('[Stats] Batching: {}'.format(
+                gateway_state.batcher.stats_str()))
+        if gateway_state.aggregator is not None:
+            logger.info('[Stats] Aggregation: {}'.format(
+                gateway_state.aggregator.stats_str()))
+        if gateway_state.spool is not None:
+            logger.info('[Stats] Spool: {}'.format(
+                gateway_state.spool.stats_str()))
+        if gateway_state.authenticator is not None:
+            logger.info('[Stats] Device auth: {}'.format(
+                gateway_state.authenticator.stats_str()))
+        if worker is not None:
+            logger.info('[Stats] Worker: {}'.format(worker.stats_str()))
+        event_loop.call_later(args.stats_interval, log_stats)
+
+    event_loop.call_later(args.stats_interval, log_stats)
+
+    if gateway_state.spool is not None:
+        replay_credit = [0.0]
+
+        def replay_spool():
+            # Replay at most spool_replay_rate events per second, and no more
+            # than the outbound queue has room for.
+            spool = gateway_state.spool
+            outbound = gateway_state.outbound
+            replay_credit[0] = min(
+                replay_credit[0] + args.spool_replay_rate * SPOOL_REPLAY_TICK,
+                args.spool_replay_rate)
+            if gateway_state.connected and spool.backlog:
+                count = min(int(replay_credit[0]), outbound.room())
+                for device_id, payload, position in spool.read(count):
+                    outbound.offer(device_id, payload, position)
+                replay_credit[0] -= count
+            event_loop.call_later(SPOOL_REPLAY_TICK, replay_spool)
+
+        def sync_spool():
+            gateway_state.spool.sync()
+            event_loop.call_later(args.spool_sync_ms / 1000.0, sync_spool)
+
+        event_loop.call_later(SPOOL_REPLAY_TICK, replay_spool)
+        event_loop.call_later(args.spool_sync_ms / 1000.0, sync_spool)
+    else:
+        # Device datagrams wait in the kernel buffer until the gateway is
+        # connected, on_connect resumes reading them.
+        event_loop.pause_udp('disconnected')
+
+    token_manager = TokenManager(
+        args.project_id, args.private_key_file, args.algorithm,
+        args.jwt_expires_minutes)
+    gateway_state.token_manager = token_manager
+
+    ca_certs = None if args.no_tls else args.ca_certs
+    client = get_client(
+        args.project_id, args.cloud_region, args.registry_id, gateway_id,
+        args.private_key_file, args.algorithm, ca_certs,
+        args.mqtt_bridge_hostname, args.mqtt_bridge_port,
+        args.jwt_expires_minutes, password=token_manager.take())
+    gateway_state.client = client
+    event_loop.add_client(client)
+
+    def create_handover_client(password):
+        return create_client(
+            args.project_id, args.cloud_region, args.registry_id,
+            gateway_id, password, ca_certs)
+
+    def connect_handover_client(client):
+        client.connect(args.mqtt_bridge_hostname, args.mqtt_bridge_port)
+
+    gateway_state.handover = ClientHandover(
+        event_loop, create_handover_client, connect_handover_client,
+        token_manager)
+
+    # Move to a new token before the current one expires
+    refresh_interval = 60 * args.jwt_expires_minutes * JWT_REFRESH_RATIO
+
+    def refresh_token():
+        if gateway_state.connected:
+            logger.info('Refreshing token after {:.0f}s'.format(refresh_interval))
+            gateway_state.handover.start()
+        # else the ReconnectScheduler reconnects with a fresh token
+        schedule_refresh()
+
+    def schedule_refresh():
+        event_loop.call_later(
+            max(refresh_interval - JWT_PREMINT_LEAD, 0), token_manager.prepare)
+        event_loop.call_later(refresh_interval, refresh_token)
+
+    schedule_refresh()
+
+    try:
+        event_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    if gateway_state.aggregator is not None:
+        gateway_state.aggregator.flush(time.time())
+    if gateway_state.batcher is not None:
+        gateway_state.batcher.flush_all('shutdown')
+    gateway_state.client.loop_write()
+    if gateway_state.spool is not None:
+        gateway_state.spool.close()
+    if gateway_state.authenticator is not None:
+        gateway_state.authenticator.close()
 
     logger.info('Finished.')
     # [END iot_listen_for_messages]
 
 
+def main():
+    args = parse_command_line_args()
+    if args.workers > 1:
+        supervise(args)
+    else:
+        run_gateway(args)
+
+
 if __name__ == '__main__':
     main()
 
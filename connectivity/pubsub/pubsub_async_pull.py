@@ -1,31 +1,306 @@
+"""
+Pulls the telemetry messages of a Pub/Sub subscription.
+
+Messages are handed over in batches to a handler, by a pool of threads, and
+acked once the handler returns: the client library sends the acks of a batch
+together. Flow control bounds the messages and bytes held by the program.
+
+    python pubsub_async_pull.py --project_id my-project \\
+        --subscription_name my-subscription --handler print
+
+To size the consumer without a Google Cloud project, start the Pub/Sub
+emulator (gcloud beta emulators pubsub start), export PUBSUB_EMULATOR_HOST as
+'gcloud beta emulators pubsub env-init' prints it, then publish test events
+to it and consume them:
+
+    python pubsub_async_pull.py --project_id my-project \\
+        --subscription_name my-subscription --emulator_topic telemetry-data \\
+        --publish 100000 --handler count --threads 8 --batch_size 500
+"""
+
+import argparse
+import concurrent.futures
+import importlib
+import logging
+import os
+import threading
+import time
+
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 
 project_id = ""
 subscription_name = ""
 # timeout = 120.0           # How long the subscriber should listen for messages in seconds
 
-subscriber = pubsub_v1.SubscriberClient()
-# The `subscription_path` method creates a fully qualified identifier
-# in the form `projects/{project_id}/subscriptions/{subscription_name}`
-subscription_path = subscriber.subscription_path(
-    project_id, subscription_name
-)
-
-def callback(message):
-    print("{}".format(message))
-    print("{} {}".format(message.publish_time, message.data))
-    message.ack()
-
-streaming_pull_future = subscriber.subscribe(
-    subscription_path, callback=callback
-)
-print("Listening for messages on {}..\n".format(subscription_path))
-
-# Wrap subscriber in a 'with' block to automatically call close() when done.
-with subscriber:
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logger.addHandler(log_handler)
+
+
+# [START handlers]
+def print_messages(messages):
+    """Prints the messages, once each."""
+    for message in messages:
+        print("{} {}".format(message.publish_time, message.data))
+
+
+def count_messages(messages):
+    """Does nothing: the consumer counts the messages, to size its throughput."""
+
+
+HANDLERS = {
+    'print': print_messages,
+    'count': count_messages,
+}
+
+
+def load_handler(name):
+    """Returns a handler of HANDLERS, or the function of 'module:function'."""
+    if name in HANDLERS:
+        return HANDLERS[name]
+    module_name, _, function_name = name.partition(':')
+    if not function_name:
+        raise ValueError('The handler must be one of {} or module:function'.format(
+            ', '.join(sorted(HANDLERS))))
+    return getattr(importlib.import_module(module_name), function_name)
+# [END handlers]
+
+
+# [START micro_batcher]
+class MicroBatcher(object):
+    """Collects the messages of the subscriber callbacks into batches.
+
+    A batch goes to handler(messages) once it holds batch_size messages, in
+    the callback thread that filled it, or once its first message waited
+    linger seconds, in the flusher thread. The messages are acked after the
+    handler returns, and nacked for redelivery if it raises.
+    """
+
+    def __init__(self, handler, batch_size, linger):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.linger = linger
+
+        self.lock = threading.Lock()
+        self.messages = []
+        self.deadline = None    # When the current batch must be handled
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+
+        self.stats = {
+            'messages': 0,
+            'bytes': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'handler_time': 0.0,
+        }
+
+    def start(self):
+        self.flusher.start()
+
+    def add(self, message):
+        """Subscriber callback."""
+        with self.lock:
+            self.messages.append(message)
+            if len(self.messages) == 1:
+                self.deadline = time.monotonic() + self.linger
+            if len(self.messages) < self.batch_size:
+                return
+            batch = self.take()
+        self.handle(batch)
+
+    def take(self):
+        batch = self.messages
+        self.messages = []
+        self.deadline = None
+        return batch
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.linger / 4):
+            with self.lock:
+                if self.deadline is None or time.monotonic() < self.deadline:
+                    continue
+                batch = self.take()
+            self.handle(batch)
+
+    def stop(self):
+        """Handles the last batch."""
+        self.stopped.set()
+        self.flusher.join()
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.handle(batch)
+
+    def handle(self, batch):
+        start = time.monotonic()
+        try:
+            self.handler(batch)
+        except Exception:
+            logger.exception('Handler failed on a batch of %d messages, nacking them',
+                             len(batch))
+            for message in batch:
+                message.nack()
+            with self.lock:
+                self.stats['failed_batches'] += 1
+            return
+        for message in batch:
+            message.ack()
+        with self.lock:
+            self.stats['messages'] += len(batch)
+            self.stats['bytes'] += sum(len(message.data) for message in batch)
+            self.stats['batches'] += 1
+            self.stats['handler_time'] += time.monotonic() - start
+
+    def stats_str(self):
+        with self.lock:
+            stats = dict(self.stats)
+        batches = stats['batches']
+        return ('messages {messages}, bytes {bytes}, batches {batches} '
+                '({per_batch:.1f} messages/batch, {handler_ms:.2f} ms/batch), '
+                'failed batches {failed_batches}').format(
+                    per_batch=stats['messages'] / batches if batches else 0,
+                    handler_ms=stats['handler_time'] * 1000 / batches if batches else 0,
+                    **stats)
+# [END micro_batcher]
+
+
+# [START emulator]
+def prepare_emulator(subscriber, subscription_path, project, topic_name, count):
+    """Creates the topic and subscription on the Pub/Sub emulator if needed,
+    and publishes count events like those of pi_device."""
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(project, topic_name)
     try:
-        # When `timeout` is not set, result() will block indefinitely,
-        # unless an exception is encountered first.
-        streaming_pull_future.result()
-    except:  # noqa
-        streaming_pull_future.cancel()
+        publisher.create_topic(name=topic_path)
+    except Exception as e:  # AlreadyExists
+        logger.info('Topic {}: {}'.format(topic_path, e))
+    try:
+        subscriber.create_subscription(name=subscription_path, topic=topic_path)
+    except Exception as e:  # AlreadyExists
+        logger.info('Subscription {}: {}'.format(subscription_path, e))
+
+    start = time.time()
+    futures = []
+    for n in range(count):
+        data = ('{{ "device_id": "my-device", "event_time": "{}", '
+                '"raw_accelerometer_data": "x=0.0, y=-0.0, z=1.0" }}').format(
+                    time.ctime(start + n))
+        futures.append(publisher.publish(topic_path, data.encode()))
+    for future in futures:
+        future.result()
+    logger.info('Published {} messages to {} in {:.1f}s'.format(
+        count, topic_path, time.time() - start))
+# [END emulator]
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--project_id', default=project_id, help='GCP project id.')
+    parser.add_argument(
+        '--subscription_name', default=subscription_name, help='Pub/Sub subscription.')
+    parser.add_argument(
+        '--handler', default='print',
+        help=('Handler of the batches of messages: {}, or module:function of a '
+              'function taking the list of messages.'.format(', '.join(sorted(HANDLERS)))))
+    parser.add_argument(
+        '--batch_size', default=100, type=int,
+        help='Messages handed over to the handler at once.')
+    parser.add_argument(
+        '--batch_linger_ms', default=500, type=float,
+        help='Maximum time, in milliseconds, a message waits for its batch to fill.')
+    parser.add_argument(
+        '--max_messages', default=1000, type=int,
+        help='Flow control: maximum number of messages received and not yet acked.')
+    parser.add_argument(
+        '--max_bytes', default=100 * 1024 * 1024, type=int,
+        help='Flow control: maximum size of the messages received and not yet acked.')
+    parser.add_argument(
+        '--threads', default=4, type=int,
+        help='Number of threads running the subscriber callbacks and the handler.')
+    parser.add_argument(
+        '--timeout', default=None, type=float,
+        help='Seconds to listen for, by default until interrupted.')
+    parser.add_argument(
+        '--report_interval', default=10, type=float,
+        help='Interval, in seconds, between two logs of the consumer statistics.')
+    parser.add_argument(
+        '--emulator_topic',
+        help=('With the Pub/Sub emulator (PUBSUB_EMULATOR_HOST set): topic to '
+              'create, with the subscription, and to publish to.'))
+    parser.add_argument(
+        '--publish', default=0, type=int,
+        help='With --emulator_topic, number of test messages to publish first.')
+    args = parser.parse_args()
+    if not args.project_id or not args.subscription_name:
+        parser.error('Set --project_id and --subscription_name.')
+    if args.emulator_topic and 'PUBSUB_EMULATOR_HOST' not in os.environ:
+        parser.error('--emulator_topic needs the Pub/Sub emulator: set PUBSUB_EMULATOR_HOST.')
+    if args.batch_size > args.max_messages:
+        logger.warning('Batches of {} messages cannot fill up with --max_messages {}, '
+                       'they are handled every {} ms instead'.format(
+                           args.batch_size, args.max_messages, args.batch_linger_ms))
+    return args
+
+
+def main():
+    args = parse_command_line_args()
+
+    subscriber = pubsub_v1.SubscriberClient()
+    # The `subscription_path` method creates a fully qualified identifier
+    # in the form `projects/{project_id}/subscriptions/{subscription_name}`
+    subscription_path = subscriber.subscription_path(
+        args.project_id, args.subscription_name
+    )
+    if args.emulator_topic:
+        prepare_emulator(subscriber, subscription_path, args.project_id,
+                         args.emulator_topic, args.publish)
+
+    batcher = MicroBatcher(load_handler(args.handler), args.batch_size,
+                           args.batch_linger_ms / 1000.0)
+    batcher.start()
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=args.max_messages, max_bytes=args.max_bytes)
+    scheduler = ThreadScheduler(concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.threads, thread_name_prefix='subscriber'))
+
+    streaming_pull_future = subscriber.subscribe(
+        subscription_path, callback=batcher.add, flow_control=flow_control,
+        scheduler=scheduler
+    )
+    logger.info("Listening for messages on {}..".format(subscription_path))
+
+    start = time.time()
+    deadline = None if args.timeout is None else start + args.timeout
+    # Wrap subscriber in a 'with' block to automatically call close() when done.
+    with subscriber:
+        try:
+            while deadline is None or time.time() < deadline:
+                wait = args.report_interval
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                try:
+                    # Raises the error that stopped the pull, if any
+                    streaming_pull_future.result(timeout=max(wait, 0))
+                    break
+                except concurrent.futures.TimeoutError:
+                    pass
+                logger.info('{:.0f}s: {}'.format(time.time() - start, batcher.stats_str()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Acks the last batch while the stream is still open
+            batcher.stop()
+            elapsed = time.time() - start
+            streaming_pull_future.cancel()
+            streaming_pull_future.result()
+    logger.info('Done in {:.1f}s, {:.0f} messages/s: {}'.format(
+        elapsed, batcher.stats['messages'] / elapsed, batcher.stats_str()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,1006 @@
 """
-A streaming value-counting workflow.
+A streaming accelerometer analytics workflow.
 """
 
 from __future__ import absolute_import
 
 import argparse
+import base64
+import calendar
+import fnmatch
+import io
 import logging
+import math
+import os
 
 import json
+import struct
 import time
+import typing
+import uuid
+import zlib
 
+import numpy as np
 import six
+try:
+    import zstandard
+except ImportError:  # Only needed for the zstd payloads of the gateway
+    zstandard = None
+try:
+    import fastavro
+except ImportError:  # Only needed by --sink_format avro
+    fastavro = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Only needed by --sink_format parquet
+    pyarrow = None
 
 import apache_beam as beam
 import apache_beam.transforms.window as window
 from apache_beam.examples.wordcount import WordExtractingDoFn
+from apache_beam.io.filesystems import FileSystems
+from apache_beam.metrics import Metrics
+from apache_beam.metrics.metric import MetricsFilter
 from apache_beam.options.pipeline_options import PipelineOptions
 from apache_beam.options.pipeline_options import SetupOptions
 from apache_beam.options.pipeline_options import StandardOptions
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import ReadModifyWriteStateSpec
+from apache_beam.transforms.userstate import TimerSpec
+from apache_beam.transforms.userstate import on_timer
+from apache_beam.utils.timestamp import Duration
+from apache_beam.utils.timestamp import Timestamp
 
+# Alert rules loaded when --alert_rules is not given
+DEFAULT_ALERT_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'alert_rules.json')
 
-def Extracting_X_Value(text):
-    x_value = json.loads(text.strip())["raw_accelerometer_data"].split(',')[0].split('=')[1]
-    if x_value == "-0.0" or x_value == "0.0":
-        x_value = "0.0"
-    return x_value
 
-class Alerting_X_Value(beam.DoFn):
-    def process(self, word_count):
-        (word, count) = word_count
-        if (word == '-1.0' and count == 10):
-            yield '[{}] Alerting {}: {}'.format(time.ctime(), word, count).encode()
+# One accelerometer reading of a device
+AccelerometerReading = typing.NamedTuple('AccelerometerReading', [
+    ('device_id', str),
+    ('event_time', str),
+    ('x', float),
+    ('y', float),
+    ('z', float),
+])
+beam.coders.registry.register_coder(AccelerometerReading, beam.coders.RowCoder)
+
+# Statistics of one axis over a window
+AxisStats = typing.NamedTuple('AxisStats', [
+    ('mean', float),
+    ('min', float),
+    ('max', float),
+    ('variance', float),
+])
+beam.coders.registry.register_coder(AxisStats, beam.coders.RowCoder)
+
+# Statistics of the readings of a device over a window
+DeviceStats = typing.NamedTuple('DeviceStats', [
+    ('device_id', str),
+    ('count', int),
+    ('x', AxisStats),
+    ('y', AxisStats),
+    ('z', AxisStats),
+])
+beam.coders.registry.register_coder(DeviceStats, beam.coders.RowCoder)
+
+# Statistics of the readings of a device over a window, published by the
+# gateway instead of the readings (--aggregate_interval). The window bounds
+# are Unix times.
+DeviceSummary = typing.NamedTuple('DeviceSummary', [
+    ('window_start', float),
+    ('window_end', float),
+    ('stats', DeviceStats),
+])
+beam.coders.registry.register_coder(DeviceSummary, beam.coders.RowCoder)
+
+
+# Binary frames forwarded by the gateway (see connectivity/gateway/gateway.py):
+#   header: magic, version, action code, length of the device id (!BBBB)
+#   device id, UTF-8
+#   version 2 only: sequence number (!I)
+#   event body: samples (timestamp, x, y, z) back to back (!dfff)
+# Formats, not struct.Struct objects, which the main session cannot pickle
+FRAME_MAGIC = 0xB5
+FRAME_HEADER = '!BBBB'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+FRAME_SEQ_SIZE = struct.calcsize('!I')
+FRAME_SAMPLE = '!dfff'
+
+# Payloads compressed by the gateway (--compress):
+#   header: magic, encoding code (1 zlib, 2 zstd), dictionary ID (!BBI)
+#   body: the JSON or binary frame payload, compressed with the dictionary
+COMPRESSED_MAGIC = 0xB6
+COMPRESSED_HEADER = '!BBI'
+COMPRESSED_HEADER_SIZE = struct.calcsize(COMPRESSED_HEADER)
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+# Bound of a decompressed payload, in bytes, that of a Pub/Sub message
+MAX_PAYLOAD_SIZE = 10 * 1024 * 1024
+
+
+def load_dictionaries(paths):
+    """Returns the compression dictionaries of files, by dictionary ID."""
+    dictionaries = {}
+    for path in paths or ():
+        with FileSystems.open(path) as f:
+            dictionary = f.read()
+        dictionaries[zlib.crc32(dictionary) & 0xffffffff] = dictionary
+    return dictionaries
+
+
+class PayloadDecompressor(object):
+    """Decompresses the payloads the gateway compressed with a dictionary."""
+
+    def __init__(self, dictionaries):
+        self.dictionaries = dictionaries
+        self.zstd = {}      # Decompressors by dictionary ID, made once
+
+    def decompress(self, message):
+        _, code, dict_id = struct.unpack_from(COMPRESSED_HEADER, message)
+        dictionary = self.dictionaries.get(dict_id)
+        if dictionary is None:
+            raise ValueError('Unknown compression dictionary {:08x}'.format(dict_id))
+        body = message[COMPRESSED_HEADER_SIZE:]
+        if code == COMPRESSION_ZLIB:
+            decompressor = zlib.decompressobj(-15, dictionary)
+            payload = decompressor.decompress(body, MAX_PAYLOAD_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ValueError('Payload larger than {} bytes'.format(MAX_PAYLOAD_SIZE))
+            return payload
+        if code == COMPRESSION_ZSTD and zstandard is not None:
+            if dict_id not in self.zstd:
+                self.zstd[dict_id] = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary))
+            return self.zstd[dict_id].decompress(body, max_output_size=MAX_PAYLOAD_SIZE)
+        raise ValueError('Unsupported compression {}'.format(code))
+
+
+def parse_axes(raw_accelerometer_data):
+    """Returns the (x, y, z) of 'x=<x>, y=<y>, z=<z>'."""
+    axes = {}
+    for part in raw_accelerometer_data.split(','):
+        name, _, value = part.partition('=')
+        axes[name.strip()] = float(value)
+    x, y, z = axes['x'], axes['y'], axes['z']
+    if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(z)):
+        raise ValueError('Not finite: {}'.format(raw_accelerometer_data))
+    return x, y, z
+
+
+def parse_frame(data):
+    """Returns the readings of a binary event frame."""
+    _, version, _, id_length = struct.unpack_from(FRAME_HEADER, data)
+    body_start = FRAME_HEADER_SIZE + id_length
+    device_id = data[FRAME_HEADER_SIZE:body_start].decode('utf8')
+    if version >= 2:
+        body_start += FRAME_SEQ_SIZE
+    return [AccelerometerReading(device_id, format_event_time(timestamp), x, y, z)
+            for timestamp, x, y, z in struct.iter_unpack(FRAME_SAMPLE, data[body_start:])]
+
+
+def iter_events(payload):
+    """Yields the events of a payload: one event, or arrays of them when the
+    gateway or the device batched them."""
+    if isinstance(payload, list):
+        for item in payload:
+            for event in iter_events(item):
+                yield event
+    elif isinstance(payload, dict):
+        yield payload
+    # Other JSON values, e.g. the test messages of pi_device, are no readings
+
+
+def parse_summary(summary):
+    """Returns the DeviceSummary of a JSON summary of the gateway."""
+    axes = [AxisStats(*(float(summary[axis][field])
+                        for field in ('mean', 'min', 'max', 'variance')))
+            for axis in ('x', 'y', 'z')]
+    device_id = summary['device_id']
+    if not isinstance(device_id, str):
+        raise TypeError('device_id must be a string')
+    return DeviceSummary(event_timestamp(summary['window_start']),
+                         event_timestamp(summary['window_end']),
+                         DeviceStats(device_id, int(summary['count']), *axes))
+
+
+def parse_event(event):
+    """Returns the AccelerometerReading of a JSON event."""
+    x, y, z = parse_axes(event["raw_accelerometer_data"])
+    device_id, event_time = event["device_id"], event["event_time"]
+    if not isinstance(device_id, str) or not isinstance(event_time, str):
+        raise TypeError('device_id and event_time must be strings')
+    return AccelerometerReading(device_id, event_time, x, y, z)
+
+
+# Errors of malformed messages, as opposed to bugs
+PARSE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, struct.error,
+                zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Messages without it hold no readings, e.g. the test messages of pi_device
+READING_MARKER = b'raw_accelerometer_data'
+
+# Messages with it are summaries of the readings of a device by the gateway
+SUMMARY_MARKER = b'"window_end"'
+
+
+def dead_letter(step, error, message):
+    """Returns the dead-letter record of a message that failed in step."""
+    record = {'step': step, 'error': '{}: {}'.format(type(error).__name__, error)}
+    try:
+        record['message'] = message.decode('utf8')
+    except UnicodeDecodeError:
+        record['message'] = base64.b64encode(message).decode('ascii')
+        record['encoding'] = 'base64'
+    return json.dumps(record).encode()
+
+
+class ParseReadings(beam.DoFn):
+    """Parses the Pub/Sub messages, JSON or binary frames, into
+    AccelerometerReadings.
+
+    A message, or an event of a batch, that fails to parse goes to the
+    DEAD_LETTER output with its error instead of failing the bundle, which a
+    streaming runner would retry forever. JSON messages without READING_MARKER
+    are skipped before decoding them. Messages the gateway compressed are
+    decompressed first, with dictionaries, the contents of the dictionary files.
+    The summaries of the gateway go to the SUMMARY output, as DeviceSummaries.
+    """
+
+    DEAD_LETTER = 'dead_letter'
+    SUMMARY = 'summary'
+
+    def __init__(self, dictionaries=None):
+        self.dictionaries = dictionaries or {}
+        self.decompressor = None
+        self.messages = Metrics.counter(self.__class__, 'messages')
+        self.compressed = Metrics.counter(self.__class__, 'compressed_messages')
+        self.skipped = Metrics.counter(self.__class__, 'skipped_messages')
+        self.readings = Metrics.counter(self.__class__, 'readings')
+        self.summaries = Metrics.counter(self.__class__, 'summaries')
+        self.invalid = Metrics.counter(self.__class__, 'invalid_records')
+
+    def reject(self, error, message):
+        self.invalid.inc()
+        return beam.pvalue.TaggedOutput(self.DEAD_LETTER, dead_letter('parse', error, message))
+
+    def setup(self):
+        self.decompressor = PayloadDecompressor(self.dictionaries)
+
+    def process(self, message):
+        self.messages.inc()
+        if message[:1] == bytes((COMPRESSED_MAGIC,)):
+            self.compressed.inc()
+            try:
+                message = self.decompressor.decompress(message)
+            except PARSE_ERRORS as e:
+                yield self.reject(e, message)
+                return
+        if message[:1] == bytes((FRAME_MAGIC,)):
+            try:
+                readings = parse_frame(message)
+            except PARSE_ERRORS as e:
+                yield self.reject(e, message)
+                return
+            self.readings.inc(len(readings))
+            for reading in readings:
+                yield reading
+            return
+        if SUMMARY_MARKER in message:
+            try:
+                summary = parse_summary(json.loads(message))
+            except PARSE_ERRORS as e:
+                yield self.reject(e, message)
+                return
+            self.summaries.inc()
+            yield beam.pvalue.TaggedOutput(self.SUMMARY, summary)
+            return
+        if READING_MARKER not in message:
+            self.skipped.inc()
+            return
+        try:
+            payload = json.loads(message)
+        except ValueError as e:
+            yield self.reject(e, message)
+            return
+        for event in iter_events(payload):
+            try:
+                reading = parse_event(event)
+            except PARSE_ERRORS as e:
+                yield self.reject(e, json.dumps(event).encode())
+                continue
+            self.readings.inc()
+            yield reading
+
+
+def event_timestamp(event_time):
+    """Returns the Unix time of an event_time, formatted like time.ctime() in
+    UTC, whatever the time zone the pipeline runs in."""
+    return calendar.timegm(time.strptime(event_time))
+
+
+def format_event_time(timestamp):
+    """Formats a Unix time as the event_time read by event_timestamp()."""
+    return time.asctime(time.gmtime(timestamp))
+
+
+class TimestampByEventTime(beam.DoFn):
+    """Timestamps the readings with their event_time, for replays.
+
+    Replayed readings come in runs of the same second: the last event_time
+    parsed is kept, as time.strptime is slow."""
+
+    def __init__(self):
+        self.invalid = Metrics.counter(ParseReadings, 'invalid_records')
+
+    def setup(self):
+        self.event_time = None
+        self.timestamp = None
+
+    def process(self, reading):
+        if reading.event_time != self.event_time:
+            try:
+                self.timestamp = event_timestamp(reading.event_time)
+            except ValueError as e:
+                self.invalid.inc()
+                yield beam.pvalue.TaggedOutput(ParseReadings.DEAD_LETTER, dead_letter(
+                    'timestamp', e, json.dumps(reading._asdict()).encode()))
+                return
+            self.event_time = reading.event_time
+        yield window.TimestampedValue(reading, self.timestamp)
+
+
+class AxisStatsFn(beam.CombineFn):
+    """Count, mean, min, max and variance of x, y and z, at once.
+
+    Adding an input only buffers its (x, y, z), and merging accumulators
+    concatenates their buffers. A buffer is folded into the statistics with
+    numpy once it holds BATCH_SIZE readings, or at the end. Partial
+    statistics are merged together with the parallel variance formula.
+
+    The accumulator is [count, mean, m2, min, max, buffer], where mean, m2
+    (sum of squared deviations), min and max are arrays over the 3 axes, or
+    None until the first fold.
+    """
+
+    BATCH_SIZE = 256
+
+    def create_accumulator(self):
+        return [0, None, None, None, None, []]
+
+    def add_input(self, accumulator, reading):
+        accumulator[5].append(reading)
+        if len(accumulator[5]) >= self.BATCH_SIZE:
+            self.fold(accumulator)
+        return accumulator
+
+    def fold(self, accumulator):
+        """Folds the buffered readings into the statistics."""
+        if not accumulator[5]:
+            return accumulator
+        batch = np.array(accumulator[5], dtype=float)
+        mean = batch.mean(axis=0)
+        folded = [len(batch), mean, ((batch - mean) ** 2).sum(axis=0),
+                  batch.min(axis=0), batch.max(axis=0), []]
+        if accumulator[0]:
+            folded = self.merge_stats([accumulator, folded])
+        accumulator[:] = folded
+        return accumulator
+
+    @staticmethod
+    def merge_stats(accumulators):
+        """Returns the statistics of accumulators, with an empty buffer."""
+        counts = np.array([accumulator[0] for accumulator in accumulators],
+                          dtype=float)[:, np.newaxis]
+        means = np.array([accumulator[1] for accumulator in accumulators])
+        count = counts.sum()
+        mean = (counts * means).sum(axis=0) / count
+        m2 = (np.array([accumulator[2] for accumulator in accumulators])
+              + counts * (means - mean) ** 2).sum(axis=0)
+        return [int(count), mean, m2,
+                np.min([accumulator[3] for accumulator in accumulators], axis=0),
+                np.max([accumulator[4] for accumulator in accumulators], axis=0), []]
+
+    def merge_accumulators(self, accumulators):
+        buffer = []
+        with_stats = []
+        for accumulator in accumulators:
+            buffer.extend(accumulator[5])
+            if accumulator[0]:
+                with_stats.append(accumulator)
+        if not with_stats:
+            merged = self.create_accumulator()
+        elif len(with_stats) == 1:
+            merged = list(with_stats[0])
+        else:
+            merged = self.merge_stats(with_stats)
+        merged[5] = buffer
+        if len(buffer) >= self.BATCH_SIZE:
+            self.fold(merged)
+        return merged
+
+    def compact(self, accumulator):
+        return self.fold(accumulator)
+
+    def extract_output(self, accumulator):
+        count, mean, m2, minimum, maximum, _ = self.fold(accumulator)
+        if not count:
+            mean = m2 = minimum = maximum = np.full(3, np.nan)
+        variance = m2 / max(count, 1)
+        # Plain tuples, see to_device_stats
+        return count, tuple((float(mean[i]), float(minimum[i]), float(maximum[i]),
+                             float(variance[i]))
+                            for i in range(3))
+
+
+class PartialCombineFn(beam.CombineFn):
+    """Runs combine_fn, and outputs its accumulators instead of its results."""
+
+    def __init__(self, combine_fn):
+        self.combine_fn = combine_fn
+
+    def create_accumulator(self):
+        return self.combine_fn.create_accumulator()
+
+    def add_input(self, accumulator, element):
+        return self.combine_fn.add_input(accumulator, element)
+
+    def merge_accumulators(self, accumulators):
+        return self.combine_fn.merge_accumulators(accumulators)
+
+    def compact(self, accumulator):
+        return self.combine_fn.compact(accumulator)
+
+    def extract_output(self, accumulator):
+        return self.combine_fn.compact(accumulator)
+
+
+class MergePartialsFn(PartialCombineFn):
+    """Merges the accumulators output by PartialCombineFn(combine_fn)."""
+
+    def add_input(self, accumulator, partial):
+        return self.combine_fn.merge_accumulators([accumulator, partial])
+
+    def extract_output(self, accumulator):
+        return self.combine_fn.extract_output(accumulator)
+
+
+class WindowFromTimestamp(window.NonMergingWindowFn):
+    """Assigns each element to the window of size seconds starting at its
+    timestamp."""
+
+    def __init__(self, size):
+        self.size = Duration.of(size)
+
+    def assign(self, context):
+        return [window.IntervalWindow(context.timestamp, context.timestamp + self.size)]
+
+    def get_window_coder(self):
+        return beam.coders.coders.IntervalWindowCoder()
+
+
+class CombinePerSlidingWindow(beam.PTransform):
+    """Combines the values of each key in sliding windows of size seconds
+    every period seconds, like
+    WindowInto(SlidingWindows(size, period)) | CombinePerKey(combine_fn).
+
+    The values are combined per period first, and these partial accumulators
+    are merged in every sliding window they belong to. The values are
+    combined before the shuffle (combiner lifting), and a value goes through
+    one shuffle in one window, instead of size / period windows.
+
+    With bounded, for batch pipelines, the periods and windows are grouped as
+    part of the keys instead: the DirectRunner takes a time quadratic in the
+    number of windows of a key to group by window, which replays of days of
+    readings cannot afford.
+    """
+
+    def __init__(self, combine_fn, size, period, bounded=False):
+        super(CombinePerSlidingWindow, self).__init__()
+        if size % period:
+            raise ValueError('The window size must be a multiple of its period.')
+        self.combine_fn = combine_fn
+        self.size = size
+        self.period = period
+        self.bounded = bounded
+
+    def expand(self, pcoll):
+        if self.bounded:
+            return self.expand_bounded(pcoll)
+        # The partial accumulator of a period is timestamped at the end of
+        # it, and falls in the same sliding windows as the values it holds.
+        return (pcoll
+                | 'per_period' >> beam.WindowInto(window.FixedWindows(self.period))
+                | 'combine_per_period' >> beam.CombinePerKey(
+                    PartialCombineFn(self.combine_fn))
+                | 'sliding' >> beam.WindowInto(
+                    window.SlidingWindows(self.size, self.period))
+                | 'merge_partials' >> beam.CombinePerKey(
+                    MergePartialsFn(self.combine_fn)))
+
+    def expand_bounded(self, pcoll):
+        size = Duration.of(self.size).micros
+        period = Duration.of(self.period).micros
+
+        def key_by_period(element, timestamp=beam.DoFn.TimestampParam):
+            key, value = element
+            return (key, timestamp.micros - timestamp.micros % period), value
+
+        def key_by_window(element):
+            (key, period_start), partial = element
+            for start in range(period_start - size + period, period_start + period, period):
+                yield (key, start), partial
+
+        def window_result(element):
+            (key, start), result = element
+            return window.TimestampedValue((key, result), Timestamp(micros=start))
+
+        return (pcoll
+                | 'key_by_period' >> beam.Map(key_by_period)
+                | 'combine_per_period' >> beam.CombinePerKey(
+                    PartialCombineFn(self.combine_fn))
+                | 'key_by_window' >> beam.FlatMap(key_by_window)
+                | 'merge_partials' >> beam.CombinePerKey(
+                    MergePartialsFn(self.combine_fn))
+                | 'window_result' >> beam.Map(window_result)
+                | 'sliding' >> beam.WindowInto(WindowFromTimestamp(self.size)))
+
+
+def to_device_stats(device_stats):
+    """Returns the DeviceStats of the output of AxisStatsFn for a device.
+
+    The NamedTuples are built here, with a type hint, for the runners to
+    encode them with their schema: without it they are pickled, which fails
+    on workers when they are defined in __main__."""
+    device_id, (count, axes) = device_stats
+    return DeviceStats(device_id, count, *[AxisStats(*axis) for axis in axes])
+
+
+# [START alerting]
+class AlertRule(object):
+    """A threshold on one axis of the readings of the devices matching device.
+
+    The rule triggers when the value goes below (or above) the threshold, and
+    raises an alert once it stayed there for duration_s seconds. The incident
+    lasts until the value crosses back the clear threshold: values between the
+    two thresholds neither end it nor raise it again (hysteresis).
+    """
+
+    METRICS = ('x', 'y', 'z')
+
+    def __init__(self, name, metric, below=None, above=None, clear=None,
+                 duration_s=0, device='*', message=None):
+        if metric not in self.METRICS:
+            raise ValueError('Rule {}: unknown metric {}.'.format(name, metric))
+        if (below is None) == (above is None):
+            raise ValueError('Rule {}: give either below or above.'.format(name))
+        self.name = name
+        self.metric = metric
+        self.below = below is not None
+        self.threshold = float(below if self.below else above)
+        self.clear = self.threshold if clear is None else float(clear)
+        if self.clear < self.threshold if self.below else self.clear > self.threshold:
+            raise ValueError('Rule {}: clear must be on the other side of the '
+                             'threshold.'.format(name))
+        self.duration_s = float(duration_s)
+        self.device = device
+        self.message = message or name
+
+    def applies_to(self, device_id):
+        return fnmatch.fnmatchcase(device_id, self.device)
+
+    def triggered(self, value):
+        return value <= self.threshold if self.below else value >= self.threshold
+
+    def cleared(self, value):
+        return value > self.clear if self.below else value < self.clear
+
+
+def load_alert_rules(path):
+    """Returns the (rules, expiry_s) of a rules file, see alert_rules.json."""
+    with open(path) as f:
+        config = json.load(f)
+    rules = [AlertRule(**rule) for rule in config['rules']]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError('The names of the rules in {} must be unique.'.format(path))
+    return rules, float(config.get('expiry_s', 300))
+
+
+class AlertingFn(beam.DoFn):
+    """Raises one alert per incident, from the (device_id, reading) pairs.
+
+    The incidents of a device are kept in its state: the rules pending, that
+    triggered and wait for their duration, and the rules firing, that raised
+    their alert already. A reading past the duration of a pending rule raises
+    its alert right away. Otherwise the deadline timer raises it when the
+    watermark passes the end of the duration without a reading clearing it.
+    The state of a device is dropped after expiry_s seconds without readings.
+    """
+
+    INCIDENTS = ReadModifyWriteStateSpec('incidents', beam.coders.PickleCoder())
+    DEADLINE = TimerSpec('deadline', TimeDomain.WATERMARK)
+    EXPIRY = TimerSpec('expiry', TimeDomain.WATERMARK)
+
+    def __init__(self, rules, expiry_s):
+        self.rules = rules
+        self.rules_by_name = dict((rule.name, rule) for rule in rules)
+        self.expiry_s = expiry_s
+
+    def setup(self):
+        self.device_rules = {}
+
+    def rules_of(self, device_id):
+        rules = self.device_rules.get(device_id)
+        if rules is None:
+            rules = [rule for rule in self.rules if rule.applies_to(device_id)]
+            self.device_rules[device_id] = rules
+        return rules
+
+    @staticmethod
+    def alert(rule, device_id, since, value, event_time):
+        return json.dumps({
+            'rule': rule.name,
+            'device_id': device_id,
+            'metric': rule.metric,
+            'value': value,
+            'since': format_event_time(since),
+            'event_time': format_event_time(event_time),
+            'message': rule.message,
+        }).encode()
+
+    def arm(self, incidents, deadline):
+        """Sets the deadline timer to the end of the first pending duration."""
+        if incidents['pending']:
+            deadline.set(min(since + self.rules_by_name[name].duration_s
+                             for name, (since, _) in incidents['pending'].items()))
+
+    def process(self, element, timestamp=beam.DoFn.TimestampParam,
+                incidents_state=beam.DoFn.StateParam(INCIDENTS),
+                deadline=beam.DoFn.TimerParam(DEADLINE),
+                expiry=beam.DoFn.TimerParam(EXPIRY)):
+        device_id, reading = element
+        now = timestamp.micros / 1e6
+        incidents = incidents_state.read() or self.new_incidents(now)
+        for alert in self.evaluate(device_id, incidents, reading, now):
+            yield alert
+        incidents_state.write(incidents)
+        self.arm(incidents, deadline)
+        expiry.set(incidents['last_seen'] + self.expiry_s)
+
+    @staticmethod
+    def new_incidents(now):
+        return {'pending': {}, 'firing': {}, 'last_seen': now}
+
+    def evaluate(self, device_id, incidents, reading, now):
+        """Updates the incidents of device_id with a reading sampled at now,
+        and yields the alerts it raises."""
+        pending, firing = incidents['pending'], incidents['firing']
+        for rule in self.rules_of(device_id):
+            value = getattr(reading, rule.metric)
+            if rule.name in firing:
+                if rule.cleared(value):
+                    del firing[rule.name]
+            elif rule.name in pending:
+                since, _ = pending[rule.name]
+                if rule.cleared(value):
+                    del pending[rule.name]
+                elif now - since >= rule.duration_s:
+                    del pending[rule.name]
+                    firing[rule.name] = since
+                    yield self.alert(rule, device_id, since, value, now)
+                else:
+                    pending[rule.name] = (since, value)
+            elif rule.triggered(value):
+                if rule.duration_s <= 0:
+                    firing[rule.name] = now
+                    yield self.alert(rule, device_id, now, value, now)
+                else:
+                    pending[rule.name] = (now, value)
+        incidents['last_seen'] = max(incidents['last_seen'], now)
+
+    def raise_due(self, device_id, incidents, now, strict=False):
+        """Raises the alerts of the pending rules whose duration ended by now
+        (before now, if strict)."""
+        for rule in self.rules_of(device_id):
+            if rule.name not in incidents['pending']:
+                continue
+            since, value = incidents['pending'][rule.name]
+            elapsed = now - since
+            if elapsed > rule.duration_s or elapsed == rule.duration_s and not strict:
+                del incidents['pending'][rule.name]
+                incidents['firing'][rule.name] = since
+                yield self.alert(rule, device_id, since, value, since + rule.duration_s)
+
+    @on_timer(DEADLINE)
+    def on_deadline(self, key=beam.DoFn.KeyParam, fire_time=beam.DoFn.TimestampParam,
+                    incidents_state=beam.DoFn.StateParam(INCIDENTS),
+                    deadline=beam.DoFn.TimerParam(DEADLINE)):
+        incidents = incidents_state.read()
+        if not incidents:
+            return
+        for alert in self.raise_due(key, incidents, fire_time.micros / 1e6):
+            yield alert
+        incidents_state.write(incidents)
+        self.arm(incidents, deadline)
+
+    @on_timer(EXPIRY)
+    def on_expiry(self, key=beam.DoFn.KeyParam, fire_time=beam.DoFn.TimestampParam,
+                  incidents_state=beam.DoFn.StateParam(INCIDENTS)):
+        # The timers may fire in any order once the watermark jumps, e.g. at
+        # the end of a batch: raise the alerts due before dropping the state.
+        incidents = incidents_state.read()
+        if incidents:
+            for alert in self.raise_due(key, incidents, fire_time.micros / 1e6):
+                yield alert
+        incidents_state.clear()
+
+
+class ReplayAlertingFn(beam.DoFn):
+    """Raises the alerts of AlertingFn in replays, from the (device_id,
+    [(timestamp in microseconds, reading)]) of all the readings of each
+    device.
+
+    A batch runner hands over the readings in any order: those of a device
+    are evaluated sorted by time. The deadlines and the expiry of the state
+    are applied between two readings as the timers would in streaming, with
+    a watermark following the readings.
+    """
+
+    def __init__(self, rules, expiry_s):
+        self.alerting = AlertingFn(rules, expiry_s)
+
+    def setup(self):
+        self.alerting.setup()
+
+    def process(self, element):
+        device_id, readings = element
+        alerting = self.alerting
+        incidents = None
+        for micros, reading in sorted(readings, key=lambda item: item[0]):
+            now = micros / 1e6
+            if incidents is not None:
+                # The timers fire once the watermark passed them, i.e. after
+                # the readings of the same time
+                expired = incidents['last_seen'] + alerting.expiry_s
+                if now > expired:
+                    for alert in alerting.raise_due(device_id, incidents, expired):
+                        yield alert
+                    incidents = None
+                else:
+                    for alert in alerting.raise_due(device_id, incidents, now, strict=True):
+                        yield alert
+            if incidents is None:
+                incidents = alerting.new_incidents(now)
+            for alert in alerting.evaluate(device_id, incidents, reading, now):
+                yield alert
+        if incidents is not None:
+            for alert in alerting.raise_due(device_id, incidents,
+                                            incidents['last_seen'] + alerting.expiry_s):
+                yield alert
+# [END alerting]
+
+
+# [START columnar_sink]
+# Columns of the tables of --sink_path, and their types
+READING_COLUMNS = [
+    ('device_id', 'string'),
+    ('event_time', 'string'),
+    ('x', 'double'),
+    ('y', 'double'),
+    ('z', 'double'),
+]
+STATS_COLUMNS = ([
+    ('device_id', 'string'),
+    ('window_start', 'timestamp'),
+    ('window_end', 'timestamp'),
+    ('count', 'long'),
+] + [('{}_{}'.format(axis, field), 'double')
+     for axis in ('x', 'y', 'z') for field in AxisStats._fields] + [
+    ('source', 'string'),   # 'pipeline', or 'gateway' for its summaries
+])
+
+# The files are partitioned by hour, in UTC
+SINK_PARTITION_S = 3600
+
+
+def reading_record(reading):
+    return reading._asdict()
+
+
+def stats_record(device_stats, source, window_start, window_end):
+    """Returns the record of DeviceStats, with the bounds of their window in
+    microseconds."""
+    record = {
+        'device_id': device_stats.device_id,
+        'window_start': window_start,
+        'window_end': window_end,
+        'count': device_stats.count,
+    }
+    for axis in ('x', 'y', 'z'):
+        for field, value in getattr(device_stats, axis)._asdict().items():
+            record['{}_{}'.format(axis, field)] = value
+    record['source'] = source
+    return record
+
+
+def summary_record(summary):
+    return stats_record(summary.stats, 'gateway', int(summary.window_start * 1e6),
+                        int(summary.window_end * 1e6))
+
+
+class WriteBatchFn(beam.DoFn):
+    """Writes each batch of records to a temporary Parquet or Avro file, and
+    outputs (path, temporary path), the path being in the partition of the
+    hour of its window.
+
+    Both are named after a random ID: a retried bundle, which may batch the
+    records differently, writes other temporary files, that RenameFileFn
+    never moves to the table.
+    """
+
+    def __init__(self, path, table, columns, file_format):
+        self.path = path
+        self.table = table
+        self.columns = columns
+        self.file_format = file_format
+        self.files = Metrics.counter(self.__class__, 'files')
+        self.records = Metrics.counter(self.__class__, 'records')
+        self.bytes = Metrics.counter(self.__class__, 'bytes')
+
+    def setup(self):
+        if self.file_format == 'parquet':
+            types = {'string': pyarrow.string(), 'double': pyarrow.float64(),
+                     'long': pyarrow.int64(), 'timestamp': pyarrow.timestamp('us', tz='UTC')}
+            self.schema = pyarrow.schema([(name, types[kind]) for name, kind in self.columns])
+        else:
+            types = {'string': 'string', 'double': 'double', 'long': 'long',
+                     'timestamp': {'type': 'long', 'logicalType': 'timestamp-micros'}}
+            self.schema = fastavro.parse_schema({
+                'type': 'record', 'name': self.table,
+                'fields': [{'name': name, 'type': types[kind]} for name, kind in self.columns]})
+
+    def encode(self, records):
+        if self.file_format == 'parquet':
+            stream = pyarrow.BufferOutputStream()
+            pyarrow.parquet.write_table(
+                pyarrow.Table.from_pylist(records, schema=self.schema), stream)
+            return stream.getvalue().to_pybytes()
+        stream = io.BytesIO()
+        fastavro.writer(stream, self.schema, records, codec='deflate')
+        return stream.getvalue()
+
+    def process(self, batch, batch_window=beam.DoFn.WindowParam):
+        _, records = batch
+        records = list(records)
+        data = self.encode(records)
+        start = time.gmtime(batch_window.start.micros // 1000000)
+        file_id = uuid.uuid4().hex
+        # Outside of the table, which is loaded with a wildcard
+        temp_path = '{}/.temp/{}/{}.{}'.format(
+            self.path, self.table, file_id, self.file_format)
+        path = '{}/{}/{}/{}-{}-{}.{}'.format(
+            self.path, self.table, time.strftime('dt=%Y-%m-%d/hour=%H', start),
+            self.table, time.strftime('%Y%m%dT%H%M%S', start), file_id,
+            self.file_format)
+        with FileSystems.create(temp_path) as f:
+            f.write(data)
+        self.files.inc()
+        self.records.inc(len(records))
+        self.bytes.inc(len(data))
+        yield path, temp_path
+
+
+class RenameFileFn(beam.DoFn):
+    """Moves the (path, temporary path) files written by WriteBatchFn to
+    their path, and outputs it.
+
+    Runs after a checkpoint of the written files, so that only those of the
+    bundles that succeeded get there. A rename retried after it succeeded
+    finds the file at its path already.
+    """
+
+    def process(self, paths):
+        path, temp_path = paths
+        directory = FileSystems.split(path)[0]
+        if not FileSystems.exists(directory):
+            try:
+                FileSystems.mkdirs(directory)    # Local files only
+            except IOError:
+                pass    # Made by another worker meanwhile
+        try:
+            FileSystems.rename([temp_path], [path])
+        except IOError:
+            if not FileSystems.exists(path):
+                raise
+        yield path
+
+
+class WriteColumnarFiles(beam.PTransform):
+    """Writes records, dicts of columns, to Parquet or Avro files of a table,
+    partitioned by hour as <path>/<table>/dt=<date>/hour=<hour>/.
+
+    The records of an hour are written in batches of up to max_records, one
+    file each, or when the oldest record waited max_delay_s, and at the end of
+    the hour. The batches are grouped per shard of the table, which the
+    runner may spread over workers. The files are written to
+    <path>/.temp/<table>/ first, and moved to the table once written: those
+    of failed bundles stay there.
+    """
+
+    def __init__(self, path, table, columns, file_format, max_records, max_delay_s=None):
+        super(WriteColumnarFiles, self).__init__()
+        self.path = path.rstrip('/')
+        self.table = table
+        self.columns = columns
+        self.file_format = file_format
+        self.max_records = max_records
+        self.max_delay_s = max_delay_s
+
+    def expand(self, records):
+        table = self.table
+        return (records
+                | 'partition' >> beam.WindowInto(window.FixedWindows(SINK_PARTITION_S))
+                | 'key' >> beam.Map(lambda record: (table, record))
+                | 'batch' >> beam.GroupIntoBatches.WithShardedKey(
+                    self.max_records, self.max_delay_s)
+                | 'write' >> beam.ParDo(WriteBatchFn(
+                    self.path, self.table, self.columns, self.file_format))
+                | 'checkpoint' >> beam.Reshuffle()
+                | 'rename' >> beam.ParDo(RenameFileFn()))
+
+
+class SampledLog(beam.DoFn):
+    """Logs at most one element every interval seconds per worker thread,
+    and how many were skipped since the previous one. An interval of 0 logs
+    them all.
+
+    Elements are only formatted, with format_element, when they are logged.
+    """
+
+    def __init__(self, interval, format_element=str):
+        self.interval = interval
+        self.format_element = format_element
+        self.skipped_counter = Metrics.counter(self.__class__, 'skipped_lines')
+
+    def setup(self):
+        self.last = None
+        self.skipped = 0
+
+    def process(self, element):
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            self.skipped += 1
+            self.skipped_counter.inc()
+            return
+        line = self.format_element(element)
+        if self.skipped:
+            line += ' ({} similar lines skipped)'.format(self.skipped)
+        logging.info(line)
+        self.last = now
+        self.skipped = 0
+# [END columnar_sink]
+
 
 def run(argv=None):
     """Build and run the pipeline."""
     parser = argparse.ArgumentParser()
-    parser.add_argument(
-        '--output_topic', required=True,
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        '--output_topic',
         help=('Output PubSub topic of the form '
               '"projects/<PROJECT>/topic/<TOPIC>".'))
+    group.add_argument(
+        '--output_path',
+        help=('Prefix of the files to write the alerts, the statistics and the '
+              'dead letters to, when replaying --input_files.'))
+    parser.add_argument(
+        '--dead_letter_topic',
+        help=('PubSub topic of the form "projects/<PROJECT>/topics/<TOPIC>" for '
+              'the messages that fail to parse. By default, they are only counted.'))
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument(
         '--input_topic',
@@ -48,50 +1010,186 @@ def run(argv=None):
         '--input_subscription',
         help=('Input PubSub subscription of the form '
               '"projects/<PROJECT>/subscriptions/<SUBSCRIPTION>."'))
+    group.add_argument(
+        '--input_files',
+        help=('Files of newline-delimited JSON events to replay in batch, e.g. '
+              '"gs://<BUCKET>/telemetry-*.json.gz". Compressed files are '
+              'decompressed on the fly.'))
+    parser.add_argument(
+        '--alert_rules', default=DEFAULT_ALERT_RULES,
+        help='JSON file of the alert rules, see alert_rules.json.')
+    parser.add_argument(
+        '--compression_dictionaries', nargs='+',
+        help=('Dictionaries of the payloads the gateway compresses, written '
+              'by connectivity/gateway/bench_compression.py.'))
+    parser.add_argument(
+        '--sink_path',
+        help=('Folder, local or "gs://<BUCKET>/<FOLDER>", to write the readings '
+              'and the statistics to, as files partitioned by hour for bulk '
+              'loads into BigQuery. By default, they are not written.'))
+    parser.add_argument(
+        '--sink_format', choices=('parquet', 'avro'), default='parquet',
+        help='Format of the files of --sink_path. parquet needs the pyarrow package.')
+    parser.add_argument(
+        '--sink_max_records', default=100000, type=int,
+        help='Records per file of --sink_path, at most.')
+    parser.add_argument(
+        '--sink_max_delay_s', default=300, type=float,
+        help=('Seconds a record waits, at most, before the file it goes to is '
+              'written, when streaming.'))
+    parser.add_argument(
+        '--debug_sample_interval', default=10, type=float,
+        help=('Interval, in seconds, between two logs of the statistics per '
+              'worker thread, when streaming. 0 logs all of them.'))
     known_args, pipeline_args = parser.parse_known_args(argv)
+    replay = known_args.input_files is not None
+    if replay != (known_args.output_path is not None):
+        parser.error('--input_files and --output_path go together.')
+    if known_args.sink_path and {'parquet': pyarrow, 'avro': fastavro}[
+            known_args.sink_format] is None:
+        parser.error('--sink_format {} needs the {} package.'.format(
+            known_args.sink_format, 'pyarrow' if known_args.sink_format == 'parquet'
+            else 'fastavro'))
+    rules, expiry_s = load_alert_rules(known_args.alert_rules)
+    dictionaries = load_dictionaries(known_args.compression_dictionaries)
 
     # We use the save_main_session option because one or more DoFn's in this
     # workflow rely on global context (e.g., a module imported at module level).
     pipeline_options = PipelineOptions(pipeline_args)
     pipeline_options.view_as(SetupOptions).save_main_session = True
-    pipeline_options.view_as(StandardOptions).streaming = True
+    pipeline_options.view_as(StandardOptions).streaming = not replay
     p = beam.Pipeline(options=pipeline_options)
 
-    # Read from PubSub into a PCollection.
-    if known_args.input_subscription:
-        lines = p | beam.io.ReadStringsFromPubSub(
+    # Read from PubSub into a PCollection. Messages are read as bytes, the
+    # gateway may forward binary frames.
+    if replay:
+        messages = p | beam.io.ReadFromText(
+            known_args.input_files, coder=beam.coders.BytesCoder())
+    elif known_args.input_subscription:
+        messages = p | beam.io.ReadFromPubSub(
             subscription=known_args.input_subscription)
     else:
-        lines = p | beam.io.ReadStringsFromPubSub(topic=known_args.input_topic)
-
-    # Count the occurrences of each word.
-    def count_ones(word_ones):
-        (word, ones) = word_ones
-        return (word, sum(ones))
+        messages = p | beam.io.ReadFromPubSub(topic=known_args.input_topic)
 
-    counts = (lines
+    parsed = (messages
             #   | 'print1' >> beam.Map(print)
-              | 'split' >> beam.Map(Extracting_X_Value)
-              | 'pair_with_one' >> beam.Map(lambda x: (x, 1))
-              | beam.WindowInto(window.SlidingWindows(10, 1, 0))
-              | 'group' >> beam.GroupByKey()
-              | 'count' >> beam.Map(count_ones))
+              | 'parse' >> beam.ParDo(ParseReadings(dictionaries)).with_output_types(
+                  AccelerometerReading).with_outputs(
+                      ParseReadings.DEAD_LETTER, ParseReadings.SUMMARY, main='readings'))
+    readings = parsed.readings
+    dead_letters = [parsed[ParseReadings.DEAD_LETTER]]
+    if replay:
+        # Windows and alerts follow the time the readings were sampled at,
+        # not the time they are replayed at
+        timestamped = readings | 'timestamp' >> beam.ParDo(
+            TimestampByEventTime()).with_output_types(AccelerometerReading).with_outputs(
+                ParseReadings.DEAD_LETTER, main='readings')
+        readings = timestamped.readings
+        dead_letters.append(timestamped[ParseReadings.DEAD_LETTER])
+
+    # The messages that failed, with their error
+    dead_letters = dead_letters | 'dead_letters' >> beam.Flatten()
+    if replay:
+        dead_letters | 'write_dead_letters' >> beam.io.WriteToText(
+            known_args.output_path + '-dead-letters', coder=beam.coders.BytesCoder())
+    elif known_args.dead_letter_topic:
+        dead_letters | 'write_dead_letters' >> beam.io.WriteToPubSub(
+            known_args.dead_letter_topic)
+
+    # Branch 1: Alert when a rule holds, e.g. the device lies on its left side
+    # for 10 seconds, by writing a message to PubSub
+    if replay:
+        # The readings of each device, sorted by ReplayAlertingFn
+        alert = (readings
+                 | 'key_by_device' >> beam.Map(
+                     lambda reading, timestamp=beam.DoFn.TimestampParam: (
+                         reading.device_id, (timestamp.micros, reading))).with_output_types(
+                             typing.Tuple[str, typing.Tuple[int, AccelerometerReading]])
+                 | 'group_by_device' >> beam.GroupByKey()
+                 | 'alert' >> beam.ParDo(ReplayAlertingFn(rules, expiry_s)))
+    else:
+        alert = (readings
+                 | 'key_by_device' >> beam.Map(
+                     lambda reading: (reading.device_id, reading)).with_output_types(
+                         typing.Tuple[str, AccelerometerReading])
+                 | 'alert' >> beam.ParDo(AlertingFn(rules, expiry_s)))
+    if replay:
+        alert | 'write_alerts' >> beam.io.WriteToText(
+            known_args.output_path + '-alerts', coder=beam.coders.BytesCoder())
+    else:
+        alert | 'write_to_pubsub' >> beam.io.WriteToPubSub(known_args.output_topic)
+
+    # Statistics of x, y and z per device, in 10s windows every second.
+    stats = (readings
+             | 'key_axes_by_device' >> beam.Map(
+                 lambda reading: (reading.device_id, (reading.x, reading.y, reading.z)))
+             | 'stats' >> CombinePerSlidingWindow(AxisStatsFn(), 10, 1, bounded=replay)
+             | 'to_device_stats' >> beam.Map(to_device_stats).with_output_types(
+                 DeviceStats))
+
+    # The statistics as records, with the summaries of the gateways that
+    # aggregate the readings: they publish the statistics of their windows
+    # instead, and the readings around anomalies only.
+    def to_stats_record(stats, stats_window=beam.DoFn.WindowParam):
+        return stats_record(stats, 'pipeline', stats_window.start.micros,
+                            stats_window.end.micros)
 
-    # Branch 1: Alert when x hits -1.0 = 10 x times, by writing a message to PubSub
-    alert = (counts | 'filter' >> beam.ParDo(Alerting_X_Value())
-                    | 'write_to_pubsub' >> beam.io.WriteStringsToPubSub(known_args.output_topic))
+    summaries = parsed[ParseReadings.SUMMARY]
+    if replay:
+        summaries = summaries | 'timestamp_summaries' >> beam.Map(
+            lambda summary: window.TimestampedValue(summary, summary.window_end))
+    # Out of their sliding windows, to be flattened with the summaries
+    aggregates = ((stats
+                   | 'stats_records' >> beam.Map(to_stats_record)
+                   | 'unwindow' >> beam.WindowInto(window.GlobalWindows()),
+                   summaries | 'summary_records' >> beam.Map(summary_record))
+                  | 'aggregates' >> beam.Flatten())
 
-    # Branch 2: Print out the output
-    # Format the counts into a PCollection of strings.
-    def format_result(word_count):
-        (word, count) = word_count
-        return '[{}] {}: {}'.format(time.ctime(), word, count)
+    # Branch 2: Write out the statistics, or log a sample of them
+    def format_record(record):
+        line = '[{}] {}: {} readings, {}'.format(
+            format_event_time(record['window_end'] / 1e6), record['device_id'], record['count'],
+            ', '.join('{} mean {:.3f} min {:.3f} max {:.3f} var {:.4f}'.format(
+                axis, *[record['{}_{}'.format(axis, field)] for field in AxisStats._fields])
+                      for axis in ('x', 'y', 'z')))
+        if record['source'] == 'gateway':
+            line += ' (gateway, since {})'.format(format_event_time(record['window_start'] / 1e6))
+        return line
+
+    if replay:
+        (aggregates
+         | 'format' >> beam.Map(format_record)
+         | 'write_stats' >> beam.io.WriteToText(known_args.output_path + '-stats'))
+    else:
+        aggregates | 'debug_sample' >> beam.ParDo(
+            SampledLog(known_args.debug_sample_interval, format_record))
 
-    output = (counts | 'format' >> beam.Map(format_result)
-                     | 'print' >> beam.Map(print))
+    # Branch 3: Write the readings and the statistics to Parquet or Avro
+    # files, to load into the data warehouse
+    if known_args.sink_path:
+        max_delay_s = None if replay else known_args.sink_max_delay_s
+        (readings
+         | 'reading_records' >> beam.Map(reading_record)
+         | 'write_readings' >> WriteColumnarFiles(
+             known_args.sink_path, 'readings', READING_COLUMNS, known_args.sink_format,
+             known_args.sink_max_records, max_delay_s))
+        aggregates | 'write_stats_files' >> WriteColumnarFiles(
+            known_args.sink_path, 'stats', STATS_COLUMNS, known_args.sink_format,
+            known_args.sink_max_records, max_delay_s)
 
+    start = time.time()
     result = p.run()
     result.wait_until_finish()
+    if replay:
+        logging.info('Replayed {} in {:.1f}s'.format(
+            known_args.input_files, time.time() - start))
+        totals = {}
+        for counter in result.metrics().query(
+                MetricsFilter().with_namespace(ParseReadings))['counters']:
+            name = counter.key.metric.name
+            totals[name] = totals.get(name, 0) + counter.committed
+        for name in sorted(totals):
+            logging.info('{}: {}'.format(name, totals[name]))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+"""
+Local benchmark of the detect_x_abnormal function.
+
+Calls the function as Cloud Functions would, with Pub/Sub events holding one
+device event or batches of them, and prints the latency of an invocation
+and the invocations needed per million readings. Run it from this folder:
+
+    python bench_function.py --batch_sizes 1 10 100 --messages 2000
+"""
+
+import argparse
+import base64
+import collections
+import contextlib
+import importlib
+import json
+import math
+import os
+import random
+import time
+
+Context = collections.namedtuple('Context', ['event_id', 'timestamp'])
+
+
+def percentile(ordered, fraction):
+    """Returns the nearest-rank percentile of a sorted sequence."""
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def make_event(device_id, timestamp, rng, tilted_ratio):
+    """Returns a JSON event of pi_device, lying on its left side sometimes."""
+    if rng.random() < tilted_ratio:
+        x, y, z = -1.0, 0.0, 0.0
+    else:
+        x, y, z = (round(rng.gauss(0, 0.02), 1), round(rng.gauss(0, 0.02), 1),
+                   round(1 + rng.gauss(0, 0.02), 1))
+    return {'device_id': device_id, 'event_time': time.ctime(timestamp),
+            'raw_accelerometer_data': 'x={}, y={}, z={}'.format(x, y, z)}
+
+
+def make_messages(count, batch_size, tilted_ratio, seed):
+    """Returns Pub/Sub events of batch_size device events each, as the gateway
+    publishes them: one JSON object, or an array of them."""
+    rng = random.Random(seed)
+    messages = []
+    for n in range(count):
+        events = [make_event('my-device', 1588085999 + n * batch_size + i, rng, tilted_ratio)
+                  for i in range(batch_size)]
+        payload = events[0] if batch_size == 1 else events
+        messages.append({'data': base64.b64encode(json.dumps(payload).encode())})
+    return messages
+
+
+def run(function, messages):
+    """Calls function on every message, returns the sorted latencies, in seconds."""
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for n, message in enumerate(messages):
+            context = Context(str(n), '2020-04-28T15:44:14.000Z')
+            start = time.perf_counter()
+            function(message, context)
+            latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--batch_sizes', nargs='+', default=[1, 10, 100], type=int,
+        help='Device events per Pub/Sub message, one run each.')
+    parser.add_argument(
+        '--messages', default=2000, type=int, help='Pub/Sub messages per run.')
+    parser.add_argument(
+        '--tilted_ratio', default=0.05, type=float,
+        help='Share of the readings lying on the left side, which raise alerts.')
+    parser.add_argument('--seed', default=1, type=int, help='Seed of the readings.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    main_module = importlib.import_module('main')
+    print('module initialization {:.1f} ms'.format((time.perf_counter() - start) * 1000))
+
+    print('{:>6} {:>10} {:>10} {:>10} {:>12} {:>16}'.format(
+        'batch', 'p50 us', 'p99 us', 'max us', 'us/reading', 'calls/1M readings'))
+    for batch_size in args.batch_sizes:
+        messages = make_messages(args.messages, batch_size, args.tilted_ratio, args.seed)
+        # Warm up, as a warm instance would be
+        run(main_module.detect_x_abnormal, messages[:100])
+        latencies = run(main_module.detect_x_abnormal, messages)
+        print('{:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.2f} {:>16}'.format(
+            batch_size, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6,
+            latencies[-1] * 1e6, sum(latencies) / (len(latencies) * batch_size) * 1e6,
+            int(math.ceil(1e6 / batch_size))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,226 @@
+import base64
+import glob
+import json
+import os
+import struct
+import time
+import zlib
+try:
+    import zstandard
+except ImportError:  # Only needed for the zstd payloads of the gateway
+    zstandard = None
+
+# Alert rules: a reading matches a rule when each axis of 'below' is at or
+# below its threshold, and each axis of 'above' at or above it. Set the
+# ALERT_RULES environment variable of the function to a JSON list to change
+# them, or ALERT_RULES_FILE to a JSON file deployed with the function, such as
+# extra_rules.json. By default, the x value of -1 only.
+DEFAULT_RULES = [
+    {'name': 'x_abnormal', 'message': 'X value is -1',
+     'below': {'x': -1.0}, 'above': {'x': -1.0}},
+]
+
+AXES = ('x', 'y', 'z')
+
+
+def compile_rules(rules):
+    """Returns the rules as (name, message, [(axis index, below, threshold)])."""
+    compiled = []
+    for rule in rules:
+        conditions = [(AXES.index(axis), True, float(threshold))
+                      for axis, threshold in sorted(rule.get('below', {}).items())]
+        conditions += [(AXES.index(axis), False, float(threshold))
+                       for axis, threshold in sorted(rule.get('above', {}).items())]
+        if not conditions:
+            raise ValueError('Rule {} has no condition'.format(rule['name']))
+        compiled.append((rule['name'], rule.get('message', rule['name']), conditions))
+    return compiled
+
+
+def load_rules():
+    """Returns the rules set in the environment of the function, or the default ones."""
+    if 'ALERT_RULES' in os.environ:
+        return json.loads(os.environ['ALERT_RULES'])
+    if 'ALERT_RULES_FILE' in os.environ:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.environ['ALERT_RULES_FILE'])
+        with open(path) as f:
+            return json.load(f)
+    return DEFAULT_RULES
+
+
+# Initialized once per instance, and kept across warm invocations
+RULES = compile_rules(load_rules())
+
+
+# Payloads compressed by the gateway (--compress): a !BBI header of magic,
+# encoding code (1 zlib, 2 zstd) and dictionary ID, then the compressed body.
+COMPRESSED_MAGIC = 0xB6
+COMPRESSED_HEADER = struct.Struct('!BBI')
+
+# Binary frames forwarded by the gateway (--binary_events forward): a !BBBB
+# header of magic, version, action code and length of the device id, the
+# device id, a !I sequence number from version 2, then !dfff samples of
+# timestamp, x, y and z.
+FRAME_MAGIC = 0xB5
+FRAME_HEADER = struct.Struct('!BBBB')
+FRAME_SEQ = struct.Struct('!I')
+FRAME_SAMPLE = struct.Struct('!dfff')
+
+# Bound of a decompressed payload, in bytes, that of a Pub/Sub message
+MAX_PAYLOAD_SIZE = 10 * 1024 * 1024
+
+
+def load_dictionaries(paths):
+    """Returns the compression dictionaries of files, by dictionary ID."""
+    dictionaries = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            dictionary = f.read()
+        dictionaries[zlib.crc32(dictionary) & 0xffffffff] = dictionary
+    return dictionaries
+
+
+# The dictionaries of the gateway, deployed with the function
+DICTIONARIES = load_dictionaries(
+    glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.dict')))
+ZSTD_DECOMPRESSORS = {}
+
+# Errors of corrupted or unknown compressed payloads
+DECOMPRESS_ERRORS = (struct.error, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def decompress(data):
+    """Returns the payload of a message, decompressed if the gateway compressed it."""
+    if data[:1] != bytes((COMPRESSED_MAGIC,)):
+        return data
+    _, code, dict_id = COMPRESSED_HEADER.unpack_from(data)
+    if dict_id not in DICTIONARIES:
+        raise ValueError('Unknown compression dictionary {:08x}'.format(dict_id))
+    body = data[COMPRESSED_HEADER.size:]
+    if code == 1:
+        decompressor = zlib.decompressobj(-15, DICTIONARIES[dict_id])
+        payload = decompressor.decompress(body, MAX_PAYLOAD_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError('Payload larger than {} bytes'.format(MAX_PAYLOAD_SIZE))
+        return payload
+    if code == 2 and zstandard is not None:
+        if dict_id not in ZSTD_DECOMPRESSORS:
+            ZSTD_DECOMPRESSORS[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(DICTIONARIES[dict_id]))
+        return ZSTD_DECOMPRESSORS[dict_id].decompress(body, max_output_size=MAX_PAYLOAD_SIZE)
+    raise ValueError('Unsupported compression {}'.format(code))
+
+
+def parse_frame(data):
+    """Returns the samples of a binary frame as the JSON events of pi_device."""
+    _, version, _, id_length = FRAME_HEADER.unpack_from(data)
+    body_start = FRAME_HEADER.size + id_length
+    device_id = data[FRAME_HEADER.size:body_start].decode('utf8')
+    if version >= 2:
+        body_start += FRAME_SEQ.size
+    return [{'device_id': device_id, 'event_time': time.asctime(time.gmtime(timestamp)),
+             'raw_accelerometer_data': 'x={}, y={}, z={}'.format(
+                 float('%.6g' % x), float('%.6g' % y), float('%.6g' % z))}
+            for timestamp, x, y, z in FRAME_SAMPLE.iter_unpack(data[body_start:])]
+
+
+def parse_payload(data):
+    """Returns the events of a decompressed payload, JSON or a binary frame."""
+    if data[:1] == bytes((FRAME_MAGIC,)):
+        return parse_frame(data)
+    return json.loads(data)
+
+
+def iter_events(payload):
+    """Yields the events of a payload: one event, or arrays of them when the
+    gateway or the device batched them."""
+    if isinstance(payload, list):
+        for item in payload:
+            for event in iter_events(item):
+                yield event
+    elif isinstance(payload, dict):
+        yield payload
+
+
+def parse_axes(raw_accelerometer_data):
+    """Returns the (x, y, z) of 'x=<x>, y=<y>, z=<z>'."""
+    parts = raw_accelerometer_data.split(', ')
+    # Fast path, for the exact format of pi_device and the gateway
+    if (len(parts) == 3 and parts[0][:2] == 'x=' and parts[1][:2] == 'y='
+            and parts[2][:2] == 'z='):
+        return float(parts[0][2:]), float(parts[1][2:]), float(parts[2][2:])
+    axes = {}
+    for part in raw_accelerometer_data.split(','):
+        name, _, value = part.partition('=')
+        axes[name.strip()] = float(value)
+    return axes['x'], axes['y'], axes['z']
+
+
+def read_columns(payload):
+    """Returns the events of a payload with readings, and their x, y and z
+    values as three columns."""
+    events = []
+    columns = ([], [], [])
+    for event in iter_events(payload):
+        try:
+            axes = parse_axes(event['raw_accelerometer_data'])
+        except (KeyError, ValueError, AttributeError):
+            continue
+        events.append(event)
+        for column, value in zip(columns, axes):
+            column.append(value)
+    return events, columns
+
+
+def match(conditions, columns):
+    """Returns the indexes of the readings meeting all the conditions.
+
+    A whole column is checked against a threshold with min() or max() first,
+    so that a batch without any match is rejected without a Python loop."""
+    matches = None
+    for axis, below, threshold in conditions:
+        column = columns[axis]
+        if below and min(column) > threshold or not below and max(column) < threshold:
+            return []
+        if matches is None:
+            matches = range(len(column))
+        if below:
+            matches = [i for i in matches if column[i] <= threshold]
+        else:
+            matches = [i for i in matches if column[i] >= threshold]
+        if not matches:
+            return []
+    return matches
+
+
 def detect_x_abnormal(event, context):
-    import base64
-    import json
-
-    if 'data' in event:
-        d_data = base64.b64decode(event['data']).decode('utf-8')
-        j_data = json.loads(d_data)
-        x_value = float(j_data['raw_accelerometer_data'].split(',')[0].strip().split('=')[1])
-        if x_value == -1.0:
-            print("""X value is -1, triggered by messageID {} published at {}""".format(context.event_id, context.timestamp))
\ No newline at end of file
+    """Logs one line per rule matched by the readings of a Pub/Sub message,
+    which holds one event or a batch of them, in JSON or as a binary frame.
+    Returns the lines."""
+    if 'data' not in event:
+        return []
+    try:
+        payload = parse_payload(decompress(base64.b64decode(event['data'])))
+    except (ValueError,) + DECOMPRESS_ERRORS as e:
+        print('Invalid message {}: {}'.format(context.event_id, e))
+        return []
+    events, columns = read_columns(payload)
+    if not events:
+        return []
+
+    alerts = []
+    for name, message, conditions in RULES:
+        matches = match(conditions, columns)
+        if not matches:
+            continue
+        first = events[matches[0]]
+        alerts.append(
+            '{}, triggered by messageID {} published at {}: rule {}, {} of {} '
+            'readings of {} from {}'.format(
+                message, context.event_id, context.timestamp, name, len(matches),
+                len(events), first.get('device_id'), first.get('event_time')))
+    for alert in alerts:
+        print(alert)
+    return alerts